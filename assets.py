@@ -0,0 +1,71 @@
+import asyncio
+import hashlib
+import logging
+import os
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile
+
+from db import get_asset_file_id, save_asset_file_id, forget_asset, club
+
+# Реестр локальных картинок (images/): каждый файл загружается в Telegram
+# один раз, а полученный file_id сохраняется в базе по sha256 содержимого.
+# Дальше картинка отправляется по file_id; если Telegram его не принял,
+# файл загружается заново. Диск читается только при первом обращении
+# к файлу (или при preload на старте) — в отдельном потоке.
+# file_id действует для бота в любом чате, поэтому реестр общий — в основной базе.
+
+ASSETS_DIR = "images"
+
+_digests: dict[str, str | None] = {}  # путь -> sha256 (None — файла нет)
+_file_ids: dict[str, str] = {}        # sha256 -> file_id
+
+
+def _hash_file(path: str) -> str | None:
+    try:
+        with open(path, "rb") as f:
+            return hashlib.file_digest(f, "sha256").hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+async def _digest(path: str) -> str | None:
+    if path not in _digests:
+        _digests[path] = await asyncio.to_thread(_hash_file, path)
+    return _digests[path]
+
+
+async def preload(directory: str = ASSETS_DIR):
+    # считаем хэши всех картинок заранее, чтобы первый запрос не ждал диска
+    names = await asyncio.to_thread(lambda: sorted(os.listdir(directory)) if os.path.isdir(directory) else [])
+    for name in names:
+        await _digest(os.path.join(directory, name))
+
+
+async def reply_photo(message, path: str, **kwargs):
+    # -> отправленное сообщение или None, если файла нет
+    digest = await _digest(path)
+    if digest is None:
+        return None
+
+    file_id = _file_ids.get(digest)
+    if not file_id:
+        async with club(None):
+            file_id = await get_asset_file_id(digest)
+    if file_id:
+        try:
+            sent = await message.reply_photo(photo=file_id, **kwargs)
+            _file_ids[digest] = file_id
+            return sent
+        except TelegramBadRequest as e:
+            logging.warning("Telegram не принял file_id для %s (%s), загружаю заново", path, e)
+            _file_ids.pop(digest, None)
+            async with club(None):
+                await forget_asset(digest)
+
+    sent = await message.reply_photo(photo=FSInputFile(path), **kwargs)
+    if sent.photo:
+        _file_ids[digest] = sent.photo[-1].file_id
+        async with club(None):
+            await save_asset_file_id(digest, path, _file_ids[digest])
+    return sent
@@ -0,0 +1,90 @@
+import asyncio
+import logging
+
+from config import AUDIT_INTERVAL, AUDIT_CHUNK, AUDIT_PAUSE_MS, AUDIT_REPAIR
+from db import audit_history, audit_balances, audit_users, repair_balance_drift, club, dirty_clubs
+import metrics
+
+# Сверка балансов с историей: раз в AUDIT_INTERVAL новые записи истории
+# (после отметки audit_to) складываются в суммы по участникам шагами по
+# AUDIT_CHUNK с паузой, затем балансы тех, чьи суммы изменились, сверяются
+# с историей. Отметка хранится в базе, поэтому прерванная полная сверка
+# (миллионы записей после первого запуска) продолжается с того же места.
+# После запуска бота один раз проходятся и все участники: так находятся
+# балансы, менявшиеся мимо истории. Расхождения пишутся в лог и метрики;
+# с AUDIT_REPAIR они закрываются записью 'audit' в истории.
+# Клубы (чаты со своей базой) обходятся по очереди через db.club(background=True):
+# после первого прохода — только те, где с прошлого прохода работали обработчики.
+
+_task: asyncio.Task | None = None
+_swept: set = set()  # клубы, где после запуска уже прошли всех участников
+
+
+async def _report(drift: list[tuple[int, int, int]], repair: bool) -> int:
+    for user_id, balance, expected in drift:
+        metrics.inc("archivist_audit_drift_total")
+        logging.warning("Сверка: у %s баланс %s, по истории %s", user_id, balance, expected)
+    if repair and drift:
+        await repair_balance_drift([user_id for user_id, _, _ in drift])
+    return len(drift)
+
+
+async def run_once(chunk: int = AUDIT_CHUNK, pause_ms: float = AUDIT_PAUSE_MS,
+                   repair: bool = AUDIT_REPAIR, sweep: bool = False) -> dict:
+    # -> {"history": записей добавлено в сверку, "drift": расхождений}
+    stats = {"history": 0, "drift": 0}
+    while True:
+        count = await audit_history(chunk)
+        stats["history"] += count
+        if count < chunk:
+            break
+        await asyncio.sleep(pause_ms / 1000)
+    pages = [audit_balances, audit_users] if sweep else [audit_balances]
+    for page in pages:
+        cursor = 0
+        while cursor is not None:
+            drift, cursor = await page(cursor, chunk)
+            stats["drift"] += await _report(drift, repair)
+            await asyncio.sleep(pause_ms / 1000)
+    return stats
+
+
+async def run_club(chat_id: int | None) -> dict:
+    async with club(chat_id, background=True):
+        stats = await run_once(sweep=chat_id not in _swept)
+    _swept.add(chat_id)
+    return stats
+
+
+async def run_all() -> int:
+    # -> сколько расхождений найдено во всех клубах
+    drift = 0
+    for chat_id in await dirty_clubs("audit"):
+        drift += (await run_club(chat_id))["drift"]
+    return drift
+
+
+async def _loop():
+    while True:
+        try:
+            drift = await run_all()
+            if drift:
+                logging.warning("Сверка балансов: расхождений %s%s", drift, " (исправлены)" if AUDIT_REPAIR else "")
+        except Exception:
+            logging.exception("Ошибка сверки балансов")
+        await asyncio.sleep(AUDIT_INTERVAL)
+
+
+def start():
+    global _task
+    if _task is None and AUDIT_INTERVAL > 0:
+        _task = asyncio.create_task(_loop())
+
+
+async def stop():
+    global _task
+    if _task is None:
+        return
+    _task.cancel()
+    await asyncio.gather(_task, return_exceptions=True)
+    _task = None
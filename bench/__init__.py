@@ -0,0 +1 @@
+# Офлайн-бенчмарки бота. Запуск: python -m bench.<имя>
@@ -0,0 +1,176 @@
+# Сверка балансов с историей: база с N записями истории и балансами, которые
+# с ней сходятся, кроме подстроенных расхождений (баланс изменён мимо истории,
+# баланс без единой записи). Полная сверка запускается под потоком
+# change_balance, прерывается на середине и продолжается следующим запуском.
+# Проверки:
+#   - после прерывания сверка продолжается с отметки, а не с начала, и каждая
+#     запись учтена ровно один раз;
+#   - найдены ровно подстроенные расхождения, после исправления их нет, а
+#     балансы участников не изменились — ни текущие, ни на момент времени
+#     (снимок, снятый до исправления, уже содержит расхождение); снимок
+#     снимается один раз на страницу исправлений, а не на каждого участника;
+#   - следующий запуск обрабатывает только новые записи;
+#   - «обнулить баланс» и «обнулить балансы» пишут историю — расхождений нет;
+#   - p99 записи баланса во время сверки растёт не больше чем на SLOW_MS.
+# Падает (код 1), если хоть одна проверка не прошла.
+#
+# Запуск: python -m bench.audit [число записей, 1 000 000]
+import asyncio
+import random
+import sys
+import time
+
+import audit
+import db
+from bench.common import percentile, temp_db
+from bench.eventlog import reopen_after_seed
+
+USERS = 5000
+SEED_BATCH = 100_000
+LOAD_WORKERS = 10
+INTERRUPT_S = 3.0
+SLOW_MS = 20
+DRIFT = {17: 7, 42: -3, 4242: 100}  # участник -> на сколько баланс изменён мимо истории
+ORPHAN = 10**9                     # баланс без истории
+
+
+async def _seed(rows: int):
+    conn = db._db().writer
+    rnd = random.Random(1)
+    balances = [0] * USERS
+    for start in range(0, rows, SEED_BATCH):
+        batch = []
+        for _ in range(start, min(start + SEED_BATCH, rows)):
+            uid = rnd.randrange(USERS)
+            amount = max(rnd.randint(-4, 6), -balances[uid])
+            balances[uid] += amount
+            batch.append((uid + 1, amount))
+        await conn.executemany(
+            "INSERT INTO history (user_id, action, amount, reason) VALUES (?, 'change_balance', ?, 'сид')", batch)
+        await conn.commit()
+    await conn.executemany("INSERT INTO users (user_id, balance, key) VALUES (?, ?, 0)",
+                           ((uid + 1, b) for uid, b in enumerate(balances)))
+    await conn.executemany("UPDATE users SET balance = balance + ? WHERE user_id = ?",
+                           ((delta, uid) for uid, delta in DRIFT.items()))
+    await conn.execute("INSERT INTO users (user_id, balance, key) VALUES (?, 55, 0)", (ORPHAN,))
+    await conn.commit()
+
+
+async def _scalar(sql: str, *params) -> int:
+    async with db._db().read() as conn:
+        async with conn.execute(sql, params) as cur:
+            return (await cur.fetchone())[0]
+
+
+async def _load(stop: asyncio.Event, latencies: list[float]):
+    rnd = random.Random()
+    while not stop.is_set():
+        start = time.perf_counter()
+        await db.change_balance(rnd.randint(1, USERS), rnd.randint(1, 5), "нагрузка", 0)
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(0.005)
+
+
+async def _under_load(work) -> tuple[object, list[float]]:
+    stop = asyncio.Event()
+    latencies: list[float] = []
+    workers = [asyncio.create_task(_load(stop, latencies)) for _ in range(LOAD_WORKERS)]
+    try:
+        result = await work
+    finally:
+        stop.set()
+        await asyncio.gather(*workers)
+    return result, latencies
+
+
+async def main(rows: int) -> int:
+    failures = []
+    async with temp_db("audit.sqlite"):
+        await _seed(rows)
+        await reopen_after_seed()
+
+        _, idle = await _under_load(asyncio.sleep(INTERRUPT_S))
+
+        # полная сверка, прерванная на середине
+        async def interrupted():
+            task = asyncio.create_task(audit.run_once(sweep=True))
+            await asyncio.sleep(INTERRUPT_S)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+        start = time.perf_counter()
+        _, busy = await _under_load(interrupted())
+        mark = await _scalar("SELECT value FROM meta WHERE key = 'audit_to'")
+        print(f"прервана через {INTERRUPT_S:.0f} с на записи {mark} из {rows}")
+        if not 0 < int(mark) < rows:
+            failures.append(f"после прерывания отметка {mark}: сверка не шла или успела целиком")
+
+        stats, resumed = await _under_load(audit.run_once(sweep=True))
+        elapsed = time.perf_counter() - start
+        busy += resumed
+        print(f"продолжена с отметки: {stats}; вся сверка {rows} записей за {elapsed:.1f} с "
+              f"({rows / elapsed:.0f} записей/с)")
+        print(f"p99 записи баланса: без сверки {percentile(idle, 99):.1f} мс, во время сверки {percentile(busy, 99):.1f} мс")
+        if percentile(busy, 99) - percentile(idle, 99) > SLOW_MS:
+            failures.append(f"сверка подняла p99 записи больше чем на {SLOW_MS} мс")
+        if stats["history"] >= rows:
+            failures.append("после прерывания сверка началась сначала")
+
+        ledger = await _scalar("SELECT SUM(amount) FROM audit_ledger")
+        total = await _scalar("SELECT SUM(amount) FROM history WHERE id <= "
+                              "(SELECT CAST(value AS INTEGER) FROM meta WHERE key = 'audit_to')")
+        if ledger != total:
+            failures.append(f"в сверке {ledger}, а в истории до отметки {total}: записи учтены не по разу")
+
+        # расхождения: нашлись подстроенные, закрыты записью в истории, балансы те же
+        await db.reset_user_balance(42)  # пишет историю: расхождение остаётся прежним, не растёт
+        before = {uid: await db.get_balance(uid) for uid in [*DRIFT, ORPHAN]}
+        await db.take_snapshot()
+        snaps = await _scalar("SELECT COUNT(*) FROM snapshots")
+        checked = await audit.run_once(sweep=True, repair=True)
+        snaps = await _scalar("SELECT COUNT(*) FROM snapshots") - snaps
+        async with db._db().read() as conn:
+            async with conn.execute("SELECT user_id, amount FROM history WHERE action = 'audit' "
+                                    "ORDER BY user_id") as cur:
+                found = await cur.fetchall()
+        expected = sorted({**DRIFT, ORPHAN: 55}.items())
+        print(f"исправлено: {found}, ожидалось {expected}; {checked}")
+        if found != expected:
+            failures.append("найдены не те расхождения")
+        if snaps > 2:  # по снимку на страницу audit_balances и audit_users, а не на участника
+            failures.append(f"исправление сняло балансы {snaps} раз")
+        if {uid: await db.get_balance(uid) for uid in before} != before:
+            failures.append("исправление изменило балансы участников")
+        now = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time() + 1))
+        at = {uid: await db.get_balance_at(uid, now) for uid in before}
+        if at != before:
+            failures.append(f"баланс на момент после исправления {at}, а в кармане {before}")
+
+        again = await audit.run_once(sweep=True)
+        if again["drift"]:
+            failures.append(f"после исправления осталось расхождений: {again['drift']}")
+
+        # новые записи: следующий запуск берёт только их
+        for uid in range(1, 1001):
+            await db.change_balance(uid, 1, "новое", 0)
+        start = time.perf_counter()
+        stats = await audit.run_once()
+        print(f"1000 новых записей: {stats} за {(time.perf_counter() - start) * 1e3:.0f} мс")
+        if stats["history"] != 1000 or stats["drift"]:
+            failures.append("повторный запуск обработал не только новые записи")
+
+        await db.reset_all_balances()
+        stats = await audit.run_once(sweep=True)
+        print(f"после «обнулить балансы»: {stats}")
+        if stats["drift"] or await _scalar("SELECT COALESCE(SUM(amount), 0) FROM audit_ledger"):
+            failures.append("обнуление балансов не сходится с историей")
+
+    for failure in failures:
+        print("ОШИБКА:", failure)
+    if not failures:
+        print("балансы сходятся с историей, сверка продолжается после прерывания")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)))
@@ -0,0 +1,113 @@
+# Массовые начисления: bulk_change_balance на N участников одной транзакцией
+# против N отдельных change_balance (параллельно, через групповую фиксацию),
+# затем команды «раздать»/«собрать» целиком через handle_message: по
+# хранителям ключа, по роли и по упоминаниям. Падает (код 1), если балансы
+# или история не сходятся, ответов не ровно по одному на команду или N
+# начислений заняли секунду и больше.
+#
+# Запуск: python -m bench.bulk [участников, 1000]
+import asyncio
+import sys
+import time
+
+from aiogram.types import MessageEntity
+
+import db
+import outbox
+from bench.common import temp_db
+from bench.fakes import FakeBot, FakeMessage, FakeUser
+from commands import KURATOR_ID, handle_message
+
+LIMIT_S = 1.0
+
+
+async def _scalar(sql: str, *params) -> int:
+    async with db._db().read() as conn:
+        async with conn.execute(sql, params) as cur:
+            return (await cur.fetchone())[0]
+
+
+async def _command(bot: FakeBot, text: str, entities: list | None = None) -> tuple[float, list[str]]:
+    sent = len(bot.sent)
+    message = FakeMessage(bot, FakeUser(KURATOR_ID, "Куратор"), text=text, entities=entities)
+    start = time.perf_counter()
+    await handle_message(message)
+    elapsed = time.perf_counter() - start
+    await outbox.drain()
+    return elapsed, bot.sent[sent:]
+
+
+async def main(n: int) -> int:
+    failures = []
+    async with temp_db("bulk.sqlite"):
+        users = list(range(1, n + 1))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(db.change_balance(uid, 5, "по одному", 0) for uid in users))
+        single_ms = (time.perf_counter() - start) * 1e3
+
+        start = time.perf_counter()
+        done, skipped = await db.bulk_change_balance(users, 5, "раздача")
+        credit_ms = (time.perf_counter() - start) * 1e3
+
+        # половине не хватит: у нечётных списываем заранее
+        await db.bulk_change_balance(users[::2], -10, "подготовка")
+        start = time.perf_counter()
+        taken, short = await db.bulk_change_balance(users, -3, "сбор")
+        debit_ms = (time.perf_counter() - start) * 1e3
+
+        print(f"{n} × change_balance параллельно: {single_ms:.0f} мс")
+        print(f"bulk_change_balance на {n}: зачисление {credit_ms:.0f} мс, "
+              f"списание {debit_ms:.0f} мс (прошло {len(taken)}, не хватило {len(short)})")
+        if max(credit_ms, debit_ms) >= LIMIT_S * 1e3:
+            failures.append(f"массовая операция на {n} заняла секунду и больше")
+        if len(done) != n or skipped or len(taken) != n // 2 or len(short) != n - n // 2:
+            failures.append("не те участники попали в зачисление или списание")
+        if await db.get_balance(2) != 7 or await db.get_balance(1) != 0:
+            failures.append("балансы после массовых операций не сходятся")
+        if await _scalar("SELECT COUNT(*) FROM history WHERE reason = 'сбор'") != n // 2:
+            failures.append("в истории не по записи на каждое списание")
+
+        # команды целиком: хранители ключа, роль, упоминания
+        conn = db._db().writer
+        await conn.executemany("UPDATE users SET key = 1 WHERE user_id = ?", ((uid,) for uid in users))
+        await conn.executemany("INSERT INTO roles (user_id, role_name, role_desc) VALUES (?, 'Бармен', '')",
+                               ((uid,) for uid in users[:10]))
+        await conn.commit()
+        db._db().profiles.invalidate()
+        await db.save_names([(101, "Сто один", "user101"), (102, "Сто два", "User102")])
+
+        bot = FakeBot()
+        before = await _scalar("SELECT SUM(balance) FROM users")
+        elapsed, replies = await _command(bot, "раздать 2 хранителям")
+        print(f"«раздать 2 хранителям» ({n}): {elapsed * 1e3:.0f} мс, ответ: {replies}")
+        if len(replies) != 1 or await _scalar("SELECT SUM(balance) FROM users") != before + 2 * n:
+            failures.append("раздача хранителям не сошлась")
+
+        elapsed, replies = await _command(bot, "собрать 1 роли бармен")
+        print(f"«собрать 1 роли бармен»: {elapsed * 1e3:.0f} мс, ответ: {replies}")
+        if len(replies) != 1 or "10 участников" not in replies[0]:
+            failures.append("сбор по роли не сошёлся")
+
+        text = "раздать 4 @user101 @USER102 @nobody Гость"
+        entities = [MessageEntity(type="mention", offset=text.index(word), length=len(word))
+                    for word in ("@user101", "@USER102", "@nobody")]
+        entities.append(MessageEntity(type="text_mention", offset=text.index("Гость"), length=5,
+                                      user={"id": 103, "is_bot": False, "first_name": "Гость"}))
+        balance = await db.get_balance(101)
+        elapsed, replies = await _command(bot, text, entities)
+        print(f"«{text}»: {elapsed * 1e3:.0f} мс, ответ: {replies}")
+        if (len(replies) != 1 or "3 участникам" not in replies[0] or "@nobody" not in replies[0]
+                or await db.get_balance(101) != balance + 4):
+            failures.append("раздача по упоминаниям не сошлась")
+
+    for failure in failures:
+        print("ОШИБКА:", failure)
+    if not failures:
+        print("массовые операции сходятся")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    sys.exit(asyncio.run(main(int(args[0]) if args else 1000)))
@@ -0,0 +1,33 @@
+# Общее для бенчмарков: перцентили задержек и временная база.
+import os
+import statistics
+import tempfile
+from contextlib import asynccontextmanager
+
+import db
+
+
+def quantiles(values: list[float]) -> list[float]:
+    # 99 точек: [49] — p50, [98] — p99. Метод inclusive не выходит за min/max
+    # выборки (exclusive на малой выборке даёт p99 больше максимума)
+    if len(values) < 2:
+        return [values[0] if values else 0.0] * 99
+    return statistics.quantiles(values, n=100, method="inclusive")
+
+
+def percentile(values: list[float], q: int) -> float:
+    # q-й перцентиль задержек в секундах -> мс
+    return quantiles(values)[q - 1] * 1e3
+
+
+@asynccontextmanager
+async def temp_db(name: str = "bench.sqlite"):
+    # Пустая база во временном каталоге: db.DB_PATH указывает на неё, пока открыта.
+    # -> каталог, в котором можно класть свои файлы (клубы, архив, выгрузки)
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, name)
+        await db.init_db()
+        try:
+            yield tmp
+        finally:
+            await db.close_db()
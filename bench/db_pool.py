@@ -0,0 +1,53 @@
+# Сравнение: новое соединение на каждый запрос (как было) против пула db.py.
+# Через пул идёт тот же SELECT, что и без него: get_balance отвечает из кэша
+# профилей и соединение не трогает, поэтому его число — отдельной строкой.
+# Запуск: python -m bench.db_pool [число запросов]
+import asyncio
+import sys
+import time
+
+import aiosqlite
+
+import db
+from bench.common import temp_db
+
+USERS = 200
+
+
+async def _seed():
+    for uid in range(1, USERS + 1):
+        await db.change_balance(uid, uid, "сид", 0)
+
+
+async def _per_call_connect(user_id: int) -> int:
+    async with aiosqlite.connect(db.DB_PATH) as conn:
+        async with conn.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,)) as cur:
+            row = await cur.fetchone()
+            return row[0] if row else 0
+
+
+async def _pooled_read(user_id: int) -> int:
+    async with db._db().read() as conn:
+        async with conn.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,)) as cur:
+            row = await cur.fetchone()
+            return row[0] if row else 0
+
+
+async def _measure(label: str, fn, n: int):
+    start = time.perf_counter()
+    for i in range(n):
+        await fn(i % USERS + 1)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<22} {n / elapsed:>10.0f} запр/с   {elapsed / n * 1e6:>8.1f} мкс/запрос")
+
+
+async def main(n: int):
+    async with temp_db("bench.sqlite"):
+        await _seed()
+        await _measure("connect на запрос", _per_call_connect, n)
+        await _measure("пул (read + SELECT)", _pooled_read, n)
+        await _measure("get_balance (кэш)", db.get_balance, n)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000))
@@ -0,0 +1,34 @@
+# Скорость разбора сообщений диспетчером commands.classify на реалистичной смеси
+# обычной болтовни и команд.
+# Запуск: python -m bench.dispatch [число сообщений]
+import random
+import sys
+import time
+
+from commands import classify
+
+CHATTER = (
+    "привет всем", "доброе утро, клуб", "кто сегодня вечером?", "ахаха", "👍",
+    "а где куратор?", "передайте соль", "ставки сделаны, господа", "ну и погода",
+    "Мне кажется, это был лучший вечер в клубе за месяц. Спасибо всем!",
+)
+COMMANDS = (
+    "мой карман", "моя роль", "рейтинг клуба", "члены клуба", "передать 10",
+    "ставлю 5 на 🎲", "вручить 3", "отнять 2", "карман", 'назначить "Граф" Хранитель',
+)
+COMMAND_SHARE = 0.15
+
+
+def main(n: int):
+    rnd = random.Random(1)
+    messages = [rnd.choice(COMMANDS) if rnd.random() < COMMAND_SHARE else rnd.choice(CHATTER)
+                for _ in range(n)]
+    start = time.perf_counter()
+    matched = sum(1 for text in messages if classify(text) is not None)
+    elapsed = time.perf_counter() - start
+    print(f"{n} сообщений, команд: {matched}")
+    print(f"{n / elapsed:,.0f} сообщений/с, {elapsed / n * 1e6:.2f} мкс на сообщение")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200_000)
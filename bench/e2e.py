@@ -0,0 +1,149 @@
+# Сквозной прогон настоящего бота: bot.py запускается отдельным процессом
+# (long polling, aiogram, шарды, обработчики, база, очередь отправки) и
+# смотрит в bench/fakeapi.py через TELEGRAM_API_URL. Нагрузка идёт ступенями
+# (столько-то обновлений в секунду, каждая ступень — заданное число секунд),
+# после ступени — до DRAIN_S секунд на то, чтобы бот ответил на всё. Для ступени печатаются
+# задержка «обновление -> ответ» (p50/p95/p99/max), сколько ответов в секунду
+# бот выдержал и сколько осталось без ответа; в конце — самая высокая ступень,
+# которую бот держит (все ответы, p95 меньше SLO_MS).
+#
+# Лимиты Telegram в очереди отправки бота по умолчанию сняты (иначе потолок —
+# OUTBOX_GLOBAL_RATE ответов в секунду); --limits оставляет их как в config.py.
+# Падает (код 1), если бот не поднялся, упал или не ответил на первой ступени.
+#
+# Запуск: python -m bench.e2e [обновлений/с через запятую, 50,200,500,1000] [секунд на ступень, 10]
+#                              [задержка API, мс, 30] [доля 429, 0.01] [--limits] [--eventlog]
+import asyncio
+import collections
+import os
+import signal
+import sys
+import tempfile
+import time
+
+from bench.common import percentile
+from bench.fakeapi import FakeTelegram
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PORT = 18081
+DRAIN_S = 15
+SLO_MS = 1000
+START_TIMEOUT_S = 60
+UNLIMITED = {"OUTBOX_GLOBAL_RATE": "100000", "OUTBOX_CHAT_RATE": "100000", "OUTBOX_GROUP_PER_MIN": "6000000",
+             "OUTBOX_BURST": "1000"}
+
+
+async def _start_bot(tmp: str, log, limits: bool, eventlog: bool) -> asyncio.subprocess.Process:
+    env = {**os.environ, "BOT_TOKEN": "42:e2e", "TELEGRAM_API_URL": f"http://127.0.0.1:{PORT}",
+           "DB_PATH": os.path.join(tmp, "bot.sqlite"), "METRICS_PORT": "0", "BOT_MODE": "polling",
+           "CLUBS_DIR": "", "PYTHONUNBUFFERED": "1"}
+    if not limits:
+        env.update(UNLIMITED)
+    if eventlog:
+        env["STORAGE_BACKEND"] = "eventlog"
+    return await asyncio.create_subprocess_exec(sys.executable, "bot.py", cwd=ROOT, env=env,
+                                                stdout=log, stderr=asyncio.subprocess.STDOUT)
+
+
+async def _stage(api: FakeTelegram, bot: asyncio.subprocess.Process, rate: float, seconds: float) -> dict:
+    first = len(api.latencies)
+    calls = sum(api.calls.values())
+    rejected = api.rejected
+    start = time.perf_counter()
+    offered, expected = await api.feed(rate, seconds)
+    fed = time.perf_counter()
+    deadline = fed + DRAIN_S
+    while api.pending and time.perf_counter() < deadline and bot.returncode is None:
+        await asyncio.sleep(0.05)
+    latencies = api.latencies[first:]
+    in_window = sum(1 for t in api.answered_at[first:] if t <= fed)
+    return {"rate": rate, "offered": offered, "expected": expected, "answered": len(latencies),
+            "left": len(api.pending), "per_s": in_window / (fed - start), "p50": percentile(latencies, 50), "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99), "max": max(latencies, default=0) * 1e3,
+            "calls": sum(api.calls.values()) - calls, "rejected": api.rejected - rejected}
+
+
+async def main(rates: list[float], seconds: float, latency_ms: float, rate_429: float,
+               limits: bool, eventlog: bool) -> int:
+    failures = []
+    api = FakeTelegram(latency_ms=latency_ms, jitter_ms=latency_ms / 2, rate_429=rate_429)
+    await api.start(port=PORT)
+    with tempfile.TemporaryDirectory() as tmp:
+        log_path = os.path.join(tmp, "bot.log")
+        with open(log_path, "wb") as log:
+            bot = await _start_bot(tmp, log, limits, eventlog)
+            results = []
+            try:
+                started = time.perf_counter()
+                while not api.calls["getUpdates"] and bot.returncode is None:
+                    if time.perf_counter() - started > START_TIMEOUT_S:
+                        break
+                    await asyncio.sleep(0.05)
+                if not api.calls["getUpdates"]:
+                    failures.append("бот не начал опрашивать getUpdates")
+                else:
+                    print(f"бот поднялся за {time.perf_counter() - started:.1f} с; API: задержка {latency_ms:g} мс "
+                          f"(+до {latency_ms / 2:g}), 429 на {rate_429:.1%} отправок; "
+                          f"лимиты отправки {'как в config.py' if limits else 'сняты'}"
+                          f"{', STORAGE_BACKEND=eventlog' if eventlog else ''}")
+                    await api.feed(20, 2)  # прогрев: участники, имена, кэши
+                    while api.pending and time.perf_counter() - started < START_TIMEOUT_S:
+                        await asyncio.sleep(0.05)
+                    for rate in rates:
+                        if bot.returncode is not None:
+                            break
+                        result = await _stage(api, bot, rate, seconds)
+                        results.append(result)
+                        print(f"{rate:>6g}/с: обновлений {result['offered']:>6} (ждут ответа {result['expected']:>6}), "
+                              f"ответов {result['answered']:>6} "
+                              f"({result['per_s']:>6.0f}/с), без ответа {result['left']:>5}; "
+                              f"p50 {result['p50']:>6.0f} p95 {result['p95']:>6.0f} p99 {result['p99']:>6.0f} "
+                              f"max {result['max']:>6.0f} мс; вызовов API {result['calls']}, 429: {result['rejected']}")
+                        api.pending.clear()  # хвост не переходит в следующую ступень
+            finally:
+                if bot.returncode is None:
+                    bot.send_signal(signal.SIGINT)
+                    try:
+                        await asyncio.wait_for(bot.wait(), 30)
+                    except asyncio.TimeoutError:
+                        bot.kill()
+                        await bot.wait()
+                        failures.append("бот не остановился по SIGINT за 30 с")
+                elif not failures:
+                    failures.append(f"бот упал с кодом {bot.returncode}")
+                await api.stop()
+        with open(log_path, encoding="utf-8", errors="replace") as f:
+            lines = f.read().splitlines()
+    # ошибки в логе бота: последняя строка каждого traceback — само исключение
+    errors = collections.Counter()
+    for i, line in enumerate(lines):
+        if line.startswith("Traceback"):
+            end = next((j for j in range(i + 1, len(lines)) if not lines[j].startswith(" ")), len(lines) - 1)
+            errors[lines[end][:160]] += 1
+    print(f"в логе бота ошибок: {sum(errors.values())}")
+    for error, count in errors.most_common(5):
+        print(f"  {count} × {error}")
+
+    if results and not results[0]["answered"]:
+        failures.append("на первой ступени бот не ответил ни на одно обновление")
+    # p95, а не p99: ответы, получившие 429, честно ждут retry_after (секунду и больше)
+    held = [r["rate"] for r in results if not r["left"] and r["p95"] < SLO_MS]
+    if results:
+        print(f"устойчиво: {max(held):g} обновлений/с (все ответы, p95 < {SLO_MS} мс)" if held
+              else f"ни одна ступень не прошла с p95 < {SLO_MS} мс")
+    if failures:
+        print("\n".join(lines[-30:]))
+    for failure in failures:
+        print("ОШИБКА:", failure)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    flags = {a for a in sys.argv[1:] if a.startswith("--")}
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    sys.exit(asyncio.run(main(
+        [float(r) for r in args[0].split(",")] if args else [50, 200, 500, 1000],
+        float(args[1]) if len(args) > 1 else 10,
+        float(args[2]) if len(args) > 2 else 30,
+        float(args[3]) if len(args) > 3 else 0.01,
+        "--limits" in flags, "--eventlog" in flags)))
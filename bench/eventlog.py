@@ -0,0 +1,265 @@
+# Хранилище «журнал событий» (STORAGE_BACKEND=eventlog) против SQLite:
+#   - один и тот же случайный сценарий (начисления, списания, переводы, массовые
+#     операции, обнуления, роли, ключи, ставки) на обоих хранилищах: ответы
+#     функций db.py и содержимое таблиц (users, roles, pending_bets, история
+#     каждого участника по порядку) должны совпасть;
+#   - перезапуск с журналом, сжатым по ходу работы в снимок, восстанавливает
+#     то же состояние;
+#   - сбой процесса: дочерний процесс пишет под нагрузкой и падает (os._exit)
+#     сразу после подтверждённых записей, не дождавшись переноса в базу, и
+#     оставляет оборванную строку в конце журнала. После старта видны все
+#     подтверждённые изменения, а история в базе сходится с балансами;
+#   - пропускная способность: WORKERS параллельных обработчиков, 80% чтений
+#     (баланс, ключ, роль) и 20% записей, участников больше, чем кэш профилей.
+# Падает (код 1), если что-то не сошлось.
+#
+# Запуск: python -m bench.eventlog [шагов сценария, 3000] [секунд нагрузки, 5]
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import db
+from bench.common import percentile
+
+USERS = 50_000
+WORKERS = 50
+CRASH_WRITES = 2000
+
+
+async def reopen_after_seed():
+    # Заполнение базы мимо db.py: при STORAGE_BACKEND=eventlog память берётся из базы заново
+    pool = db._db()
+    if pool.state:
+        await pool.writer.execute("DELETE FROM meta WHERE key = 'eventlog_seq'")
+        await pool.writer.commit()
+        await db.close_db()
+        await db.init_db()
+
+
+async def _scenario(steps: int) -> list:
+    rnd = random.Random(7)
+    answers = []
+    bets: list[int] = []
+    for step in range(steps):
+        uid, other = rnd.randint(1, 60), rnd.randint(1, 60)
+        amount = rnd.randint(-20, 30)
+        kind = rnd.random()
+        if kind < 0.3:
+            answers.append(await db.change_balance(uid, amount, "сценарий", 0))
+        elif kind < 0.4:
+            answers.append(await db.debit_if_sufficient(uid, abs(amount), "списание"))
+        elif kind < 0.55:
+            answers.append(await db.transfer(uid, other, abs(amount)))
+        elif kind < 0.6:
+            answers.append(await db.bulk_change_balance([rnd.randint(1, 70) for _ in range(8)], amount, "массово"))
+        elif kind < 0.62:
+            answers.append(await db.reset_user_balance(uid))
+        elif kind < 0.63:
+            answers.append(await db.reset_all_balances())
+        elif kind < 0.68:
+            answers.append(await db.set_role(uid, rnd.choice(["Бармен", "Гость", None]), f"роль {step}"))
+        elif kind < 0.7:
+            answers.append(await db.set_role_image(uid, f"file{step}"))
+        elif kind < 0.74:
+            answers.append(await (db.grant_key if rnd.random() < 0.6 else db.revoke_key)(uid))
+        elif kind < 0.8:
+            ok, balance, bet_id = await db.place_bet(uid, rnd.randint(1, 5), -100, step, f"user{uid}")
+            answers.append((ok, balance, bet_id))
+            if ok:
+                bets.append(bet_id)
+                await db.set_bet_roll(bet_id, rnd.randint(1, 6), 0.0)
+        elif kind < 0.88 and bets:
+            answers.append(await db.settle_bet(bets.pop(rnd.randrange(len(bets))), 6, 5))
+        elif kind < 0.9 and bets:
+            answers.append(await db.cancel_bet(bets.pop()))
+        elif 0.9 <= kind < 0.901:
+            answers.append(await db.reset_club())
+        answers.append((await db.get_balance(uid), await db.has_key(uid), await db.get_role_with_image(uid)))
+    answers.append(await db.get_pending_bets())
+    answers.append(await db.get_top_users(20))
+    answers.append(sorted(await db.get_all_roles()))
+    answers.append(await db.get_key_holders())
+    return [tuple(a) if isinstance(a, list) else a for a in answers]
+
+
+async def _tables() -> dict:
+    tables = {}
+    async with db._db().read() as conn:
+        for name, sql in (("users", "SELECT user_id, balance, key FROM users ORDER BY user_id"),
+                          ("roles", "SELECT * FROM roles ORDER BY user_id"),
+                          ("bets", "SELECT * FROM pending_bets ORDER BY id"),
+                          # порядок строк «обнулить балансы» между участниками не важен
+                          ("history", "SELECT user_id, action, amount, reason FROM history ORDER BY user_id, id"),
+                          ("snapshots", "SELECT COUNT(*) FROM balance_snapshots")):
+            async with conn.execute(sql) as cur:
+                tables[name] = [tuple(row) for row in await cur.fetchall()]
+    return tables
+
+
+def _state() -> tuple:
+    state = db._db().state
+    return dict(state.users), dict(state.roles), dict(state.bets), state.next_bet
+
+
+async def _conformance(tmp: str, steps: int, failures: list[str]):
+    results = {}
+    for backend in ("sqlite", "eventlog"):
+        db.STORAGE_BACKEND = backend
+        db.DB_PATH = os.path.join(tmp, f"same-{backend}.sqlite")
+        await db.init_db()
+        try:
+            if db._db().state:
+                db._db().state.compact_bytes = 64 * 1024  # сжатие несколько раз за сценарий
+            start = time.perf_counter()
+            answers = await _scenario(steps)
+            elapsed = time.perf_counter() - start
+            results[backend] = (answers, await _tables())
+            compactions = ""
+            if db._db().state:
+                before = _state()
+                compactions = f", сжатий журнала {db._db().state.compactions}"
+        finally:
+            await db.close_db()
+        print(f"сценарий на {backend}: {steps} шагов за {elapsed:.2f} с{compactions}")
+
+    answers, tables = results["sqlite"]
+    answers_log, tables_log = results["eventlog"]
+    wrong = next((i for i, (a, b) in enumerate(zip(answers, answers_log)) if a != b), None)
+    if wrong is not None or len(answers) != len(answers_log):
+        failures.append(f"ответы хранилищ разошлись на шаге {wrong}: {answers[wrong]} против {answers_log[wrong]}")
+    for name in tables:
+        if tables[name] != tables_log[name]:
+            failures.append(f"таблица {name} после сценария разная")
+    print(f"ответов {len(answers)}, записей истории {len(tables['history'])}, "
+          f"участников {len(tables['users'])}: {'совпадают' if not failures else 'РАЗНЫЕ'}")
+
+    # перезапуск: снимок + журнал дают то же состояние
+    await db.init_db()
+    try:
+        if _state() != before:
+            failures.append("после перезапуска состояние в памяти другое")
+        if await _tables() != tables_log:
+            failures.append("после перезапуска база другая")
+    finally:
+        await db.close_db()
+
+
+async def _crash_child(path: str):
+    # пишем под нагрузкой, отчитываемся о подтверждённом и падаем, не закрывая базу
+    db.STORAGE_BACKEND = "eventlog"
+    db.DB_PATH = path
+    await db.init_db()
+    rnd = random.Random(3)
+    await asyncio.gather(*(db.change_balance(rnd.randint(1, 300), rnd.randint(1, 9), "до сбоя", 0)
+                           for _ in range(CRASH_WRITES)))
+    state = db._db().state
+    balances = {uid: state.balance(uid) for uid in range(1, 301)}  # все записи уже подтверждены
+    print(json.dumps({"balances": balances, "projected": state.projected, "seq": state.seq}), flush=True)
+    with open(state.path, "ab") as f:
+        f.write(b'{"seq": 999999, "ts": "2025-')  # запись, оборванная посреди строки
+    os._exit(0)
+
+
+async def _crash(tmp: str, failures: list[str]):
+    path = os.path.join(tmp, "crash.sqlite")
+    out = subprocess.run([sys.executable, "-m", "bench.eventlog", "--crash", path],
+                         capture_output=True, text=True, check=True)
+    child = json.loads(out.stdout.strip().splitlines()[-1])
+    db.STORAGE_BACKEND = "eventlog"
+    db.DB_PATH = path
+    start = time.perf_counter()
+    await db.init_db()
+    open_ms = (time.perf_counter() - start) * 1e3
+    try:
+        wrong = 0
+        for uid, balance in child["balances"].items():
+            wrong += await db.get_balance(int(uid)) != balance
+        async with db._db().read() as conn:
+            async with conn.execute("SELECT COUNT(*) FROM users u WHERE balance != "
+                                    "(SELECT COALESCE(SUM(amount), 0) FROM history h WHERE h.user_id = u.user_id)") as cur:
+                drift = (await cur.fetchone())[0]
+    finally:
+        await db.close_db()
+    print(f"сбой: подтверждено {child['seq']} записей, в базе к моменту сбоя {child['projected']}; "
+          f"старт с доносом в базу {open_ms:.0f} мс, неверных балансов {wrong}, расхождений с историей {drift}")
+    if wrong or drift:
+        failures.append("после сбоя потеряны подтверждённые изменения или история не сходится")
+
+
+async def _throughput(tmp: str, backend: str, seconds: float) -> dict:
+    db.STORAGE_BACKEND = backend
+    db.DB_PATH = os.path.join(tmp, f"load-{backend}.sqlite")
+    await db.init_db()
+    try:
+        conn = db._db().writer
+        await conn.executemany("INSERT INTO users (user_id, balance, key) VALUES (?, 100, ?)",
+                               ((uid, uid % 7 == 0) for uid in range(1, USERS + 1)))
+        await conn.executemany("INSERT INTO roles (user_id, role_name, role_desc) VALUES (?, 'Гость', '')",
+                               ((uid,) for uid in range(1, USERS + 1, 10)))
+        await conn.commit()
+        await reopen_after_seed()
+        reads: list[float] = []
+        writes: list[float] = []
+        stop = time.perf_counter() + seconds
+
+        async def worker(seed: int):
+            rnd = random.Random(seed)
+            while time.perf_counter() < stop:
+                uid = rnd.randint(1, USERS)
+                kind = rnd.random()
+                t0 = time.perf_counter()
+                if kind < 0.8:
+                    await db.has_key(uid)
+                    await db.get_balance(uid)
+                    await db.get_role_with_image(uid)
+                    reads.append(time.perf_counter() - t0)
+                else:
+                    if kind < 0.9:
+                        await db.change_balance(uid, 1, "нагрузка", 0)
+                    else:
+                        await db.transfer(uid, rnd.randint(1, USERS), 1)
+                    writes.append(time.perf_counter() - t0)
+
+        await asyncio.gather(*(worker(i) for i in range(WORKERS)))
+    finally:
+        await db.close_db()
+    start = time.perf_counter()
+    await db.init_db()
+    reopen_ms = (time.perf_counter() - start) * 1e3
+    await db.close_db()
+    return {"ops": (len(reads) + len(writes)) / seconds, "reads": len(reads) / seconds,
+            "writes": len(writes) / seconds, "read_p50": percentile(reads, 50), "read_p99": percentile(reads, 99),
+            "write_p50": percentile(writes, 50), "write_p99": percentile(writes, 99), "reopen_ms": reopen_ms}
+
+
+async def main(steps: int, seconds: float) -> int:
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp:
+        await _conformance(tmp, steps, failures)
+        await _crash(tmp, failures)
+        results = {backend: await _throughput(tmp, backend, seconds) for backend in ("sqlite", "eventlog")}
+    print(f"нагрузка {seconds:.0f} с, {WORKERS} обработчиков, {USERS} участников (80% чтений):")
+    for backend, r in results.items():
+        print(f"  {backend:<8} {r['ops']:>8,.0f} операций/с (чтений {r['reads']:,.0f}, записей {r['writes']:,.0f}); "
+              f"чтение p50 {r['read_p50']:.3f} p99 {r['read_p99']:.3f} мс; "
+              f"запись p50 {r['write_p50']:.2f} p99 {r['write_p99']:.2f} мс; повторный старт {r['reopen_ms']:.0f} мс")
+    print(f"журнал / SQLite: x{results['eventlog']['ops'] / results['sqlite']['ops']:.1f} операций/с")
+
+    for failure in failures:
+        print("ОШИБКА:", failure)
+    if not failures:
+        print("журнал событий отвечает так же, как SQLite, и переживает сбой")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--crash"]:
+        asyncio.run(_crash_child(sys.argv[2]))
+    else:
+        args = sys.argv[1:]
+        sys.exit(asyncio.run(main(int(args[0]) if args else 3000, float(args[1]) if len(args) > 1 else 5)))
@@ -0,0 +1,119 @@
+# Выгрузка истории в постоянной памяти: заполняет временную базу N записями
+# истории, выгружает их через export.write_history и следит за RSS процесса.
+# Отдельно: история, часть которой retention перенёс в архив, выгружается
+# целиком и по порядку и после перезапуска бота (архив подключается заново).
+# Падает (код 1), если выгружено не N строк, RSS за время выгрузки вырос
+# больше чем на RSS_LIMIT_MB (считается анонимная память, без mmap файла базы)
+# или из выгрузки пропали архивные записи.
+#
+# Запуск: python -m bench.export [число записей, по умолчанию 1 000 000] [csv|jsonl]
+import asyncio
+import gzip
+import os
+import sys
+import tempfile
+import time
+
+import db
+import export
+import retention
+from bench.common import temp_db
+
+RSS_LIMIT_MB = 64
+SEED_BATCH = 100_000
+
+
+def _rss_mb() -> float:
+    # resident - shared: без страниц файла базы, отображённых через mmap_size
+    with open("/proc/self/statm") as f:
+        _, resident, shared, *_ = map(int, f.read().split())
+    return (resident - shared) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+async def _seed(rows: int):
+    conn = db._db().writer
+    for start in range(0, rows, SEED_BATCH):
+        await conn.executemany(
+            "INSERT INTO history (user_id, action, amount, reason) VALUES (?, 'change_balance', ?, 'сид')",
+            ((i % 5000, i % 50 - 25) for i in range(start, min(start + SEED_BATCH, rows))))
+        await conn.commit()
+
+
+def _count_lines(path: str) -> int:
+    with gzip.open(path, "rb") as f:
+        return sum(1 for _ in f)
+
+
+async def _archived(tmp: str, failures: list[str]):
+    # 100 старых записей уходят в архив, 10 свежих остаются в основной базе
+    db.DB_PATH = os.path.join(tmp, "archived.sqlite")
+    retention.ARCHIVE_PATH = os.path.join(tmp, "archived_archive.sqlite")
+    out = os.path.join(tmp, "archived.csv.gz")
+    await db.init_db()
+    try:
+        await db._db().writer.executemany(
+            "INSERT INTO history (user_id, action, amount, reason, date) VALUES (?, 'change_balance', 1, 'сид', ?)",
+            [(i, "2020-01-01 00:00:00" if i < 100 else time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()))
+             for i in range(110)])
+        await db._db().writer.commit()
+        moved = await retention.run_once(retention.ARCHIVE_PATH, days=30)
+        await db.close_db()
+        await db.init_db()  # после перезапуска архив ещё не подключён
+        await retention.attach_club_archive(None)
+        written = await export.write_history(out)
+    finally:
+        await db.close_db()
+    with gzip.open(out, "rt") as f:
+        ids = [int(line.split(",")[0]) for line in f.read().splitlines()[1:]]
+    print(f"в архиве {moved} из 110 записей: выгружено {written}")
+    if ids != list(range(1, 111)):
+        failures.append(f"с архивом выгружено {len(ids)} записей из 110 (или не по порядку)")
+
+
+async def main(rows: int, fmt: str) -> int:
+    with tempfile.TemporaryDirectory() as tmp:
+        out = os.path.join(tmp, f"history.{fmt}.gz")
+        async with temp_db("export.sqlite"):
+            start = time.perf_counter()
+            await _seed(rows)
+            print(f"заполнено {rows} записей за {time.perf_counter() - start:.1f} с")
+
+            base = peak = _rss_mb()
+            done = asyncio.Event()
+
+            async def sample():
+                nonlocal peak
+                while not done.is_set():
+                    peak = max(peak, _rss_mb())
+                    await asyncio.sleep(0.05)
+
+            sampler = asyncio.create_task(sample())
+            start = time.perf_counter()
+            written = await export.write_history(out, fmt)
+            elapsed = time.perf_counter() - start
+            done.set()
+            await sampler
+
+        size = os.path.getsize(out) / 2**20
+        lines = await asyncio.to_thread(_count_lines, out)
+        failures = []
+        await _archived(tmp, failures)
+
+    header = 1 if fmt == "csv" else 0
+    growth = peak - base
+    print(f"{fmt}: {written} строк за {elapsed:.1f} с ({written / elapsed:,.0f} строк/с), "
+          f"файл {size:.1f} МБ")
+    print(f"RSS: до выгрузки {base:.0f} МБ, пик {peak:.0f} МБ (+{growth:.1f} МБ)")
+
+    if written != rows or lines != rows + header:
+        failures.append(f"выгружено {written} строк, в файле {lines}, ожидалось {rows}")
+    if growth > RSS_LIMIT_MB:
+        failures.append(f"RSS вырос на {growth:.0f} МБ (предел {RSS_LIMIT_MB} МБ)")
+    for failure in failures:
+        print("ОШИБКА:", failure)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    sys.exit(asyncio.run(main(int(args[0]) if args else 1_000_000, args[1] if len(args) > 1 else "csv")))
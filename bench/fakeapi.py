@@ -0,0 +1,230 @@
+# Локальная подмена api.telegram.org для нагрузочных прогонов настоящего бота
+# (bot.py с TELEGRAM_API_URL=http://127.0.0.1:<порт>). Отвечает на getMe,
+# deleteWebhook, getUpdates (long polling из очереди сгенерированных
+# обновлений), sendMessage, sendPhoto, sendDocument, sendDice и getChatMember;
+# остальные методы получают true. Каждый ответ задерживается на LATENCY мс
+# (+ случайно до JITTER мс), а доля отправок RATE_429 получает 429 с
+# retry_after — как при превышении лимитов Telegram.
+#
+# Обновления пишет сценарий: USERS участников в CHATS группах, тексты команд
+# по весам SCRIPT, ответы на сообщения других участников, куратор раздаёт
+# нуары. Время каждого обновления отмечается в момент, когда оно появилось в
+# очереди, а первый ответ бота на него (reply на это сообщение; для кубика —
+# sendDice в этот чат) закрывает замер «обновление -> ответ».
+#
+# Отдельно (для ручного запуска бота): python -m bench.fakeapi [порт, 8081] [обновлений/с, 50]
+import asyncio
+import collections
+import itertools
+import json
+import random
+import sys
+import time
+
+from aiohttp import web
+
+from commands import KURATOR_ID
+from bench.common import percentile
+
+# (текст, вес, в ответ на сообщение другого участника); {n} — случайная сумма
+SCRIPT = (
+    ("мой карман", 30, False),
+    ("моя роль", 8, False),
+    ("рейтинг клуба", 4, False),
+    ("хранители ключа", 2, False),
+    ("список команд", 1, False),
+    ("передать {n}", 20, True),
+    ("вручить {n}", 15, True),   # от куратора
+    ("ставлю 1 на 🎲", 5, False),
+    ("всем привет", 15, False),  # болтовня: бот молчит
+)
+SILENT = {"всем привет"}
+
+
+class FakeTelegram:
+    def __init__(self, users: int = 5000, chats: int = 200, latency_ms: float = 0, jitter_ms: float = 0,
+                 rate_429: float = 0, retry_after: int = 1, seed: int = 1):
+        self.users = users
+        self.chats = chats
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.rnd = random.Random(seed)
+        self._update_ids = itertools.count(1)
+        self._message_ids = collections.defaultdict(lambda: itertools.count(1))
+        self._updates: collections.deque = collections.deque()
+        self._arrived = asyncio.Event()
+        self._last: dict[int, dict] = {}  # чат -> последнее сообщение (на него отвечают)
+        self._dice: dict[int, collections.deque] = collections.defaultdict(collections.deque)
+        self.pending: dict[tuple[int, int], float] = {}  # (чат, сообщение) -> когда появилось
+        self.latencies: list[float] = []
+        self.answered_at: list[float] = []
+        self.calls: collections.Counter = collections.Counter()
+        self.rejected = 0  # ответов 429
+        self.silent = 0
+        self._runner: web.AppRunner | None = None
+
+    # --- Сценарий ---
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"Участник {user_id}", "username": f"user{user_id}"}
+
+    def _chat_of(self, user_id: int) -> int:
+        return -1000 - user_id % self.chats
+
+    def generate(self, count: int) -> int:
+        # -> сколько обновлений, ждущих ответа, добавлено
+        texts, weights = [s[0] for s in SCRIPT], [s[1] for s in SCRIPT]
+        replies = {s[0] for s in SCRIPT if s[2]}
+        now = time.perf_counter()
+        expected = 0
+        for text in self.rnd.choices(texts, weights, k=count):
+            user_id = 1000 + self.rnd.randrange(self.users)
+            if text.startswith("вручить"):
+                user_id = KURATOR_ID
+            chat_id = self._chat_of(user_id) if user_id != KURATOR_ID else -1000 - self.rnd.randrange(self.chats)
+            message = {"message_id": next(self._message_ids[chat_id]), "date": int(time.time()),
+                       "chat": {"id": chat_id, "type": "supergroup", "title": f"Клуб {chat_id}"},
+                       "from": self._user(user_id), "text": text.format(n=self.rnd.randint(1, 20))}
+            if text in replies:
+                target = self._last.get(chat_id)
+                if target is None or target["from"]["id"] == user_id:
+                    continue  # отвечать пока не на что
+                message["reply_to_message"] = target
+            if text in SILENT:
+                self.silent += 1
+            else:
+                self.pending[(chat_id, message["message_id"])] = now
+                expected += 1
+                if "🎲" in text:
+                    self._dice[chat_id].append(message["message_id"])
+            if "reply_to_message" not in message:
+                self._last[chat_id] = message
+            self._updates.append({"update_id": next(self._update_ids), "message": message})
+        self._arrived.set()
+        return expected
+
+    async def feed(self, rate: float, seconds: float, tick: float = 0.01):
+        # открытая нагрузка: rate обновлений в секунду, не глядя на то, успевает ли бот;
+        # -> (сколько отправлено, сколько из них ждут ответа)
+        start = time.perf_counter()
+        sent = expected = 0
+        while (elapsed := time.perf_counter() - start) < seconds:
+            due = int(rate * elapsed) - sent
+            if due > 0:
+                expected += self.generate(due)
+                sent += due
+            await asyncio.sleep(tick)
+        return sent, expected
+
+    def _answer(self, chat_id: int, message_id: int | None):
+        started = self.pending.pop((chat_id, message_id), None)
+        if started is not None:
+            now = time.perf_counter()
+            self.latencies.append(now - started)
+            self.answered_at.append(now)
+
+    # --- HTTP ---
+    async def _delay(self):
+        delay = self.latency_ms + self.rnd.random() * self.jitter_ms
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+
+    def _message(self, chat_id: int, **extra) -> dict:
+        return {"message_id": next(self._message_ids[chat_id]), "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "supergroup"}, "from": {"id": 42, "is_bot": True,
+                                                                        "first_name": "Archivist"}, **extra}
+
+    async def _get_updates(self, params: dict):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        while self._updates and self._updates[0]["update_id"] < offset:
+            self._updates.popleft()  # подтверждены сдвигом offset
+        if not self._updates:
+            self._arrived.clear()
+            try:
+                await asyncio.wait_for(self._arrived.wait(), float(params.get("timeout") or 0) or 0.01)
+            except asyncio.TimeoutError:
+                pass
+        return list(itertools.islice(self._updates, limit))
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.calls[method] += 1
+        if method == "getUpdates":
+            result = await self._get_updates(params)
+            await self._delay()
+            return web.json_response({"ok": True, "result": result})
+        await self._delay()
+        if method.startswith("send") and self.rate_429 and self.rnd.random() < self.rate_429:
+            self.rejected += 1
+            return web.json_response({"ok": False, "error_code": 429,
+                                      "description": f"Too Many Requests: retry after {self.retry_after}",
+                                      "parameters": {"retry_after": self.retry_after}}, status=429)
+        chat_id = int(params["chat_id"]) if "chat_id" in params else 0
+        reply_to = params.get("reply_to_message_id")
+        if reply_to is None and params.get("reply_parameters"):
+            reply_to = json.loads(params["reply_parameters"]).get("message_id")
+        if method in ("sendMessage", "sendPhoto", "sendDocument"):
+            self._answer(chat_id, int(reply_to) if reply_to else None)
+        if method == "getMe":
+            result = {"id": 42, "is_bot": True, "first_name": "Archivist", "username": "archivist_bot"}
+        elif method == "sendMessage":
+            result = self._message(chat_id, text=params.get("text", ""))
+        elif method == "sendPhoto":
+            result = self._message(chat_id, caption=params.get("caption"), photo=[
+                {"file_id": f"photo{self.calls[method]}", "file_unique_id": f"u{self.calls[method]}",
+                 "width": 640, "height": 640}])
+        elif method == "sendDocument":
+            result = self._message(chat_id, document={"file_id": f"doc{self.calls[method]}",
+                                                      "file_unique_id": f"d{self.calls[method]}"})
+        elif method == "sendDice":
+            waiting = self._dice[chat_id]
+            while waiting:  # ставки, на которые уже ответили «не хватает», пропускаем
+                message_id = waiting.popleft()
+                if (chat_id, message_id) in self.pending:
+                    self._answer(chat_id, message_id)
+                    break
+            result = self._message(chat_id, dice={"emoji": params.get("emoji", "🎲"),
+                                                  "value": self.rnd.randint(1, 6)})
+        elif method == "getChatMember":
+            result = {"status": "member", "user": self._user(int(params["user_id"]))}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8081):
+        app = web.Application(client_max_size=64 * 2**20)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+async def main(port: int, rate: float):
+    api = FakeTelegram()
+    await api.start(port=port)
+    print(f"Bot API на http://127.0.0.1:{port}; обновлений в секунду: {rate:g} (Ctrl+C — стоп)")
+    try:
+        while True:
+            before = len(api.latencies)
+            await api.feed(rate, 5)
+            done = api.latencies[before:]
+            p50 = percentile(done, 50)
+            print(f"за 5 с: ответов {len(done)}, p50 {p50:.0f} мс, ждут ответа {len(api.pending)}, 429: {api.rejected}")
+    finally:
+        await api.stop()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    try:
+        asyncio.run(main(int(args[0]) if args else 8081, float(args[1]) if len(args) > 1 else 50))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,96 @@
+# Лёгкие заменители aiogram Message/Bot для прогона commands.py без токена.
+# Покрывают то, чем пользуются обработчики: reply, reply_photo, answer,
+# reply_document, answer_dice, reply_to_message, bot.get_chat_member и bot.send_message.
+import asyncio
+import itertools
+import random
+from types import SimpleNamespace
+
+_message_ids = itertools.count(1)
+
+
+class FakeUser:
+    def __init__(self, user_id: int, full_name: str | None = None, username: str | None = None,
+                 is_bot: bool = False):
+        self.id = user_id
+        self.full_name = full_name or f"Участник {user_id}"
+        self.first_name = self.full_name
+        self.username = username
+        self.is_bot = is_bot
+
+
+class FakeChat:
+    def __init__(self, chat_id: int = -1000):
+        self.id = chat_id
+        self.type = "supergroup"
+
+
+class FakeBot:
+    # api_delay — искусственная задержка каждого вызова «Telegram», с
+    def __init__(self, api_delay: float = 0.0, users: dict[int, FakeUser] | None = None):
+        self.api_delay = api_delay
+        self.users = users if users is not None else {}
+        self.calls: dict[str, int] = {}
+        self.sent: list[str] = []
+
+    async def _call(self, name: str):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.api_delay:
+            await asyncio.sleep(self.api_delay)
+
+    async def get_chat_member(self, chat_id: int, user_id: int):
+        await self._call("getChatMember")
+        user = self.users.get(user_id) or FakeUser(user_id)
+        return SimpleNamespace(user=user, status="member")
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        await self._call("sendMessage")
+        self.sent.append(text)
+        return FakeMessage(self, FakeUser(0, "Archivist", is_bot=True), text=text, chat=FakeChat(chat_id))
+
+    async def send_document(self, chat_id: int, document, caption: str | None = None, **kwargs):
+        await self._call("sendDocument")
+        self.sent.append(caption or "")
+        return FakeMessage(self, FakeUser(0, "Archivist", is_bot=True), chat=FakeChat(chat_id))
+
+    async def send_photo(self, chat_id: int, photo, caption: str | None = None, **kwargs):
+        await self._call("sendPhoto")
+        self.sent.append(caption or "")
+        return FakeMessage(self, FakeUser(0, "Archivist", is_bot=True), chat=FakeChat(chat_id),
+                           photo=[SimpleNamespace(file_id=f"photo-{next(_message_ids)}")])
+
+
+class FakeMessage:
+    def __init__(self, bot: FakeBot, from_user: FakeUser, text: str | None = None,
+                 reply_to: "FakeMessage | None" = None, chat: FakeChat | None = None,
+                 caption: str | None = None, photo: list | None = None, dice_value: int | None = None,
+                 entities: list | None = None):
+        self.bot = bot
+        self.from_user = from_user
+        self.text = text
+        self.entities = entities
+        self.caption = caption
+        self.photo = photo
+        self.chat = chat or FakeChat()
+        self.message_id = next(_message_ids)
+        self.reply_to_message = reply_to
+        self.dice = SimpleNamespace(value=dice_value) if dice_value is not None else None
+
+    async def reply(self, text: str, **kwargs):
+        return await self.bot.send_message(self.chat.id, text, reply_to_message_id=self.message_id, **kwargs)
+
+    async def answer(self, text: str, **kwargs):
+        return await self.bot.send_message(self.chat.id, text, **kwargs)
+
+    async def reply_photo(self, photo, caption: str | None = None, **kwargs):
+        return await self.bot.send_photo(self.chat.id, photo, caption=caption,
+                                         reply_to_message_id=self.message_id, **kwargs)
+
+    async def reply_document(self, document, caption: str | None = None, **kwargs):
+        return await self.bot.send_document(self.chat.id, document, caption=caption,
+                                            reply_to_message_id=self.message_id, **kwargs)
+
+    async def answer_dice(self, emoji: str = "🎲", **kwargs):
+        await self.bot._call("sendDice")
+        return FakeMessage(self.bot, FakeUser(0, "Archivist", is_bot=True), chat=self.chat,
+                           dice_value=random.randint(1, 6))
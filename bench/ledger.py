@@ -0,0 +1,35 @@
+# Пропускная способность change_balance при разных размерах пачки групповой фиксации
+# (писатель с synchronous = FULL: каждый COMMIT пачки ждёт fsync).
+# Запуск: python -m bench.ledger [число операций] [окно, мс]
+import asyncio
+import sys
+import time
+
+import db
+from bench.common import temp_db
+
+BATCH_SIZES = (1, 10, 50, 200, 1000)
+USERS = 500
+
+
+async def _run(n: int, batch: int, flush_ms: float):
+    ledger = db._db().ledger
+    ledger.max_ops = batch
+    ledger.flush_ms = flush_ms
+    start = time.perf_counter()
+    await asyncio.gather(*(db.change_balance(i % USERS, 1, "бенч", 0) for i in range(n)))
+    elapsed = time.perf_counter() - start
+    print(f"пачка {batch:>5}: {n / elapsed:>9.0f} операций/с   {elapsed * 1e3:>8.1f} мс всего")
+
+
+async def main(n: int, flush_ms: float):
+    async with temp_db("bench.sqlite"):
+        async with db._db().writer.execute("PRAGMA synchronous") as cur:
+            print(f"synchronous писателя: {(await cur.fetchone())[0]} (2 — FULL)")
+        for batch in BATCH_SIZES:
+            await _run(n, batch, flush_ms)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    asyncio.run(main(int(args[0]) if args else 5000, float(args[1]) if len(args) > 1 else 5))
@@ -0,0 +1,75 @@
+# Цена инструментирования: сколько добавляет metrics.timed к одному вызову
+# (пустая корутина и get_balance из кэша профилей), сколько стоит прогон
+# bench.replay с метриками, и сколько занимает отдача /metrics после него.
+# Выходит с кодом 1, если обёртка дороже LIMIT_US на вызов.
+#
+# Запуск: python -m bench.metrics [число вызовов]
+import asyncio
+import sys
+import time
+
+import aiohttp
+
+import db
+import metrics
+from bench import replay
+from bench.common import temp_db
+
+LIMIT_US = 5.0
+PORT = 19091
+
+
+async def _noop():
+    return None
+
+
+async def _per_call(fn, n: int) -> float:
+    start = time.perf_counter()
+    for _ in range(n):
+        await fn()
+    return (time.perf_counter() - start) / n * 1e6
+
+
+async def _compare(label: str, plain, wrapped, n: int) -> float:
+    await _per_call(plain, n // 10)  # прогрев
+    base = min([await _per_call(plain, n) for _ in range(3)])
+    timed = min([await _per_call(wrapped, n) for _ in range(3)])
+    print(f"{label:<28} без метрик {base:7.2f} мкс   с метриками {timed:7.2f} мкс   "
+          f"+{timed - base:5.2f} мкс ({(timed / base - 1) * 100:+.0f}%)")
+    return timed - base
+
+
+async def main(n: int) -> int:
+    overheads = [await _compare("пустая корутина", _noop, metrics.timed("bench")(_noop), n)]
+
+    async with temp_db("metrics.sqlite"):
+        await db.change_balance(1, 100, "сид", 0)
+        plain = db.get_balance.__wrapped__
+        overheads.append(await _compare("get_balance (из кэша)",
+                                        lambda: plain(1), lambda: db.get_balance(1), n))
+
+    result = await replay.run(3000, 50, 0.0, replay._parse_mix(None))
+    print(f"replay: {result['throughput']:.0f} сообщений/с с метриками "
+          f"(по гистограммам: {sum(h.count for h in metrics._histograms.values())} замеров)")
+
+    runner = await metrics.start_server("127.0.0.1", PORT)
+    try:
+        async with aiohttp.ClientSession() as http:
+            start = time.perf_counter()
+            async with http.get(f"http://127.0.0.1:{PORT}/metrics") as resp:
+                body = await resp.text()
+            scrape = (time.perf_counter() - start) * 1e3
+    finally:
+        await runner.cleanup()
+    print(f"/metrics: {len(body.splitlines())} строк, {len(body) / 1024:.1f} КБ за {scrape:.1f} мс")
+
+    worst = max(overheads)
+    if worst > LIMIT_US:
+        print(f"ПРОВАЛ: накладные расходы {worst:.2f} мкс на вызов (предел {LIMIT_US} мкс)")
+        return 1
+    print(f"OK: накладные расходы не больше {worst:.2f} мкс на вызов")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)))
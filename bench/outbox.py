@@ -0,0 +1,198 @@
+# Очередь исходящих сообщений против локального «Telegram»: aiohttp-сервер
+# с методом sendMessage, который, как настоящий, отвечает 429 с retry_after,
+# если бот превысил общий лимит или лимит чата (скользящее окно 1 с), и ещё
+# случайно отвечает 429 на долю запросов. Настоящий aiogram Bot ходит в него
+# по HTTP.
+#
+# Всплеск: сначала в очередь ставится длинный вывод (BULK) в несколько чатов,
+# следом — ответы на команды (REPLY) в другие чаты. Без очереди часть отправок
+# падает с 429; с очередью доставлено всё, лимиты сервера не превышены,
+# ответы обгоняют длинный вывод.
+#
+# Обработчики: кубик, портрет Куратора и выгрузка истории против «Telegram»,
+# который отвечает HANDLER_API_S секунд, должны вернуться сразу (воркер шарда
+# свободен), а отправки — дойти после: бросок записан в ставку, временный файл
+# выгрузки удалён. Падает (код 1), если что-то из этого не так.
+#
+# Запуск: python -m bench.outbox [ответов, 60] [длинного вывода, 200] [доля случайных 429, 0.05]
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict, deque
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramRetryAfter
+from aiohttp import web
+
+import commands
+import db
+import outbox
+import scheduler
+from bench.common import quantiles, temp_db
+from bench.fakes import FakeBot, FakeMessage, FakeUser
+
+TOKEN = "42:bench"
+PORT = 18081
+GLOBAL_RATE = 30     # сообщений в секунду на бота
+CHAT_RATE = 5        # в секунду в чат (в бенче выше, чем у Telegram, чтобы прогон был коротким)
+BURST = 3
+BULK_CHATS = 10
+HANDLER_API_S = 1.0
+
+
+class FakeTelegram:
+    # Скользящее окно 1 с: сколько сообщений сервер примет от бота и в один чат
+    def __init__(self, inject: float):
+        self.inject = inject
+        self.rnd = random.Random(1)
+        self.sent: deque = deque()
+        self.per_chat: dict[int, deque] = defaultdict(deque)
+        self.limited = 0
+        self.injected = 0
+        self.delivered = 0
+
+    @staticmethod
+    def _over(window: deque, now: float, limit: float) -> bool:
+        while window and now - window[0] > 1.0:
+            window.popleft()
+        return len(window) >= limit
+
+    def _429(self):
+        return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                  "parameters": {"retry_after": 1}})
+
+    async def send_message(self, request: web.Request):
+        form = await request.post()
+        chat_id = int(form["chat_id"])
+        now = time.monotonic()
+        if self.rnd.random() < self.inject:
+            self.injected += 1
+            return self._429()
+        if self._over(self.sent, now, GLOBAL_RATE + 1) or self._over(self.per_chat[chat_id], now, CHAT_RATE + BURST):
+            self.limited += 1
+            return self._429()
+        self.sent.append(now)
+        self.per_chat[chat_id].append(now)
+        self.delivered += 1
+        return web.json_response({"ok": True, "result": {
+            "message_id": self.delivered, "date": int(time.time()), "text": form["text"],
+            "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"}}})
+
+
+async def _burst(bot: Bot, replies: int, bulk: int, queued: bool) -> dict:
+    latencies: dict[int, list[float]] = {outbox.REPLY: [], outbox.BULK: []}
+    failed = 0
+
+    async def send(chat_id: int, level: int):
+        nonlocal failed
+        start = time.perf_counter()
+        try:
+            await bot.send_message(chat_id, "текст")
+        except TelegramRetryAfter:
+            failed += 1
+            return
+        latencies[level].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    jobs = [(1000 + i % BULK_CHATS, outbox.BULK) for i in range(bulk)] + \
+           [(2000 + i, outbox.REPLY) for i in range(replies)]
+    for chat_id, level in jobs:
+        with outbox.priority(level):
+            outbox.post(send(chat_id, level))
+    enqueue_ms = (time.perf_counter() - start) * 1e3
+    await outbox.drain()
+    return {"latencies": latencies, "failed": failed, "enqueue_ms": enqueue_ms,
+            "elapsed": time.perf_counter() - start}
+
+
+async def _handlers(failures: list[str]):
+    async with temp_db("handlers.sqlite") as tmp:
+        tempfile.tempdir = os.path.join(tmp, "exports")  # сюда выгрузка кладёт временный файл
+        os.mkdir(tempfile.tempdir)
+        try:
+            bot = FakeBot(api_delay=HANDLER_API_S)
+            kurator = FakeUser(commands.KURATOR_ID, "Куратор")
+            gambler = FakeUser(7, "Игрок")
+            await db.change_balance(gambler.id, 100, "сид", 0)
+            await db.set_role(kurator.id, "Куратор", "хозяин клуба")
+            took = {}
+            for label, user, text in (("кубик", gambler, "ставлю 5 на 🎲"), ("портрет Куратора", kurator, "моя роль"),
+                                      ("выгрузка", kurator, "выгрузить историю")):
+                start = time.perf_counter()
+                await commands.handle_message(FakeMessage(bot, user, text=text))
+                took[label] = (time.perf_counter() - start) * 1e3
+            await outbox.drain()
+            bets = await db.get_pending_bets()
+            left = os.listdir(tempfile.tempdir)
+        finally:
+            await scheduler.shutdown()
+            tempfile.tempdir = None
+    print("обработчики при ответе API за {:.0f} с: {}; вызовы API {}".format(
+        HANDLER_API_S, ", ".join(f"{label} {ms:.0f} мс" for label, ms in took.items()), bot.calls))
+    slow = [label for label, ms in took.items() if ms >= HANDLER_API_S * 1e3 / 2]
+    if slow:
+        failures.append(f"обработчики ждали отправки: {', '.join(slow)}")
+    if len(bets) != 1 or bets[0][1] is None:
+        failures.append(f"бросок кубика не записан в ставку: {bets}")
+    if not bot.calls.get("sendDocument") or left:
+        failures.append(f"выгрузка не отправлена или временный файл не удалён: {left}")
+
+
+async def main(replies: int, bulk: int, inject: float) -> int:
+    failures = []
+    await _handlers(failures)
+    for queued in (False, True):
+        fake = FakeTelegram(inject if queued else 0.0)
+        app = web.Application()
+        app.router.add_post(f"/bot{TOKEN}/sendMessage", fake.send_message)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", PORT).start()
+        bot = Bot(TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(f"http://127.0.0.1:{PORT}")))
+        sender = outbox.Outbox(GLOBAL_RATE, CHAT_RATE, CHAT_RATE * 60, BURST, retries=5)
+        if queued:
+            bot.session.middleware(sender)
+        try:
+            result = await _burst(bot, replies, bulk, queued)
+        finally:
+            await bot.session.close()
+            await runner.cleanup()
+
+        label = "с очередью" if queued else "без очереди"
+        print(f"{label}: доставлено {fake.delivered} из {replies + bulk}, не отправлено {result['failed']}, "
+              f"429 за превышение лимита {fake.limited}, случайных 429 {fake.injected}, "
+              f"всё за {result['elapsed']:.1f} с, постановка в очередь {result['enqueue_ms']:.1f} мс")
+        if not queued:
+            continue
+        for level, name in ((outbox.REPLY, "ответы"), (outbox.BULK, "длинный вывод")):
+            lat = result["latencies"][level]
+            q = quantiles(lat)
+            print(f"  {name}: p50 {q[49] * 1e3:.0f} мс, p99 {q[98] * 1e3:.0f} мс, max {max(lat) * 1e3:.0f} мс")
+        print("  " + json.dumps(sender.stats(), ensure_ascii=False))
+        if result["failed"] or fake.delivered != replies + bulk:
+            failures.append("с очередью доставлено не всё")
+        if fake.limited:
+            failures.append(f"очередь превысила лимиты сервера {fake.limited} раз")
+        if statistics.median(result["latencies"][outbox.REPLY]) >= statistics.median(result["latencies"][outbox.BULK]):
+            failures.append("ответы не обогнали длинный вывод")
+        if result["enqueue_ms"] > 50:
+            failures.append("постановка в очередь ждала отправки")
+
+    for failure in failures:
+        print("ОШИБКА:", failure)
+    if not failures:
+        print("всё доставлено в пределах лимитов, ответы идут первыми")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    sys.exit(asyncio.run(main(int(args[0]) if args else 60, int(args[1]) if len(args) > 1 else 200,
+                              float(args[2]) if len(args) > 2 else 0.05)))
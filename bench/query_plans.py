@@ -0,0 +1,167 @@
+# Проверка планов запросов: на большом синтетическом наборе данных вызывает
+# каждую публичную функцию db.py, перехватывает выполненные ею SQL-запросы
+# и прогоняет их через EXPLAIN QUERY PLAN. Падает (код 1), если какой-то запрос
+# читает таблицу целиком (кроме обхода по rowid с LIMIT) или сортирует её
+# во временном B-дереве, а также если для новой функции db.py нет вызова в CALLS.
+# Запуск: python -m bench.query_plans [число участников]
+import asyncio
+import inspect
+import os
+import re
+import sys
+
+import db
+from bench.common import temp_db
+
+HISTORY_PER_USER = 5
+
+# Как вызвать каждую функцию db.py (uid — существующий участник)
+CALLS = {
+    "get_balance": lambda uid: db.get_balance(uid),
+    "change_balance": lambda uid: db.change_balance(uid, 5, "план", 0),
+    "debit_if_sufficient": lambda uid: db.debit_if_sufficient(uid, 1),
+    "transfer": lambda uid: db.transfer(uid, uid + 1, 1),
+    "bulk_change_balance": lambda uid: db.bulk_change_balance([uid, uid + 1, uid + 2], -1, "план"),
+    "take_snapshot": lambda uid: db.take_snapshot(3600),
+    "get_balance_at": lambda uid: db.get_balance_at(uid, "2999-01-01 00:00:00"),
+    "get_balance_changes": lambda uid: db.get_balance_changes("2020-02-01 00:00:00", "2999-01-01 00:00:00"),
+    "prune_snapshots": lambda uid: db.prune_snapshots(30),
+    "audit_history": lambda uid: db.audit_history(100),
+    "audit_balances": lambda uid: db.audit_balances(uid, 100),
+    "audit_users": lambda uid: db.audit_users(uid, 100),
+    "repair_balance_drift": lambda uid: db.repair_balance_drift([uid, uid + 1]),
+    "reset_user_balance": lambda uid: db.reset_user_balance(uid),
+    "reset_all_balances": lambda uid: db.reset_all_balances(),
+    "reset_club": lambda uid: db.reset_club(),
+    "purge_history": lambda uid: db.purge_history(100),
+    "set_role": lambda uid: db.set_role(uid, "роль", "описание"),
+    "get_role": lambda uid: db.get_role(uid + 2),
+    "set_role_image": lambda uid: db.set_role_image(uid, "file-id"),
+    "get_role_with_image": lambda uid: db.get_role_with_image(uid + 3),
+    "grant_key": lambda uid: db.grant_key(uid),
+    "revoke_key": lambda uid: db.revoke_key(uid),
+    "has_key": lambda uid: db.has_key(uid + 4),
+    "get_last_history": lambda uid: db.get_last_history(5),
+    "get_history": lambda uid: db.get_history(uid, before_id=uid * HISTORY_PER_USER, limit=10),
+    "iter_history": lambda uid: _first(db.iter_history(after_id=uid, batch=100)),
+    "archive_history": lambda uid: db.archive_history("9999-12-31", 100),
+    "get_history_total": lambda uid: db.get_history_total(uid),
+    "get_top_users": lambda uid: db.get_top_users(10),
+    "get_all_roles": lambda uid: db.get_all_roles(),
+    "get_key_holders": lambda uid: db.get_key_holders(),
+    "save_names": lambda uid: db.save_names([(uid, "Имя", None)]),
+    "get_names": lambda uid: db.get_names([uid, uid + 1]),
+    "get_user_ids_by_usernames": lambda uid: db.get_user_ids_by_usernames(["user1", "User2"]),
+    "save_asset_file_id": lambda uid: db.save_asset_file_id("ab" * 32, "images/x.jpg", "file-id"),
+    "get_asset_file_id": lambda uid: db.get_asset_file_id("ab" * 32),
+    "forget_asset": lambda uid: db.forget_asset("ab" * 32),
+    "place_bet": lambda uid: db.place_bet(uid + 5, 1, -100),
+    "set_bet_roll": lambda uid: db.set_bet_roll(1, 6, 0.0),
+    "settle_bet": lambda uid: db.settle_bet(1, 6, 4),
+    "cancel_bet": lambda uid: db.cancel_bet(1),
+    "get_pending_bets": lambda uid: db.get_pending_bets(),
+}
+
+# Функции жизненного цикла и список файлов клубов, а не запросы
+SKIP = {"init_db", "close_db", "attach_archive", "club_chat_ids", "dirty_clubs"}
+# Служебная таблица SQLite: по строке на таблицу с AUTOINCREMENT
+SCAN_OK_TABLES = {"sqlite_sequence"}
+# Запросы, которые читают таблицу целиком по замыслу
+FULL_READ_OK = (
+    # таймеры ставок поднимаются при старте; в таблице только несыгранные ставки
+    re.compile(r"^SELECT id, roll, settle_at FROM pending_bets ORDER BY id$"),
+    # сверка с нуля начинается с итогов по дням целиком
+    re.compile(r"^INSERT INTO audit_ledger \(user_id, amount, last_id\) SELECT user_id, SUM\(amount\), \d+ "
+               r"FROM history_daily GROUP BY user_id$"),
+)
+# Группировка не больше одного шага переноса или сверки (диапазон id), а не всей таблицы
+BOUNDED_GROUP = re.compile(r"WHERE id > \d+ AND id <= \d+ GROUP BY")
+
+BAD_PLAN = re.compile(r"^SCAN ([\w.]+)(?: USING (?:COVERING )?INDEX \w+)?$|USE TEMP B-TREE")
+# Обход по rowid с LIMIT читает только последние строки — это не полный скан
+ROWID_LIMIT = re.compile(r"ORDER BY (?:id|user_id)(?: DESC| ASC)?\s+LIMIT", re.IGNORECASE)
+EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+
+async def _first(gen):
+    async for row in gen:
+        return row
+
+
+async def _seed(users: int):
+    conn = db._db().writer
+    await conn.executemany(
+        "INSERT INTO users (user_id, username, balance, key) VALUES (?, NULL, ?, ?)",
+        ((uid, uid % 1000, int(uid % 97 == 0)) for uid in range(1, users + 1)))
+    await conn.executemany(
+        "INSERT INTO roles (user_id, role_name, role_desc, role_image) VALUES (?, ?, ?, NULL)",
+        ((uid, f"роль {uid}" if uid % 3 else "", "описание") for uid in range(1, users + 1, 10)))
+    await conn.executemany(
+        "INSERT INTO history (user_id, action, amount, reason) VALUES (?, 'change_balance', 1, 'сид')",
+        ((uid,) for uid in range(1, users + 1) for _ in range(HISTORY_PER_USER)))
+    await conn.executemany(
+        "INSERT INTO names (user_id, full_name, username) VALUES (?, ?, NULL)",
+        ((uid, f"Участник {uid}") for uid in range(1, users + 1, 2)))
+    # снимки за два месяца раз в час (балансы в них не важны для планов)
+    await conn.executemany(
+        "INSERT INTO snapshots (history_id, taken_at) VALUES (0, datetime('2020-01-01', ?))",
+        ((f"+{hour} hours",) for hour in range(1500)))
+    await conn.execute("ANALYZE")
+    await conn.commit()
+
+
+async def _explain(sql: str) -> list[str]:
+    if "archive." in sql:
+        # архив подключён только к пишущему соединению
+        async with db._db().writer.execute("EXPLAIN QUERY PLAN " + sql) as cur:
+            return [row[3] for row in await cur.fetchall()]
+    async with db._db().read() as conn:
+        async with conn.execute("EXPLAIN QUERY PLAN " + sql) as cur:
+            return [row[3] for row in await cur.fetchall()]
+
+
+async def main(users: int) -> int:
+    functions = {name for name, fn in inspect.getmembers(db)
+                 if (inspect.iscoroutinefunction(fn) or inspect.isasyncgenfunction(fn))
+                 and not name.startswith("_") and fn.__module__ == db.__name__} - SKIP
+    failures = [f"нет вызова в CALLS: {name}" for name in sorted(functions - CALLS.keys())]
+
+    async with temp_db("plans.sqlite") as tmp:
+        await _seed(users)
+        await db.attach_archive(os.path.join(tmp, "plans_archive.sqlite"))
+        await db.take_snapshot()  # без снимка запросы на момент времени упрутся в archive_history
+        seen: dict[str, str] = {}
+        pool = db._db()
+        for name, call in sorted(CALLS.items()):
+            statements: list[str] = []
+            for conn in pool._all:
+                await conn.set_trace_callback(statements.append)
+            await call(users // 2)
+            for conn in pool._all:
+                await conn.set_trace_callback(None)
+            for sql in statements:
+                if sql.lstrip().upper().startswith(EXPLAINABLE):
+                    seen.setdefault(sql, name)
+
+        for sql, name in seen.items():
+            plan = await _explain(sql)
+            flat = " ".join(sql.split())
+            bad = [line for line in plan if (match := BAD_PLAN.search(line))
+                   and not (line.startswith("SCAN") and (ROWID_LIMIT.search(flat)
+                                                         or match[1] in SCAN_OK_TABLES
+                                                         or any(ok.search(flat) for ok in FULL_READ_OK)))
+                   and not (line == "USE TEMP B-TREE FOR GROUP BY" and BOUNDED_GROUP.search(flat))]
+            status = "ПЛОХО" if bad else "ok"
+            print(f"[{status}] {name}: {flat[:100]}")
+            for line in plan:
+                print(f"         {line}")
+            if bad:
+                failures.append(f"{name}: {'; '.join(bad)}")
+
+    for failure in failures:
+        print("ОШИБКА:", failure)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)))
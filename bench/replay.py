@@ -0,0 +1,178 @@
+# Офлайн-прогон нагрузки через handle_message/handle_photo_command на временной
+# SQLite-базе с поддельными Message/Bot (bench/fakes.py). Печатает пропускную
+# способность и p50/p95/p99 по каждой команде; результаты можно сохранить как
+# базовые (--save) и сравнивать с ними последующие прогоны.
+#
+# Запуск: python -m bench.replay [-n 5000] [-c 50] [--api-ms 0]
+#                                [--mix "мой карман=20,передать=10"] [--save]
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from types import SimpleNamespace
+
+import db
+import scheduler
+import commands
+from bench.common import quantiles, temp_db
+from bench.fakes import FakeBot, FakeMessage, FakeUser
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+USERS = 300
+KEY_HOLDERS = 10
+
+# Команда -> (вес, кто пишет, текст, в ответ ли на чужое сообщение)
+# кто пишет: "user" — любой участник, "key" — держатель ключа, "kurator" — Куратор.
+# «Обнулить клуб» и «обнулить балансы» не входят: они сбрасывают базу посреди прогона.
+WORKLOAD = {
+    "болтовня":        (55, "user", None, False),
+    "мой карман":      (8, "user", "мой карман", False),
+    "моя роль":        (4, "user", "моя роль", False),
+    "роль":            (2, "user", "роль", True),
+    "рейтинг клуба":   (3, "user", "рейтинг клуба", False),
+    "члены клуба":     (2, "user", "члены клуба", False),
+    "хранители ключа": (1, "user", "хранители ключа", False),
+    "список команд":   (1, "user", "список команд", False),
+    "клуб":            (1, "user", "клуб", False),
+    "передать":        (7, "user", "передать 1", True),
+    "ставлю":          (3, "user", "ставлю 1 на 🎲", False),
+    "вручить":         (5, "key", "вручить 3", True),
+    "отнять":          (2, "key", "отнять 1", True),
+    "карман":          (2, "key", "карман", True),
+    "назначить":       (1, "kurator", 'назначить "Граф" Хранитель тайн', True),
+    "фото роли":       (1, "kurator", None, True),
+}
+
+CHATTER = (
+    "привет всем", "доброе утро, клуб", "кто сегодня вечером?", "ахаха", "👍",
+    "а где куратор?", "ну и погода", "Мне кажется, это был лучший вечер в клубе за месяц.",
+)
+
+
+def _parse_mix(spec: str | None) -> dict[str, int]:
+    weights = {name: w for name, (w, *_) in WORKLOAD.items()}
+    if spec:
+        for part in spec.split(","):
+            name, _, weight = part.partition("=")
+            if name.strip() not in WORKLOAD:
+                raise SystemExit(f"Неизвестная команда в --mix: {name.strip()}")
+            weights[name.strip()] = int(weight)
+    return weights
+
+
+async def _seed(users: dict[int, FakeUser]):
+    for uid in users:
+        await db.change_balance(uid, 1000, "сид", 0)
+    for uid in list(users)[:KEY_HOLDERS]:
+        await db.grant_key(uid)
+    for uid in list(users)[::7]:
+        await db.set_role(uid, f"Роль {uid}", "описание")
+
+
+def _build(label: str, rnd: random.Random, bot: FakeBot, users: list[FakeUser]) -> FakeMessage:
+    _, who, text, with_reply = WORKLOAD[label]
+    if who == "kurator":
+        author = FakeUser(commands.KURATOR_ID, "Куратор")
+    elif who == "key":
+        author = users[rnd.randrange(KEY_HOLDERS)]
+    else:
+        author = rnd.choice(users)
+    reply_to = None
+    if with_reply:
+        target = rnd.choice([u for u in rnd.sample(users, 2) if u.id != author.id] or users[:1])
+        reply_to = FakeMessage(bot, target, text="…")
+    if label == "болтовня":
+        text = rnd.choice(CHATTER)
+    if label == "фото роли":
+        return FakeMessage(bot, author, caption="фото роли", reply_to=reply_to,
+                           photo=[SimpleNamespace(file_id=f"file-{rnd.random()}")])
+    return FakeMessage(bot, author, text=text, reply_to=reply_to)
+
+
+async def run(n: int, concurrency: int, api_ms: float, mix: dict[str, int], seed: int = 7) -> dict:
+    rnd = random.Random(seed)
+    users = {uid: FakeUser(uid) for uid in range(1, USERS + 1)}
+    bot = FakeBot(api_delay=api_ms / 1000, users=users)
+    labels = [label for label, w in mix.items() if w > 0]
+    weights = [mix[label] for label in labels]
+    plan = rnd.choices(labels, weights, k=n)
+    user_list = list(users.values())
+    messages = [(label, _build(label, rnd, bot, user_list)) for label in plan]
+
+    latencies: dict[str, list[float]] = {label: [] for label in labels}
+    queue: asyncio.Queue = asyncio.Queue()
+    for item in messages:
+        queue.put_nowait(item)
+
+    async def worker():
+        while not queue.empty():
+            label, message = queue.get_nowait()
+            start = time.perf_counter()
+            if message.photo:
+                await commands.handle_photo_command(message)
+            else:
+                await commands.handle_message(message)
+            latencies[label].append(time.perf_counter() - start)
+
+    async with temp_db("replay.sqlite"):
+        await _seed(users)
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+        await scheduler.shutdown()  # несыгранные ставки остаются в базе, нам они не нужны
+
+    result = {"n": n, "concurrency": concurrency, "api_ms": api_ms,
+              "throughput": n / elapsed, "seconds": elapsed, "commands": {}}
+    for label, values in latencies.items():
+        if not values:
+            continue
+        values.sort()
+        q = quantiles(values)
+        result["commands"][label] = {
+            "count": len(values),
+            "p50_ms": q[49] * 1e3, "p95_ms": q[94] * 1e3, "p99_ms": q[98] * 1e3,
+        }
+    return result
+
+
+def report(result: dict, baseline: dict | None):
+    print(f"{result['n']} сообщений, параллельно {result['concurrency']}, API {result['api_ms']} мс: "
+          f"{result['throughput']:.0f} сообщений/с")
+    if baseline:
+        print(f"  базовая линия: {baseline['throughput']:.0f} сообщений/с "
+              f"({(result['throughput'] / baseline['throughput'] - 1) * 100:+.0f}%)")
+    print(f"{'команда':<17}{'кол-во':>7}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}")
+    for label, row in sorted(result["commands"].items(), key=lambda kv: -kv[1]["count"]):
+        line = f"{label:<17}{row['count']:>7}{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}{row['p99_ms']:>10.2f}"
+        base = baseline and baseline["commands"].get(label)
+        if base:
+            line += f"   p95 было {base['p95_ms']:.2f}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-прогон нагрузки через commands.py")
+    parser.add_argument("-n", type=int, default=5000, help="сколько сообщений прогнать")
+    parser.add_argument("-c", "--concurrency", type=int, default=50, help="одновременно обрабатываемых")
+    parser.add_argument("--api-ms", type=float, default=0.0, help="задержка каждого вызова Telegram, мс")
+    parser.add_argument("--mix", help='веса команд, напр. "мой карман=20,передать=10"')
+    parser.add_argument("--save", action="store_true", help=f"сохранить результат как базовый ({BASELINE})")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args.n, args.concurrency, args.api_ms, _parse_mix(args.mix)))
+    baseline = None
+    if os.path.exists(BASELINE) and not args.save:
+        with open(BASELINE, encoding="utf-8") as f:
+            baseline = json.load(f)
+    report(result, baseline)
+    if args.save:
+        with open(BASELINE, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"сохранено в {BASELINE}")
+
+
+if __name__ == "__main__":
+    main()
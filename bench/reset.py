@@ -0,0 +1,115 @@
+# «Обнулить клуб» и обнуление балансов на большой базе без остановки:
+# заполняет временную базу (участники, роли, история, архив), держит поток
+# change_balance/get_balance и замеряет reset_all_balances, reset_club
+# и фоновую дочистку истории (retention.purge).
+# Падает (код 1), если после сброса видна старая история, после дочистки
+# в таблицах клуба что-то осталось, кэш отдаёт старый баланс или запись
+# после сброса не прошла.
+#
+# Запуск: python -m bench.reset [участников, 100 000] [записей истории, 1 000 000]
+import asyncio
+import os
+import random
+import sys
+import time
+
+import db
+import retention
+from bench.common import quantiles, temp_db
+
+SEED_BATCH = 100_000
+LOAD_WORKERS = 20
+WARM = 1000
+
+
+async def _seed(users: int, rows: int, archive: str):
+    conn = db._db().writer
+    await conn.executemany("INSERT INTO users (user_id, balance, key) VALUES (?, ?, ?)",
+                           ((uid, 100 + uid % 900, int(uid % 50 == 0)) for uid in range(1, users + 1)))
+    await conn.executemany("INSERT INTO roles (user_id, role_name, role_desc) VALUES (?, ?, 'описание')",
+                           ((uid, f"роль {uid}") for uid in range(1, users + 1, 10)))
+    for start in range(0, rows, SEED_BATCH):
+        await conn.executemany(
+            "INSERT INTO history (user_id, action, amount, reason) VALUES (?, 'change_balance', 1, 'сид')",
+            ((i % users + 1,) for i in range(start, min(start + SEED_BATCH, rows))))
+    await conn.commit()
+    await db.attach_archive(archive)
+    await conn.execute("INSERT INTO archive.history SELECT * FROM main.history WHERE id <= ?", (rows // 2,))
+    await conn.commit()
+
+
+async def _load(stop: asyncio.Event, users: int, latencies: list[float]):
+    rnd = random.Random()
+    while not stop.is_set():
+        uid = rnd.randrange(WARM + 1, users + 1)  # прогретых участников поток не трогает
+        start = time.perf_counter()
+        await db.get_balance(uid)
+        await db.change_balance(uid, 1, "нагрузка", 0)
+        latencies.append(time.perf_counter() - start)
+
+
+async def _count(table: str) -> int:
+    async with db._db().writer.execute(f"SELECT COUNT(*) FROM {table}") as cur:
+        return (await cur.fetchone())[0]
+
+
+async def main(users: int, rows: int) -> int:
+    failures = []
+    async with temp_db("club.sqlite") as tmp:
+        await _seed(users, rows, os.path.join(tmp, "archive.sqlite"))
+        for uid in range(1, WARM + 1):
+            await db.get_balance(uid)  # прогреваем кэш профилей
+        print(f"заполнено: {users} участников, {rows} записей истории, {rows // 2} в архиве")
+
+        latencies: list[float] = []
+        stop = asyncio.Event()
+        loaders = [asyncio.create_task(_load(stop, users, latencies)) for _ in range(LOAD_WORKERS)]
+        await asyncio.sleep(1)
+
+        start = time.perf_counter()
+        await db.reset_all_balances()
+        balances_ms = (time.perf_counter() - start) * 1e3
+        if await db.get_balance(1) != 0:
+            failures.append("кэш отдаёт баланс после reset_all_balances")
+        await asyncio.sleep(0.5)
+
+        start = time.perf_counter()
+        await db.reset_club()
+        club_ms = (time.perf_counter() - start) * 1e3
+        if await db.get_history(1, limit=1) or await db.get_history_total(1):
+            failures.append("после reset_club видна старая история")
+        start = time.perf_counter()
+        purged = await retention.purge()
+        purge_s = time.perf_counter() - start
+        stop.set()
+        await asyncio.gather(*loaders)
+
+        print(f"reset_all_balances: {balances_ms:.1f} мс, reset_club: {club_ms:.1f} мс, "
+              f"дочистка {purged} строк истории в фоне: {purge_s:.1f} с")
+        q = quantiles(latencies)
+        print(f"нагрузка: {len(latencies)} операций, p50 {q[49] * 1e3:.1f} мс, p99 {q[98] * 1e3:.1f} мс, "
+              f"max {max(latencies) * 1e3:.1f} мс")
+
+        # второй сброс стирает и то, что записал поток нагрузки
+        await db.reset_club()
+        await retention.purge()
+        for table in ("main.users", "main.roles", "main.history", "main.history_daily",
+                      "main.pending_bets", "archive.history"):
+            left = await _count(table)
+            if left:
+                failures.append(f"в {table} осталось {left} строк")
+        if await db.get_balance(5) != 0:
+            failures.append("кэш отдаёт баланс после reset_club")
+        if await db.change_balance(5, 7, "после сброса", 0) != 7 or await db.get_balance(5) != 7:
+            failures.append("запись после сброса не прошла")
+
+    for failure in failures:
+        print("ОШИБКА:", failure)
+    if not failures:
+        print("таблицы клуба пусты, кэш сброшен, бот продолжает писать")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    sys.exit(asyncio.run(main(int(args[0]) if args else 100_000, int(args[1]) if len(args) > 1 else 1_000_000)))
@@ -0,0 +1,131 @@
+# Перенос истории в архив под нагрузкой: заполняет временную базу N записями
+# (90% старше срока хранения), запускает retention.run_once параллельно
+# с потоком change_balance и сравнивает задержки записи до и во время переноса.
+# Падает (код 1), если после переноса не сходятся суммы по участникам
+# (итоги по дням + живая история) или число записей в основной базе и архиве.
+#
+# Запуск: python -m bench.retention [число записей, по умолчанию 1 000 000]
+import asyncio
+import os
+import random
+import sys
+import time
+
+import db
+import metrics
+import retention
+from bench.common import quantiles, temp_db
+
+USERS = 500
+DAYS = 90
+SEED_BATCH = 100_000
+LOAD_WORKERS = 20
+
+
+async def _seed(rows: int):
+    conn = db._db().writer
+    now = time.time()
+
+    def stamp(i: int) -> str:
+        # 90% записей — от 400 до 91 дня назад, остальные — за последний месяц, id растут вместе с датой
+        if i < rows * 0.9:
+            age = 400 - (i / (rows * 0.9)) * 309
+        else:
+            age = 30 - ((i - rows * 0.9) / (rows * 0.1)) * 30
+        return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(now - age * 86400))
+
+    for start in range(0, rows, SEED_BATCH):
+        await conn.executemany(
+            "INSERT INTO history (user_id, action, amount, reason, date) VALUES (?, 'change_balance', ?, 'сид', ?)",
+            ((i % USERS, i % 50 - 25, stamp(i)) for i in range(start, min(start + SEED_BATCH, rows))))
+        await conn.commit()
+
+
+async def _totals() -> dict[int, int]:
+    async with db._db().read() as conn:
+        async with conn.execute("SELECT user_id, SUM(amount) FROM history GROUP BY user_id") as cur:
+            return dict(await cur.fetchall())
+
+
+async def _count(sql: str) -> int:
+    pool = db._db()
+    if pool.state:
+        await pool.state.sync()  # STORAGE_BACKEND=eventlog: писатель видит только перенесённое из журнала
+    async with pool.writer.execute(sql) as cur:
+        return (await cur.fetchone())[0]
+
+
+async def _load(stop: asyncio.Event, latencies: list[float], deltas: dict[int, int]):
+    rnd = random.Random()
+    while not stop.is_set():
+        uid = rnd.randrange(USERS)
+        start = time.perf_counter()
+        await db.change_balance(uid, 1, "нагрузка", 0)
+        latencies.append(time.perf_counter() - start)
+        deltas[uid] = deltas.get(uid, 0) + 1
+
+
+def _describe(label: str, values: list[float]) -> str:
+    q = quantiles(values)
+    return (f"{label:<18} {len(values):>7} записей   p50 {q[49] * 1e3:6.2f}   p99 {q[98] * 1e3:6.2f}   "
+            f"max {max(values) * 1e3:7.2f} мс")
+
+
+async def main(rows: int) -> int:
+    failures = []
+    async with temp_db("live.sqlite") as tmp:
+        start = time.perf_counter()
+        await _seed(rows)
+        before = await _totals()
+        print(f"заполнено {rows} записей за {time.perf_counter() - start:.1f} с")
+
+        deltas: dict[int, int] = {}
+        idle: list[float] = []
+        stop = asyncio.Event()
+        loaders = [asyncio.create_task(_load(stop, idle, deltas)) for _ in range(LOAD_WORKERS)]
+        await asyncio.sleep(2)
+        stop.set()
+        await asyncio.gather(*loaders)
+
+        busy: list[float] = []
+        stop = asyncio.Event()
+        loaders = [asyncio.create_task(_load(stop, busy, deltas)) for _ in range(LOAD_WORKERS)]
+        start = time.perf_counter()
+        moved = await retention.run_once(os.path.join(tmp, "archive.sqlite"), days=DAYS)
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await asyncio.gather(*loaders)
+
+        chunk = metrics.histogram("db", "archive_history")
+        print(f"перенесено {moved} записей за {elapsed:.1f} с ({moved / elapsed:,.0f} записей/с), "
+              f"шагов {chunk.count}, в среднем {chunk.sum / chunk.count * 1e3:.1f} мс на шаг")
+        print(_describe("запись без переноса", idle))
+        print(_describe("запись при переносе", busy))
+
+        live = await _count("SELECT COUNT(*) FROM main.history")
+        archived = await _count("SELECT COUNT(*) FROM archive.history")
+        days = await _count("SELECT COUNT(*) FROM history_daily")
+        pages = await _count("PRAGMA main.page_count")
+        free = await _count("PRAGMA main.freelist_count")
+        print(f"в основной базе {live} записей и {days} итогов по дням; в архиве {archived}; "
+              f"свободных страниц {free} из {pages}")
+
+        expected = rows + len(idle) + len(busy)
+        if live + archived != expected:
+            failures.append(f"записей {live} + {archived}, ожидалось {expected}")
+        for uid in range(USERS):
+            want = before.get(uid, 0) + deltas.get(uid, 0)
+            got = await db.get_history_total(uid)
+            if got != want:
+                failures.append(f"участник {uid}: сумма {got}, ожидалось {want}")
+                break
+
+    for failure in failures:
+        print("ОШИБКА:", failure)
+    if not failures:
+        print("суммы по участникам и число записей сходятся")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)))
@@ -0,0 +1,77 @@
+# Один участник заваливает бота сообщениями, рядом много тихих участников.
+# Приём обновлений идёт по одному, как polling с handle_as_tasks=False:
+# следующее обновление берётся, только когда submit вернулся. Обработчик
+# каждого сообщения занят HANDLER_MS. Проверки:
+#   - тихие участники получают ответ быстро: приём не ждёт, пока разберётся
+#     очередь флудера;
+#   - у флудера ждёт не больше SHARD_QUEUE_DEPTH сообщений, лишние
+#     отброшены и посчитаны, оставшиеся выполнены по порядку.
+# Падает (код 1), если хоть одна проверка не прошла.
+#
+# Запуск: python -m bench.shards [сообщений флудера, 5000] [тихих участников, 500]
+import asyncio
+import random
+import sys
+import time
+
+from shards import UserShards
+from bench.common import quantiles
+
+SHARDS = 8
+DEPTH = 20
+HANDLER_MS = 5
+FLOODER = 1
+QUIET_MS = 500  # p99 ответа тихому участнику должен уложиться сюда
+
+
+async def main(flood: int, quiet: int) -> int:
+    failures = []
+    shards = UserShards(SHARDS, DEPTH)
+    handled: dict[int, list[int]] = {}
+    latencies: list[float] = []
+
+    async def handler(user_id: int, seq: int, arrived: float):
+        await asyncio.sleep(HANDLER_MS / 1000)
+        handled.setdefault(user_id, []).append(seq)
+        if user_id != FLOODER:
+            latencies.append(time.perf_counter() - arrived)
+
+    rnd = random.Random(1)
+    stream = [FLOODER] * flood + [FLOODER + 1 + i for i in range(quiet)]
+    rnd.shuffle(stream)  # сообщения тихих вперемешку с потоком флудера
+    flooder_seq = 0
+    start = time.perf_counter()
+    for user_id in stream:
+        seq = 0
+        if user_id == FLOODER:
+            seq, flooder_seq = flooder_seq, flooder_seq + 1
+        await shards.submit(user_id, handler, user_id, seq, time.perf_counter())
+    intake = time.perf_counter() - start
+    await shards.stop()
+    total = time.perf_counter() - start
+
+    stats = shards.stats()
+    q = quantiles(latencies)
+    done = handled.get(FLOODER, [])
+    print(f"приём {len(stream)} обновлений за {intake:.2f} с, всё выполнено за {total:.2f} с")
+    print(f"тихие ({quiet}): p50 {q[49] * 1e3:.0f} мс, p99 {q[98] * 1e3:.0f} мс, max {max(latencies) * 1e3:.0f} мс")
+    print(f"флудер: выполнено {len(done)} из {flood}, отброшено {stats['dropped']}")
+    if q[98] * 1e3 > QUIET_MS:
+        failures.append(f"p99 ответа тихому участнику {q[98] * 1e3:.0f} мс при пределе {QUIET_MS} мс")
+    if len(handled) - (FLOODER in handled) != quiet:
+        failures.append("не все тихие участники получили ответ")
+    if not stats["dropped"] or len(done) + stats["dropped"] != flood:
+        failures.append("лишние сообщения флудера не отброшены или не посчитаны")
+    if done != sorted(done):
+        failures.append("сообщения флудера выполнены не по порядку")
+
+    for failure in failures:
+        print("ОШИБКА:", failure)
+    if not failures:
+        print("флудер упирается в свою очередь, тихие участники его не ждут")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    sys.exit(asyncio.run(main(int(args[0]) if args else 5000, int(args[1]) if len(args) > 1 else 500)))
@@ -0,0 +1,228 @@
+# Снимки балансов: история с постоянным темпом (DAY_ROWS записей в день) и
+# снимками каждые SNAP_HOURS часов, длиной в 100 тыс. и 1 млн записей.
+# get_balance_at и get_balance_changes (снимок + хвост истории) сравниваются
+# с полным проигрыванием истории: ответы должны совпасть, а задержка — не
+# расти вместе с историей (хвост зависит от частоты снимков, не от размера).
+# Ещё проверяется, что списание, упёршееся в ноль, пишет в историю реально
+# списанное, и что на старой базе (списания без упора в ноль, обнуления без
+# записей в истории) ответы до первого снимка — «нет данных», а не догадка.
+# Наконец снимки старше половины истории удаляются (prune_snapshots): внутри
+# окна ответы те же, раньше — «нет данных», а снимков остаётся на окно.
+# Падает (код 1), если ответы не сходятся, списание записано не так или p99
+# запроса по снимку SLOW_MS и больше.
+#
+# Запуск: python -m bench.snapshots [размеры истории через запятую, 100000,1000000]
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import db
+from bench.common import percentile, temp_db
+
+USERS = 2000
+DAY_ROWS = 10_000
+SNAP_HOURS = 6
+QUERIES = 200
+SEED_BATCH = 100_000
+SLOW_MS = 50
+
+
+def _stamp(t: float) -> str:
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(t))
+
+
+async def _seed(rows: int, start: float) -> tuple[dict[int, int], list[str]]:
+    # id растут вместе с датой; суммы — фактически применённые (баланс не ниже нуля)
+    conn = db._db().writer
+    # снимок новой базы снят «сейчас», а история сида лежит в прошлом
+    await conn.execute("DELETE FROM balance_snapshots")
+    await conn.execute("DELETE FROM snapshots")
+    rnd = random.Random(rows)
+    balances: dict[int, int] = {}
+    snapshots = []
+    step = 86400 / DAY_ROWS
+    next_snap = start + SNAP_HOURS * 3600
+    batch = []
+    for i in range(1, rows + 1):
+        t = start + i * step
+        if t >= next_snap:
+            await _flush(conn, batch)
+            taken_at = _stamp(next_snap)
+            async with conn.execute("INSERT INTO snapshots (history_id, taken_at) VALUES (?, ?) RETURNING id",
+                                    (i - 1, taken_at)) as cur:
+                snap_id = (await cur.fetchone())[0]
+            await conn.executemany("INSERT INTO balance_snapshots (snap_id, user_id, balance) VALUES (?, ?, ?)",
+                                   ((snap_id, uid, b) for uid, b in balances.items() if b > 0))
+            snapshots.append(taken_at)
+            next_snap += SNAP_HOURS * 3600
+        uid = rnd.randrange(USERS)
+        amount = max(rnd.randint(-4, 6), -balances.get(uid, 0))
+        balances[uid] = balances.get(uid, 0) + amount
+        batch.append((uid, amount, _stamp(t)))
+        if len(batch) >= SEED_BATCH:
+            await _flush(conn, batch)
+    await _flush(conn, batch)
+    await conn.executemany("INSERT INTO users (user_id, balance, key) VALUES (?, ?, 0)", balances.items())
+    await conn.commit()
+    return balances, snapshots
+
+
+async def _flush(conn, batch: list):
+    await conn.executemany(
+        "INSERT INTO history (user_id, action, amount, reason, date) VALUES (?, 'change_balance', ?, 'сид', ?)", batch)
+    batch.clear()
+
+
+async def _replay(conn, at: str, user_id: int | None = None):
+    # Полное проигрывание истории до at — то, что было раньше единственным способом
+    if user_id is not None:
+        async with conn.execute("SELECT COALESCE(SUM(amount), 0) FROM history WHERE user_id = ? AND date <= ?",
+                                (user_id, at)) as cur:
+            return (await cur.fetchone())[0]
+    async with conn.execute("SELECT user_id, SUM(amount) FROM history WHERE date <= ? GROUP BY user_id",
+                            (at,)) as cur:
+        return dict(await cur.fetchall())
+
+
+def _top(before: dict, after: dict, limit: int) -> list[tuple[int, int]]:
+    changes = [(uid, b - before.get(uid, 0)) for uid, b in after.items() if b - before.get(uid, 0) > 0]
+    changes.sort(key=lambda c: (-c[1], c[0]))
+    return changes[:limit]
+
+
+async def _run(rows: int, failures: list[str]) -> dict:
+    async with temp_db("snapshots.sqlite"):
+        days = rows / DAY_ROWS
+        start = time.time() - days * 86400 - 3600
+        balances, snapshots = await _seed(rows, start)
+        rnd = random.Random(1)
+        span = days * 86400
+
+        point, replay_point, wrong = [], [], 0
+        async with db._db().read() as conn:
+            for _ in range(QUERIES):
+                uid = rnd.randrange(USERS)
+                at = _stamp(start + rnd.random() * span)
+                t0 = time.perf_counter()
+                got = await db.get_balance_at(uid, at)
+                t1 = time.perf_counter()
+                want = await _replay(conn, at, uid) if at >= snapshots[0] else None
+                replay_point.append(time.perf_counter() - t1)
+                point.append(t1 - t0)
+                wrong += got != want
+        if wrong:
+            failures.append(f"{rows}: get_balance_at разошёлся с историей в {wrong} из {QUERIES}")
+
+        # «рейтинг недели» в разные недели истории и до текущих балансов
+        weekly, replay_weekly, wrong = [], [], 0
+        async with db._db().read() as conn:
+            for i in range(10):
+                since = start + rnd.random() * (span - 7 * 86400)
+                until = None if i == 0 else _stamp(since + 7 * 86400)
+                t0 = time.perf_counter()
+                got = await db.get_balance_changes(_stamp(since), until, limit=10)
+                t1 = time.perf_counter()
+                after = balances if until is None else await _replay(conn, until)
+                want = _top(await _replay(conn, _stamp(since)), after, 10) if _stamp(since) >= snapshots[0] else None
+                replay_weekly.append(time.perf_counter() - t1)
+                weekly.append(t1 - t0)
+                wrong += got != want
+        if wrong:
+            failures.append(f"{rows}: get_balance_changes разошёлся с историей в {wrong} из 10")
+
+        t0 = time.perf_counter()
+        await db.take_snapshot()
+        snap_ms = (time.perf_counter() - t0) * 1e3
+
+        # окно в половину истории: старые снимки удаляются, ответы внутри окна прежние
+        keep = days / 2
+        pruned = await db.prune_snapshots(keep)
+        cutoff = time.time() - keep * 86400
+        wrong = 0
+        async with db._db().read() as conn:
+            for _ in range(QUERIES // 4):
+                uid = rnd.randrange(USERS)
+                at = _stamp(cutoff + rnd.random() * (time.time() - cutoff - 7200))
+                wrong += await db.get_balance_at(uid, at) != await _replay(conn, at, uid)
+            old = await db.get_balance_at(0, _stamp(start + span / 4))
+        print(f"  окно {keep:.0f} дней: удалено снимков {pruned} из {len(snapshots) + 1}")
+        if wrong:
+            failures.append(f"{rows}: после удаления старых снимков get_balance_at разошёлся в {wrong} ответах")
+        if old is not None or pruned < len(snapshots) // 2 - 1:
+            failures.append(f"{rows}: снимки старше окна не удалены")
+    print(f"{rows} записей ({days:.0f} дней, {len(snapshots)} снимков, {USERS} участников):")
+    print(f"  баланс на момент: снимок p50 {percentile(point, 50):.2f} мс, p99 {percentile(point, 99):.2f} мс; "
+          f"полное проигрывание p50 {percentile(replay_point, 50):.1f} мс")
+    print(f"  прирост за неделю: снимки p50 {statistics.median(weekly) * 1e3:.1f} мс, "
+          f"max {max(weekly) * 1e3:.1f} мс; полное проигрывание p50 {statistics.median(replay_weekly) * 1e3:.0f} мс")
+    print(f"  снимок всех балансов: {snap_ms:.1f} мс")
+    if percentile(point, 99) >= SLOW_MS or max(weekly) * 1e3 >= SLOW_MS:
+        failures.append(f"{rows}: запрос по снимку занял {SLOW_MS} мс и больше")
+    return {"point_p50": percentile(point, 50), "weekly_p50": statistics.median(weekly) * 1e3}
+
+
+async def _clamp(failures: list[str]):
+    async with temp_db("clamp.sqlite"):
+        await db.change_balance(1, 5, "начисление", 0)
+        balance = await db.change_balance(1, -100, "взыскание", 0)
+        rows = await db.get_history(1, limit=10)
+    amounts = [row[3] for row in rows]
+    print(f"списание 100 при балансе 5: баланс {balance}, в истории {amounts}")
+    if balance != 0 or sorted(amounts) != [-5, 5]:
+        failures.append("списание, упёршееся в ноль, записано в историю не фактической суммой")
+
+
+async def _legacy(failures: list[str]):
+    # база старой версии: история не сходится с балансами, снимков нет
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, "legacy.sqlite")
+        await db.init_db()
+        conn = db._db().writer
+        await conn.execute("DELETE FROM balance_snapshots")
+        await conn.execute("DELETE FROM snapshots")
+        await conn.executemany(
+            "INSERT INTO history (user_id, action, amount, reason, date) VALUES (?, 'change_balance', ?, '', ?)",
+            [(1, 5, "2025-01-01 10:00:00"), (1, -100, "2025-01-02 10:00:00"),  # списано 5, записано -100
+             (2, 30, "2025-01-01 10:00:00"), (2, -65, "2025-01-03 10:00:00"),
+             (2, 30, "2025-01-04 10:00:00")])  # обнуление между ними в историю не попало
+        await conn.executemany("INSERT INTO users (user_id, balance, key) VALUES (?, ?, 0)", [(1, 0), (2, 30)])
+        await conn.execute("PRAGMA user_version = 6")
+        await conn.commit()
+        await db.close_db()
+        await db.init_db()  # миграция 7 снимает первый снимок
+        try:
+            now = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time() + 1))
+            old = [await db.get_balance_at(1, "2025-01-05 00:00:00"), await db.get_balance_at(2, "2025-01-05 00:00:00"),
+                   await db.get_balance_changes("2025-01-01 00:00:00")]
+            current = [await db.get_balance_at(1, now), await db.get_balance_at(2, now)]
+        finally:
+            await db.close_db()
+    print(f"старая база: до первого снимка {old}, сейчас {current}")
+    if old != [None, None, None] or current != [0, 30]:
+        failures.append("на старой базе баланс на момент до первого снимка не «нет данных» или текущий неверен")
+
+
+async def main(sizes: list[int]) -> int:
+    failures = []
+    results = [await _run(rows, failures) for rows in sizes]
+    if len(results) > 1:
+        print(f"рост задержки от {sizes[0]} до {sizes[-1]} записей: баланс на момент "
+              f"x{results[-1]['point_p50'] / results[0]['point_p50']:.1f}, "
+              f"прирост за неделю x{results[-1]['weekly_p50'] / results[0]['weekly_p50']:.1f}")
+    await _clamp(failures)
+    await _legacy(failures)
+
+    for failure in failures:
+        print("ОШИБКА:", failure)
+    if not failures:
+        print("снимки отвечают так же, как полная история")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    sys.exit(asyncio.run(main([int(n) for n in args[0].split(",")] if args else [100_000, 1_000_000])))
@@ -0,0 +1,134 @@
+# Сторож цикла событий (stalls.py):
+#   - обработчик, который синхронно спит BLOCK_MS, должен попасть в отчёт
+#     с именем обработчика и строкой time.sleep в стеке, а в метриках —
+#     archivist_loop_stalls_total{handler="handle_blocking"};
+#   - поток команд через handle_message (список команд, выгрузка истории,
+#     карманы, рейтинги) не должен ни разу открыть/удалить файл в потоке
+#     цикла событий (ловится аудит-хуком Python) и ни разу зависнуть дольше
+#     порога;
+#   - сторож почти не стоит: сравнивается число оборотов цикла в секунду
+#     с ним и без него.
+# Падает (код 1), если что-то из этого не так.
+#
+# Запуск: python -m bench.stalls [команд, 500]
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+
+import commands
+import db
+import metrics
+import outbox
+import stalls
+from bench.common import temp_db
+from bench.fakes import FakeBot, FakeMessage, FakeUser
+
+THRESHOLD_MS = 50
+BLOCK_MS = 200
+FILE_EVENTS = {"open", "os.remove", "os.listdir", "os.scandir", "tempfile.mkstemp", "os.rename"}
+COMMANDS = ["список команд", "мой карман", "рейтинг клуба", "рейтинг недели", "хранители ключа",
+            "выгрузить историю csv", "выгрузить историю jsonl", "прошлое"]
+
+_loop_thread = 0
+_file_calls: list[tuple[str, str]] = []  # (событие, вызывающий код) в потоке цикла
+_watching = False
+
+
+def _audit(event: str, args):
+    if _watching and event in FILE_EVENTS and threading.get_ident() == _loop_thread:
+        # ближайший кадр кода бота; без чтения исходников — иначе хук вызовет сам себя через open
+        frame = sys._getframe(1)
+        while frame is not None and not frame.f_code.co_filename.startswith(stalls.ROOT):
+            frame = frame.f_back
+        where = f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno} {frame.f_code.co_name}" if frame else "?"
+        _file_calls.append((event, where))
+
+
+async def handle_blocking(message):
+    time.sleep(BLOCK_MS / 1000)
+
+
+async def _spins(seconds: float) -> int:
+    count = 0
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        await asyncio.sleep(0)
+        count += 1
+    return count
+
+
+async def main(total: int) -> int:
+    global _loop_thread, _watching
+    failures = []
+    _loop_thread = threading.get_ident()
+    sys.addaudithook(_audit)
+    logged: list[str] = []
+    handler = logging.Handler()
+    handler.emit = lambda record: logged.append(record.getMessage())
+    logging.getLogger().addHandler(handler)
+
+    # замеры вперемешку, лучший из пяти: шум машины больше цены сторожа
+    bare = watched = 0
+    for _ in range(5):
+        bare = max(bare, await _spins(0.2) * 5)
+        stalls.start(THRESHOLD_MS)
+        watched = max(watched, await _spins(0.2) * 5)
+        await stalls.stop()
+    stalls.start(THRESHOLD_MS)
+    print(f"оборотов цикла за 1 с: без сторожа {bare}, со сторожем {watched} "
+          f"({(bare - watched) / bare * 100:+.1f}% потерь)")
+    if watched < bare * 0.9:
+        failures.append("сторож замедляет цикл событий больше чем на 10%")
+
+    async with temp_db("stalls.sqlite"):
+        try:
+            bot = FakeBot()
+            kurator = FakeUser(commands.KURATOR_ID, "Куратор")
+            for uid in range(1, 200):
+                await db.change_balance(uid, uid, "сид", 0)
+            await commands.preload_help()
+
+            # намеренная блокировка: сторож должен назвать обработчик и показать стек
+            await asyncio.create_task(handle_blocking(FakeMessage(bot, kurator, text="блок")))
+            await asyncio.sleep(THRESHOLD_MS / 1000)
+            report = next((line for line in logged if "handle_blocking" in line), "")
+            print(f"блокировка {BLOCK_MS} мс: {report.splitlines()[0] if report else 'не найдена'}")
+            if "time.sleep" not in report:
+                failures.append("зависание не найдено или в стеке нет time.sleep")
+            if "archivist_loop_stalls_total{handler=\"handle_blocking\"}" not in metrics.render():
+                failures.append("зависание не попало в метрики")
+
+            # поток настоящих команд
+            before = stalls.detected
+            _watching = True
+            start = time.perf_counter()
+            for i in range(total):
+                text = COMMANDS[i % len(COMMANDS)]
+                await commands.handle_message(FakeMessage(bot, kurator, text=text))
+            await outbox.drain()
+            elapsed = time.perf_counter() - start
+            _watching = False
+            stalled = stalls.detected - before
+            print(f"{total} команд за {elapsed:.1f} с: зависаний дольше {THRESHOLD_MS} мс {stalled}, "
+                  f"файловых вызовов в потоке цикла {len(_file_calls)}")
+            for event, caller in sorted(set(_file_calls)):
+                print(f"  {event}: {caller}")
+            if _file_calls:
+                failures.append("обработчики трогают диск в потоке цикла событий")
+            if stalled:
+                failures.append(f"зависаний при обработке команд: {stalled}")
+        finally:
+            await stalls.stop()
+
+    for failure in failures:
+        print("ОШИБКА:", failure)
+    if not failures:
+        print("сторож находит блокировки, команды цикл событий не блокируют")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 500)))
@@ -0,0 +1,108 @@
+# Холодный старт до первого обработанного обновления: для каждой базы
+# запускает отдельный процесс, который импортирует бота, вызывает init_db,
+# запускает long polling на сессии-заглушке (bench/webhook.py) и ждёт ответа
+# на первое обновление. Время считается от запуска процесса.
+#
+# Базы: пустая (все миграции), уже актуальная с N записями истории (быстрый
+# путь по PRAGMA user_version) и старая версии 1 с N записями без индексов
+# (миграции на месте, включая построение индексов).
+#
+# Запуск: python -m bench.startup [записей истории, по умолчанию 1 000 000] [повторов, 5]
+import asyncio
+import json
+import os
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+async def _child(path: str, spawned_at: float):
+    import db
+    from bench.webhook import StubSession, _dispatcher, TOKEN
+    from aiogram import Bot
+    imported = time.time()
+
+    db.DB_PATH = path
+    start = time.perf_counter()
+    await db.init_db()
+    init_ms = (time.perf_counter() - start) * 1e3
+
+    session = StubSession(0)
+    session.expected = 1
+    session.updates.put_nowait({
+        "update_id": 1,
+        "message": {"message_id": 1, "date": 0, "text": "мой карман",
+                    "chat": {"id": -100, "type": "supergroup"},
+                    "from": {"id": 7, "is_bot": False, "first_name": "U"}},
+    })
+    bot = Bot(TOKEN, session=session)
+    dp = _dispatcher()
+    runner = asyncio.create_task(dp.start_polling(bot, handle_signals=False, close_bot_session=False))
+    await session.all_replied.wait()
+    first_ms = (time.time() - spawned_at) * 1e3
+    await dp.stop_polling()
+    await runner
+    await db.close_db()
+    print(json.dumps({"import_ms": (imported - spawned_at) * 1e3, "init_ms": init_ms, "first_ms": first_ms}))
+
+
+def _legacy(path: str, rows: int):
+    # схема первой версии бота: три таблицы без индексов
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE users (user_id INTEGER PRIMARY KEY, username TEXT,
+                            balance INTEGER NOT NULL DEFAULT 0, key INTEGER NOT NULL DEFAULT 0);
+        CREATE TABLE roles (user_id INTEGER PRIMARY KEY, role_name TEXT, role_desc TEXT, role_image TEXT);
+        CREATE TABLE history (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, action TEXT,
+                              amount INTEGER, reason TEXT, date TIMESTAMP DEFAULT CURRENT_TIMESTAMP);
+        PRAGMA user_version = 1;
+    """)
+    conn.executemany("INSERT INTO users (user_id, balance) VALUES (?, ?)", ((i, i % 1000) for i in range(5000)))
+    conn.executemany("INSERT INTO history (user_id, action, amount, reason) VALUES (?, 'change_balance', 1, 'сид')",
+                     ((i % 5000,) for i in range(rows)))
+    conn.commit()
+    conn.close()
+
+
+def _run(template: str | None, tmp: str) -> dict:
+    path = os.path.join(tmp, "run.sqlite")
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    if template:
+        shutil.copy(template, path)
+    out = subprocess.run([sys.executable, "-m", "bench.startup", "--child", path, repr(time.time())],
+                         cwd=ROOT, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main(rows: int, repeats: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy = os.path.join(tmp, "legacy.sqlite")
+        _legacy(legacy, rows)
+        current = os.path.join(tmp, "current.sqlite")
+        shutil.copy(legacy, current)
+        _run(current, tmp)  # доводим копию до последней версии
+        shutil.copy(os.path.join(tmp, "run.sqlite"), current)
+
+        cases = (("пустая база", None), (f"актуальная, {rows:,} записей", current),
+                 (f"версия 1, {rows:,} записей", legacy))
+        print(f"{'база':<30}{'импорт, мс':>12}{'init_db, мс':>13}{'до ответа, мс':>15}")
+        for label, template in cases:
+            runs = [_run(template, tmp) for _ in range(repeats)]
+            med = {key: statistics.median(r[key] for r in runs) for key in runs[0]}
+            print(f"{label:<30}{med['import_ms']:>12.0f}{med['init_ms']:>13.1f}{med['first_ms']:>15.0f}")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--child"]:
+        asyncio.run(_child(sys.argv[2], float(sys.argv[3])))
+    else:
+        args = sys.argv[1:]
+        main(int(args[0]) if args else 1_000_000, int(args[1]) if len(args) > 1 else 5)
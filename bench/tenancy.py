@@ -0,0 +1,169 @@
+# Много клубов на одном боте: каждый чат пишет в свою базу (CLUBS_DIR),
+# открытыми держится не больше CLUB_POOL_MAX баз. Поток change_balance
+# по тысячам чатов вразброс (почти каждая запись открывает базу заново)
+# и по горячим чатам, которые помещаются в лимит, затем проверки:
+#   - балансы каждого чата сходятся с тем, что в него записали (после
+#     закрытия и повторного открытия баз), и не видны из других чатов;
+#   - имена, полученные от Telegram в любом чате, ложатся в общий справочник
+#     основной базы, и другой чат берёт их оттуда, не спрашивая Telegram;
+#   - открытых баз не больше лимита;
+#   - фоновые проходы сверки и архива не вытесняют базы горячих чатов, а
+#     после первого прохода обходят только чаты, где работали обработчики;
+#   - пока писатель одного клуба занят, запись в другой клуб не ждёт.
+# Падает (код 1), если хоть одна проверка не прошла.
+#
+# Запуск: python -m bench.tenancy [чатов, 2000] [операций, 10 000] [лимит открытых баз, 32]
+import asyncio
+import os
+import random
+import sys
+import time
+from collections import Counter
+
+import audit
+import db
+import names
+import retention
+from bench.common import quantiles, temp_db
+from bench.fakes import FakeBot
+
+WORKERS = 8
+USERS_PER_CHAT = 5
+HOLD = 1.0  # сколько держим писателя одного клуба, с
+
+
+async def _worker(ops: list[tuple[int, int]], expected: Counter, latencies: list[float]):
+    while ops:
+        chat_id, user_id = ops.pop()
+        start = time.perf_counter()
+        async with db.club(chat_id):
+            await db.change_balance(user_id, 1, "нагрузка", 0)
+        latencies.append(time.perf_counter() - start)
+        expected[chat_id, user_id] += 1
+
+
+async def _watch(stop: asyncio.Event, peak: list[int]):
+    while not stop.is_set():
+        peak[0] = max(peak[0], db.open_clubs())
+        await asyncio.sleep(0.001)
+
+
+async def main(chats: int, ops: int, pool_max: int) -> int:
+    failures = []
+    async with temp_db("home.sqlite") as tmp:
+        db.CLUBS_DIR = os.path.join(tmp, "clubs")
+        db.CLUB_POOL_MAX = pool_max
+        rnd = random.Random(1)
+        chat_ids = [-1000 - i for i in range(chats)]
+        hot = chat_ids[:pool_max // 2]
+        expected: Counter = Counter()
+        stop = asyncio.Event()
+        peak = [0]
+        watcher = asyncio.create_task(_watch(stop, peak))
+        for label, pick in (("вразброс", chat_ids), ("горячие", hot)):
+            work = [(rnd.choice(pick), rnd.randint(1, USERS_PER_CHAT)) for _ in range(ops)]
+            latencies: list[float] = []
+            start = time.perf_counter()
+            await asyncio.gather(*(_worker(work, expected, latencies) for _ in range(WORKERS)))
+            elapsed = time.perf_counter() - start
+            q = quantiles(latencies)
+            print(f"{label}: {ops} записей по {len(pick)} чатам за {elapsed:.1f} с: {ops / elapsed:.0f} оп/с, "
+                  f"p50 {q[49] * 1e3:.1f} мс, p99 {q[98] * 1e3:.1f} мс")
+        stop.set()
+        await watcher
+
+        touched = len({chat_id for chat_id, _ in expected})
+        print(f"открыто баз максимум {peak[0]} при лимите {pool_max}")
+        if peak[0] > pool_max:
+            failures.append(f"открыто {peak[0]} баз при лимите {pool_max}")
+        files = len(await db.club_chat_ids())
+        if files != touched:
+            failures.append(f"файлов клубов {files}, а чатов {touched}")
+
+        # фоновые проходы: первый обходит все клубы, горячие базы остаются открытыми
+        for chat_id in hot:
+            async with db.club(chat_id):
+                pass
+        retention.ARCHIVE_PATH = os.path.join(tmp, "home_archive.sqlite")
+        start = time.perf_counter()
+        await audit.run_all()
+        await retention.run_all()
+        elapsed = time.perf_counter() - start
+        kept = sum(db.club_path(chat_id) in db._clubs for chat_id in hot)
+        print(f"сверка и архив по {touched} клубам за {elapsed:.1f} с: горячих баз открыто {kept} из {len(hot)}, "
+              f"всего открыто {db.open_clubs()}")
+        if kept != len(hot):
+            failures.append(f"фоновый проход вытеснил {len(hot) - kept} горячих баз")
+        if db.open_clubs() > pool_max:
+            failures.append(f"после фонового прохода открыто {db.open_clubs()} баз при лимите {pool_max}")
+        busy_chats = set(chat_ids[5:8])
+        for chat_id in busy_chats:
+            async with db.club(chat_id):
+                await db.change_balance(1, 1, "после прохода", 0)
+            expected[chat_id, 1] += 1
+        again = set(await db.dirty_clubs("audit"))
+        if again != busy_chats:
+            failures.append(f"следующий проход сверки обошёл бы {len(again)} клубов, а писали в {len(busy_chats)}")
+
+        # балансы: каждый чат видит только свои записи
+        wrong = 0
+        for chat_id in chat_ids[:200]:
+            async with db.club(chat_id):
+                for user_id in range(1, USERS_PER_CHAT + 1):
+                    if await db.get_balance(user_id) != expected[chat_id, user_id]:
+                        wrong += 1
+        async with db.club(None):
+            if await db.get_balance(1):
+                failures.append("записи клубов попали в основную базу")
+        if wrong:
+            failures.append(f"{wrong} балансов не сходятся")
+
+        # имена: спрошенные у Telegram в одном чате, другой чат находит в основной базе
+        bot = FakeBot()
+        fetched_in, asked_in = chat_ids[2], chat_ids[3]
+        async with db.club(fetched_in):
+            await names.resolve_names(bot, fetched_in, [901, 902])
+        names._cache.clear()
+        async with db.club(asked_in):
+            await names.resolve_names(bot, asked_in, [901, 902])
+        async with db.club(None):
+            home = await db.get_names([901, 902])
+        async with db.club(fetched_in):
+            local = await db.get_names([901, 902])
+        print(f"имена из Telegram: в основной базе {len(home)}, в базе клуба {len(local)}, "
+              f"запросов getChatMember {bot.calls.get('getChatMember', 0)}")
+        if len(home) != 2 or local or bot.calls.get("getChatMember") != 2:
+            failures.append("имена из Telegram сохранены не в общий справочник основной базы")
+
+        # писатель клуба A занят — клуб B пишет без ожидания
+        busy, free = chat_ids[0], chat_ids[1]
+        held = asyncio.Event()
+
+        async def hold():
+            async with db.club(busy) as pool:
+                async with pool.write():
+                    held.set()
+                    await asyncio.sleep(HOLD)
+
+        holder = asyncio.create_task(hold())
+        await held.wait()
+        start = time.perf_counter()
+        async with db.club(free):
+            await db.change_balance(1, 1, "соседний клуб", 0)
+        other_ms = (time.perf_counter() - start) * 1e3
+        await holder
+        print(f"запись в клуб B, пока писатель клуба A занят {HOLD:.0f} с: {other_ms:.1f} мс")
+        if other_ms > HOLD * 1e3 / 4:
+            failures.append("клуб B ждал писателя клуба A")
+
+    for failure in failures:
+        print("ОШИБКА:", failure)
+    if not failures:
+        print("клубы изолированы, лимит открытых баз соблюдён")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    sys.exit(asyncio.run(main(int(args[0]) if args else 2000, int(args[1]) if len(args) > 1 else 10_000,
+                              int(args[2]) if len(args) > 2 else 32)))
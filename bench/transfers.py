@@ -0,0 +1,54 @@
+# Стресс-проверка атомарных переводов: сотни одновременных transfer/debit_if_sufficient
+# между несколькими участниками. Ни один баланс не должен уйти в минус,
+# а сумма нуаров в клубе — измениться (кроме успешных списаний).
+# Запуск: python -m bench.transfers [число переводов]
+import asyncio
+import random
+import sys
+
+import db
+from bench.common import temp_db
+
+USERS = 20
+START_BALANCE = 50
+
+
+async def _total() -> int:
+    async with db._db().read() as conn:
+        async with conn.execute("SELECT COALESCE(SUM(balance), 0), MIN(balance) FROM users") as cur:
+            return await cur.fetchone()
+
+
+async def main(n: int) -> int:
+    rnd = random.Random(42)
+    async with temp_db("stress.sqlite"):
+        for uid in range(1, USERS + 1):
+            await db.change_balance(uid, START_BALANCE, "сид", 0)
+        before, _ = await _total()
+
+        jobs = []
+        for _ in range(n):
+            a, b = rnd.sample(range(1, USERS + 1), 2)
+            jobs.append(db.transfer(a, b, rnd.randint(1, 40)))
+        jobs += [db.debit_if_sufficient(rnd.randint(1, USERS), rnd.randint(1, 30)) for _ in range(n // 10)]
+        results = await asyncio.gather(*jobs)
+
+        # списания уходят из клуба, их сумму берём из истории
+        async with db._db().read() as conn:
+            async with conn.execute("SELECT COALESCE(-SUM(amount), 0) FROM history "
+                                    "WHERE reason = 'без причины'") as cur:
+                debited = (await cur.fetchone())[0]
+
+        after, min_balance = await _total()
+        ok_transfers = sum(1 for r in results[:n] if r[0])
+        print(f"переводов: {n}, прошло: {ok_transfers}, отказов: {n - ok_transfers}")
+        print(f"сумма до: {before}, после: {after}, списано: {debited}, минимальный баланс: {min_balance}")
+        if min_balance < 0 or before - debited != after:
+            print("НАРУШЕН ИНВАРИАНТ")
+            return 1
+        print("инварианты соблюдены")
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 500)))
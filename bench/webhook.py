@@ -0,0 +1,157 @@
+# Сравнение задержки «обновление -> ответ» для вебхука и long polling при
+# синтетическом всплеске. Telegram подменяется сессией-заглушкой, которая
+# отвечает на каждый вызов API с задержкой API_DELAY; в режиме вебхука
+# обновления POST-ятся в настоящий aiohttp-сервер из webhook.py при разном
+# размере пула воркеров. Очередей по участникам (shards.py) здесь нет: в боте
+# одновременно работают не больше SHARD_WORKERS обработчиков при любом пуле.
+# Запуск: python -m bench.webhook [размер всплеска] [задержка API, мс]
+import asyncio
+import statistics
+import sys
+import time
+
+import aiohttp
+from aiogram import Bot, Dispatcher, F, Router
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Message, Update, User
+from aiohttp import web
+
+import webhook
+from commands import handle_message
+from bench.common import quantiles, temp_db
+
+TOKEN = "42:bench"
+PORT = 18080
+WORKER_COUNTS = (16, 64, 256)
+TEXTS = ("мой карман", "рейтинг клуба", "моя роль", "список команд")  # все отвечают reply
+
+
+class StubSession(BaseSession):
+    # Заглушка Bot API: getUpdates отдаёт очередь, sendMessage отмечает время ответа
+    def __init__(self, api_delay: float):
+        super().__init__()
+        self.api_delay = api_delay
+        self.updates: asyncio.Queue = asyncio.Queue()
+        self.replied: dict[int, float] = {}
+        self.all_replied = asyncio.Event()
+        self.expected = 0
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+    async def make_request(self, bot, method, timeout=None):
+        name = type(method).__name__
+        if name == "GetUpdates":
+            try:
+                first = await asyncio.wait_for(self.updates.get(), method.timeout or 1)
+            except asyncio.TimeoutError:
+                return []
+            batch = [first]
+            while not self.updates.empty() and len(batch) < (method.limit or 100):
+                batch.append(self.updates.get_nowait())
+            await asyncio.sleep(self.api_delay)
+            return [Update.model_validate(u, context={"bot": bot}) for u in batch]
+        await asyncio.sleep(self.api_delay)
+        if name == "GetMe":
+            return User(id=42, is_bot=True, first_name="Archivist")
+        if name == "SendMessage":
+            self.replied[method.reply_to_message_id] = time.perf_counter()
+            if len(self.replied) >= self.expected:
+                self.all_replied.set()
+            return Message.model_validate({
+                "message_id": 10**6 + len(self.replied), "date": 0,
+                "chat": {"id": method.chat_id, "type": "supergroup"},
+            }, context={"bot": bot})
+        return True
+
+
+def _updates(n: int) -> list[dict]:
+    return [{
+        "update_id": i,
+        "message": {
+            "message_id": i, "date": 0, "text": TEXTS[i % len(TEXTS)],
+            "chat": {"id": -100, "type": "supergroup"},
+            "from": {"id": 1000 + i % 300, "is_bot": False, "first_name": f"U{i % 300}"},
+        },
+    } for i in range(1, n + 1)]
+
+
+def _dispatcher() -> Dispatcher:
+    router = Router()
+
+    @router.message(F.text & ~F.from_user.is_bot)
+    async def on_text(message: Message):
+        await handle_message(message)
+
+    dp = Dispatcher()
+    dp.include_router(router)
+    return dp
+
+
+def _report(label: str, sent: dict[int, float], session: StubSession, total: float):
+    lat = sorted((session.replied[i] - sent[i]) * 1e3 for i in sent)
+    q = quantiles(lat)
+    print(f"{label:<11} всего {total * 1e3:8.1f} мс   p50 {q[49]:7.1f}   p95 {q[94]:7.1f}   max {lat[-1]:7.1f} мс")
+
+
+async def _polling(updates: list[dict], api_delay: float):
+    session = StubSession(api_delay)
+    session.expected = len(updates)
+    bot = Bot(TOKEN, session=session)
+    dp = _dispatcher()
+    runner = asyncio.create_task(dp.start_polling(bot, handle_signals=False, close_bot_session=False))
+    await asyncio.sleep(0.2)
+    start = time.perf_counter()
+    sent = {}
+    for update in updates:
+        sent[update["update_id"]] = time.perf_counter()
+        session.updates.put_nowait(update)
+    await session.all_replied.wait()
+    _report("polling", sent, session, time.perf_counter() - start)
+    await dp.stop_polling()
+    await runner
+
+
+async def _webhook(updates: list[dict], api_delay: float, size: int):
+    session = StubSession(api_delay)
+    session.expected = len(updates)
+    bot = Bot(TOKEN, session=session)
+    workers = webhook.UpdateWorkers(_dispatcher(), bot, workers=size)
+    await workers.start()
+    runner = web.AppRunner(webhook.build_app(workers, secret=None))
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", PORT).start()
+
+    sent, acks = {}, []
+    async with aiohttp.ClientSession() as http:
+        async def post(update):
+            sent[update["update_id"]] = t0 = time.perf_counter()
+            async with http.post(f"http://127.0.0.1:{PORT}{webhook.WEBHOOK_PATH}", json=update) as resp:
+                resp.raise_for_status()
+            acks.append((time.perf_counter() - t0) * 1e3)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(post(u) for u in updates))
+        await session.all_replied.wait()
+        total = time.perf_counter() - start
+    _report(f"webhook/{size}", sent, session, total)
+    print(f"{'':<11} подтверждение POST: p50 {statistics.median(acks):.1f} мс, max {max(acks):.1f} мс, "
+          f"воркеров {workers.size}")
+    await runner.cleanup()
+    await workers.stop()
+
+
+async def main(n: int, api_delay_ms: float):
+    updates = _updates(n)
+    async with temp_db("bench.sqlite"):
+        await _polling(updates, api_delay_ms / 1000)
+        for size in WORKER_COUNTS:
+            await _webhook(updates, api_delay_ms / 1000, size)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    asyncio.run(main(int(args[0]) if args else 500, float(args[1]) if len(args) > 1 else 30))
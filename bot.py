@@ -3,8 +3,18 @@ import asyncio
 import logging
 from dotenv import load_dotenv
 
-from commands import handle_message, handle_photo_command
-from db import init_db
+from commands import handle_message, handle_photo_command, resume_kubik_bets, preload_help
+from db import init_db, close_db, profile_cache_stats, open_clubs
+from config import BOT_MODE, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_SECRET, TELEGRAM_API_URL
+from config import METRICS_HOST, METRICS_PORT
+import assets
+import audit
+import metrics
+import outbox
+import retention
+import scheduler
+import stalls
+from shards import UserShards
 
 load_dotenv()
 TOKEN = os.getenv("BOT_TOKEN")
@@ -13,6 +23,22 @@ if not TOKEN:
 
 logging.basicConfig(level=logging.INFO)
 
+# Команды одного участника выполняются по порядку, разных — параллельно и не ждут друг друга
+shards = UserShards()
+# Исходящие сообщения идут в пределах лимитов Telegram, ответы раньше списков
+sender = outbox.Outbox()
+
+# Значения, которые снимаются в момент запроса /metrics
+metrics.gauge("archivist_profile_cache_hits_total", lambda: profile_cache_stats()["hits"], "counter")
+metrics.gauge("archivist_profile_cache_misses_total", lambda: profile_cache_stats()["misses"], "counter")
+metrics.gauge("archivist_profile_cache_size", lambda: profile_cache_stats()["size"])
+metrics.gauge("archivist_shard_queue_depth", lambda: shards.stats()["depth_total"])
+metrics.gauge("archivist_shard_wait_max_seconds", lambda: shards.wait_max)
+metrics.gauge("archivist_scheduled_tasks", scheduler.pending)
+metrics.gauge("archivist_open_clubs", open_clubs)
+metrics.gauge("archivist_outbox_queued", lambda: sender.queued + outbox.pending())
+metrics.gauge("archivist_outbox_sent_total", lambda: sender.sent, "counter")
+
 import aiogram
 AIOMAJOR = int(aiogram.__version__.split(".")[0])
 
@@ -27,10 +53,17 @@ if AIOMAJOR >= 3:
         from aiogram.router import Router
 
     from aiogram.types import Message
-
-    bot = Bot(token=TOKEN)
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+
+    # Свой адрес Bot API: локальный сервер Telegram или заглушка для нагрузочных прогонов
+    session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+    bot = Bot(token=TOKEN, session=session)
+    bot.session.middleware(sender)                  # очередь и лимиты отправки
+    bot.session.middleware(metrics.api_middleware)  # время каждого вызова Telegram API
     dp = Dispatcher()
     router = Router()
+    router.message.middleware(shards)
 
     @router.message(F.photo & F.caption)
     async def on_photo(message: Message):
@@ -41,9 +74,33 @@ if AIOMAJOR >= 3:
         await handle_message(message)
 
     async def main():
+        stalls.start()
         await init_db()
+        await assets.preload()
+        await preload_help()
+        await resume_kubik_bets(bot)
         dp.include_router(router)
-        await dp.start_polling(bot)
+        retention.start()
+        audit.start()
+        metrics_runner = await metrics.start_server(METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
+        try:
+            if BOT_MODE == "webhook":
+                from webhook import run_webhook
+                await run_webhook(dp, bot)
+            else:
+                await bot.delete_webhook()
+                # обновления по одному: пока очереди участников полны, новые не запрашиваются
+                await dp.start_polling(bot, handle_as_tasks=False)
+        finally:
+            await shards.stop()
+            await retention.stop()
+            await audit.stop()
+            await scheduler.shutdown()
+            await outbox.drain()
+            await close_db()
+            await stalls.stop()
+            if metrics_runner:
+                await metrics_runner.cleanup()
 
     if __name__ == "__main__":
         try:
@@ -58,18 +115,50 @@ else:
     from aiogram import Bot, Dispatcher, types
     from aiogram.utils import executor
 
-    bot = Bot(token=TOKEN)
+    if TELEGRAM_API_URL:
+        from aiogram.bot.api import TelegramAPIServer
+        bot = Bot(token=TOKEN, server=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+    else:
+        bot = Bot(token=TOKEN)
     dp = Dispatcher(bot)
 
     @dp.message_handler(content_types=types.ContentTypes.ANY)
     async def fallback_handler(message: types.Message):
         if message.photo and message.caption:
-            await handle_photo_command(message)
+            await shards.submit(message.from_user.id, handle_photo_command, message)
         elif message.text:
-            await handle_message(message)
+            await shards.submit(message.from_user.id, handle_message, message)
 
     async def on_startup(_):
+        # в v2 нет мидлвари сессии: вызовы Telegram API не замеряются
+        stalls.start()
         await init_db()
+        await assets.preload()
+        await preload_help()
+        await resume_kubik_bets(bot)
+        retention.start()
+        audit.start()
+        if METRICS_PORT:
+            await metrics.start_server(METRICS_HOST, METRICS_PORT)
+
+    async def on_shutdown(_):
+        await shards.stop()
+        await retention.stop()
+        await audit.stop()
+        await scheduler.shutdown()
+        await outbox.drain()
+        await close_db()
+        await stalls.stop()
+
+    async def on_startup_webhook(_):
+        await on_startup(_)
+        if WEBHOOK_URL:
+            await bot.set_webhook(WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
 
     if __name__ == "__main__":
-        executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
+        if BOT_MODE == "webhook":
+            # в v2 пул воркеров не ограничивается: executor запускает задачу на каждое обновление
+            executor.start_webhook(dp, WEBHOOK_PATH, on_startup=on_startup_webhook, on_shutdown=on_shutdown,
+                                   skip_updates=True, host=WEBHOOK_HOST, port=WEBHOOK_PORT)
+        else:
+            executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
@@ -0,0 +1,70 @@
+from collections import OrderedDict
+
+from config import PROFILE_CACHE_SIZE
+
+MISSING = object()
+
+# Ограниченный LRU-кэш состояния участников: ключ ("key"), баланс ("balance")
+# и роль ("role" — строка roles или None). Записи в db.py обновляют кэш после
+# коммита, а значения, прочитанные из базы, кладутся только если за время
+# чтения не было ни одной записи (иначе можно закэшировать устаревшее).
+class ProfileCache:
+    def __init__(self, maxsize: int = PROFILE_CACHE_SIZE):
+        self.maxsize = max(1, maxsize)
+        self._data: OrderedDict[int, dict] = OrderedDict()
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int, field: str):
+        entry = self._data.get(user_id)
+        if entry is not None and field in entry:
+            self._data.move_to_end(user_id)
+            self.hits += 1
+            return entry[field]
+        self.misses += 1
+        return MISSING
+
+    def fill(self, user_id: int, field: str, value, version: int):
+        # значение из базы, прочитанное при версии version
+        if version == self.version:
+            self._put(user_id, {field: value})
+
+    def update(self, user_id: int, **fields):
+        self.version += 1
+        self._put(user_id, fields)
+
+    def invalidate(self, user_id: int | None = None, field: str | None = None):
+        self.version += 1
+        if user_id is None:
+            if field is None:
+                self._data.clear()
+            else:
+                for entry in self._data.values():
+                    entry.pop(field, None)
+            return
+        entry = self._data.get(user_id)
+        if entry is not None:
+            if field is None:
+                del self._data[user_id]
+            else:
+                entry.pop(field, None)
+
+    def set_all(self, field: str, value):
+        # массовая запись (например, обнуление всех балансов)
+        self.version += 1
+        for entry in self._data.values():
+            entry[field] = value
+
+    def _put(self, user_id: int, fields: dict):
+        entry = self._data.get(user_id)
+        if entry is None:
+            self._data[user_id] = dict(fields)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        else:
+            entry.update(fields)
+            self._data.move_to_end(user_id)
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
@@ -1,7 +1,9 @@
 import re
 import os
-import sys
+import time
 import asyncio
+import tempfile
+from datetime import datetime, timedelta, timezone
 from aiogram import types
 from aiogram.types import FSInputFile
 
@@ -10,11 +12,48 @@ from db import (
     grant_key, revoke_key, has_key, get_last_history,
     get_top_users, get_all_roles, reset_user_balance,
     reset_all_balances, set_role_image, get_role_with_image,
-    get_key_holders
+    get_key_holders, transfer, debit_if_sufficient,
+    place_bet, set_bet_roll, settle_bet, cancel_bet, get_pending_bets,
+    get_history, reset_club, club, club_chat_ids,
+    bulk_change_balance, get_user_ids_by_usernames,
+    get_balance_at, get_balance_changes
 )
-
-KURATOR_ID = 164059195
-DB_PATH = "/data/bot_data.sqlite"
+from config import CLUB_CURATORS
+from assets import reply_photo as reply_asset_photo
+from export import write_history
+from names import remember, resolve_names
+import metrics
+import outbox
+import retention
+import scheduler
+
+KURATOR_ID = 164059195  # куратор основного клуба; кураторы других чатов — CLUB_CURATORS
+KURATOR_IMAGE = "images/kurator.jpg"
+HELP_PATH = "Список команд.txt"
+
+KUBIK_DELAY = 3.5   # сколько длится анимация кубика, с
+KUBIK_WIN = 6       # выигрышная грань
+KUBIK_PAYOUT = 4    # при выигрыше: ставка из эскроу + ставка x3
+
+RATING_WEEK = 7                    # дней в «рейтинге недели»
+HISTORY_PAGE = 10                  # записей на странице «прошлое»
+DOCUMENT_LIMIT = 50 * 1024 * 1024  # больше бот отправить не может
+EXPORTS_AT_ONCE = 2                # выгрузок истории одновременно; сверх этого — «попробуйте позже»
+
+def kurator_of(chat_id: int) -> int:
+    return CLUB_CURATORS.get(chat_id, KURATOR_ID)
+
+_help_text: str | None = None
+_exports = asyncio.Semaphore(EXPORTS_AT_ONCE)
+
+def _read_text(path: str) -> str:
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+async def preload_help():
+    # список команд читаем с диска один раз (в отдельном потоке), а не на каждый запрос
+    global _help_text
+    _help_text = await asyncio.to_thread(_read_text, HELP_PATH)
 
 def mention_html(user_id: int, fallback: str = "Участник") -> str:
     return f"<a href='tg://user?id={user_id}'>{fallback}</a>"
@@ -23,89 +62,40 @@ async def handle_message(message: types.Message):
     if not message.text:
         return
 
-    text = message.text.lower().strip()
     author_id = message.from_user.id
 
     if message.from_user.is_bot:
         return
 
+    remember(message.from_user)
+    if message.reply_to_message:
+        remember(message.reply_to_message.from_user)
 
-    # --- Команды для всех участников ---
-    match text:
-        case "мой карман":
-            await handle_moy_karman(message)
-            return
-        case "моя роль":
-            await handle_moya_rol(message)
-            return
-        case "роль" if message.reply_to_message:
-            await handle_rol(message)
-            return
-        case "список команд":
-            await handle_list(message)
-            return
-        case "клуб":
-            await handle_klub(message)
-            return
-        case "рейтинг клуба":
-            await handle_rating(message)
-            return
-        case "члены клуба":
-            await handle_club_members(message)
-            return
-        case "хранители ключа":
-            await handle_key_holders(message)
-            return
-        case _ if text.startswith("передать "):
-            await handle_peredat(message)
-            return
-        case _ if text.startswith("ставлю"):
-            await handle_kubik(message)
-            return
+    command = classify(message.text)
+    if command is None:
+        return  # обычная болтовня: ни одного запроса к базе
+    handler, access, needs_reply, args = command
+    if needs_reply and not message.reply_to_message:
+        return
 
-    # --- Проверка ключа ---
-    user_has_key = (author_id == KURATOR_ID) or await has_key(author_id)
+    # --- Проверка прав: только после того, как команда распознана ---
+    kurator_id = kurator_of(message.chat.id)
+    if access == KURATOR and author_id != kurator_id:
+        return
 
-    # --- Команды с ключом ---
-    if user_has_key:
-        if text.startswith(("вручить ", "выдать ")):
-            await handle_vruchit(message)
-            return
-        if text.startswith(("взыскать ", "отнять ")):
-            await handle_otnyat(message, text, author_id)
-            return
-        if text == "карман":
-            await handle_kurator_karman(message)
+    # Данные каждого чата — в его собственной базе
+    async with club(message.chat.id):
+        if access == KEY and author_id != kurator_id and not await has_key(author_id):
             return
 
-    # --- Команды только Куратора ---
-    if author_id == KURATOR_ID:
-        if text.startswith("назначить ") and message.reply_to_message:
-            await handle_naznachit(message)
-            return
-        if text == "снять роль" and message.reply_to_message:
-            await handle_snyat_rol(message)
-            return
-        if text == "ключ от сейфа" and message.reply_to_message:
-            await handle_kluch(message)
-            return
-        if text == "снять ключ" and message.reply_to_message:
-            await handle_snyat_kluch(message)
-            return
-        if text == "обнулить клуб":
-            await asyncio.sleep(1)
-            await handle_clear_db(message)
-            return
-        if text.startswith("обнулить балансы"):
-            await handle_obnulit_balansy(message)
-            return
-        if text.startswith("обнулить баланс"):
-            await handle_obnulit_balans(message)
-            return
+        metrics.inc("archivist_commands_total", command=handler.__name__)
+        with metrics.track("handler", handler.__name__), outbox.priority(
+                outbox.BULK if handler in BULK_OUTPUT else outbox.REPLY):
+            await handler(message, **args)
 
 async def handle_moy_karman(message: types.Message):
     bal = await get_balance(message.from_user.id)
-    await message.reply(f"У Вас в кармане 🪙{bal} нуаров.")
+    outbox.post(message.reply(f"У Вас в кармане 🪙{bal} нуаров."))
 
 async def handle_moya_rol(message: types.Message):
     author_id = message.from_user.id
@@ -119,17 +109,22 @@ async def handle_moya_rol(message: types.Message):
         role_name, role_desc, image_file_id = role_row
         text_response = f"🎭 *{role_name}*\n\n_{role_desc}_"
         if image_file_id:
-            await message.reply_photo(photo=image_file_id, caption=text_response, parse_mode="Markdown")
+            outbox.post(message.reply_photo(photo=image_file_id, caption=text_response, parse_mode="Markdown"))
+        elif author_id == kurator_of(message.chat.id):
+            outbox.post(_reply_kurator_photo(message, text_response))
         else:
-            if author_id == KURATOR_ID and os.path.exists("images/kurator.jpg"):
-                try:
-                    await message.reply_photo(photo=FSInputFile("images/kurator.jpg"), caption=text_response, parse_mode="Markdown")
-                except Exception:
-                    await message.reply(text_response, parse_mode="Markdown")
-            else:
-                await message.reply(text_response, parse_mode="Markdown")
+            outbox.post(message.reply(text_response, parse_mode="Markdown"))
     else:
-        await message.reply("Я вас не узнаю.")
+        outbox.post(message.reply("Я вас не узнаю."))
+
+async def _reply_kurator_photo(message: types.Message, text: str):
+    # Портрет Куратора уходит через очередь отправки; нет картинки или не отправилась — текстом
+    try:
+        sent = await reply_asset_photo(message, KURATOR_IMAGE, caption=text, parse_mode="Markdown")
+    except Exception:
+        sent = None
+    if sent is None:
+        await message.reply(text, parse_mode="Markdown")
 
 async def handle_rol(message: types.Message):
     target_id = message.reply_to_message.from_user.id
@@ -143,14 +138,14 @@ async def handle_rol(message: types.Message):
         role_name, role_desc, image_file_id = role_row
         text_response = f"🎭 *{role_name}*\n\n_{role_desc}_"
         if image_file_id:
-            await message.reply_photo(photo=image_file_id, caption=text_response, parse_mode="Markdown")
+            outbox.post(message.reply_photo(photo=image_file_id, caption=text_response, parse_mode="Markdown"))
         else:
-            await message.reply(text_response, parse_mode="Markdown")
+            outbox.post(message.reply(text_response, parse_mode="Markdown"))
     else:
-        await message.reply("Я не знаю кто это.")
+        outbox.post(message.reply("Я не знаю кто это."))
 
 async def handle_klub(message: types.Message):
-    await message.answer(
+    outbox.post(message.answer(
         "🎩 <b>Клуб Le Cadeau Noir</b>\n"
         "<i>В переводе с французского — «Чёрный подарок»</i>\n\n"
         "🌑 <b>Концепция:</b>\n"
@@ -161,12 +156,13 @@ async def handle_klub(message: types.Message):
         "Всё происходит в атмосфере вежливости, загадочности и утончённого шика.\n"
         "Прямые предложения не приветствуются — всё через намёки, ролевую игру и символы.",
         parse_mode="HTML"
-    )
+    ))
 
 
 async def handle_photo_command(message: types.Message):
+    remember(message.from_user)
     # Только куратор устанавливает фото роли
-    if message.from_user.id != KURATOR_ID:
+    if message.from_user.id != kurator_of(message.chat.id):
         return
     if not (message.caption and message.photo):
         return
@@ -175,61 +171,110 @@ async def handle_photo_command(message: types.Message):
     if text.startswith("фото роли") and message.reply_to_message:
         target_user_id = message.reply_to_message.from_user.id
         photo_id = message.photo[-1].file_id
-        await set_role_image(target_user_id, photo_id)
-        await message.reply("Фото роли обновлено.")
+        metrics.inc("archivist_commands_total", command="handle_photo_command")
+        with metrics.track("handler", "handle_photo_command"):
+            async with club(message.chat.id):
+                await set_role_image(target_user_id, photo_id)
+            outbox.post(message.reply("Фото роли обновлено."))
 
 # --- Ключевые обработчики ---
 
-async def handle_vruchit(message: types.Message):
+async def handle_vruchit(message: types.Message, amount: int | None):
     if message.reply_to_message:
-        m = re.match(r"(?:вручить|выдать)\s+(-?\d+)", message.text.strip(), re.IGNORECASE)
-        if not m:
-            await message.reply("Обращение не по этикету Клуба. Пример: 'вручить|выдать 5'")
+        if amount is None:
+            outbox.post(message.reply("Обращение не по этикету Клуба. Пример: 'вручить|выдать 5'"))
             return
-        amount = int(m.group(1))
         if amount <= 0:
-            await message.reply("Я не могу выдать минус.")
+            outbox.post(message.reply("Я не могу выдать минус."))
             return
         recipient = message.reply_to_message.from_user
         await change_balance(recipient.id, amount, "без причины", message.from_user.id)
-        await message.reply(
+        outbox.post(message.reply(
             f"🧮Я выдал {amount} нуаров {mention_html(recipient.id, recipient.full_name)}",
             parse_mode="HTML"
-        )
+        ))
 
-async def handle_otnyat(message: types.Message, text: str, author_id: int):
+async def handle_otnyat(message: types.Message, amount: int | None):
     if message.reply_to_message:
-        m = re.match(r"(?:взыскать|отнять)\s+(-?\d+)", text, re.IGNORECASE)
-        if not m:
-            await message.reply("Обращение не по этикету Клуба. Пример: 'взыскать|отнять 3'")
+        if amount is None:
+            outbox.post(message.reply("Обращение не по этикету Клуба. Пример: 'взыскать|отнять 3'"))
             return
-        amount = int(m.group(1))
         if amount <= 0:
-            await message.reply("Я не могу отнять минус.")
+            outbox.post(message.reply("Я не могу отнять минус."))
             return
 
         recipient = message.reply_to_message.from_user
-        current_balance = await get_balance(recipient.id)
-        if amount > current_balance:
-            await message.reply(f"У {recipient.full_name} нет такого количества нуаров. Баланс: {current_balance}")
+        ok, current_balance = await debit_if_sufficient(recipient.id, amount, "без причины")
+        if not ok:
+            outbox.post(message.reply(f"У {recipient.full_name} нет такого количества нуаров. Баланс: {current_balance}"))
             return
 
-        await change_balance(recipient.id, -amount, "без причины", author_id)
-        await message.reply(
+        outbox.post(message.reply(
             f"🧮Я взыскал {amount} нуаров у {mention_html(recipient.id, recipient.full_name)}",
             parse_mode="HTML"
-        )
+        ))
+
+async def _bulk_targets(message: types.Message, target: str) -> tuple[list[int], str, list[str]]:
+    # -> (кому, как назвать в ответе, неизвестные @username)
+    lowered = target.lower()
+    if lowered.startswith("хранителям"):
+        return await get_key_holders(), "хранители ключа", []
+    if lowered.startswith("роли "):
+        role = target[5:].strip().strip('"«»')
+        user_ids = [uid for uid, name in await get_all_roles() if name.strip().casefold() == role.casefold()]
+        return user_ids, f"роль «{role}»", []
+    user_ids, usernames = [], []
+    for entity in getattr(message, "entities", None) or []:
+        if entity.type == "text_mention" and entity.user:
+            user_ids.append(entity.user.id)
+        elif entity.type == "mention":
+            usernames.append(entity.extract_from(message.text)[1:])
+    unknown = []
+    if usernames:
+        async with club(None):  # справочник имён общий
+            found = await get_user_ids_by_usernames(usernames)
+        user_ids += [found[name.lower()] for name in usernames if name.lower() in found]
+        unknown = [name for name in usernames if name.lower() not in found]
+    return user_ids, "по упоминаниям", unknown
+
+async def _bulk(message: types.Message, amount: int | None, target: str | None, command: str, sign: int):
+    if amount is None or not target:
+        outbox.post(message.reply(f"Обращение не по этикету Клуба. Пример: '{command} 5 хранителям', "
+                                  f"'{command} 5 роли Бармен', '{command} 5 @имя @имя'"))
+        return
+    if amount <= 0:
+        outbox.post(message.reply("Я не могу раздать минус." if sign > 0 else "Я не могу отнять минус."))
+        return
+    user_ids, label, unknown = await _bulk_targets(message, target.strip())
+    if not user_ids:
+        outbox.post(message.reply(f"Мне некого найти: {label}." if not unknown
+                                  else "Я не знаю " + ", ".join("@" + name for name in unknown)))
+        return
+    done, skipped = await bulk_change_balance(user_ids, sign * amount, "раздача" if sign > 0 else "сбор")
+    if sign > 0:
+        lines = [f"🧮Я выдал по {amount} нуаров {len(done)} участникам ({label})."]
+    else:
+        lines = [f"🧮Я взыскал по {amount} нуаров с {len(done)} участников ({label})."]
+    if skipped:
+        lines.append(f"У {len(skipped)} не хватило нуаров.")
+    if unknown:
+        lines.append("Я не знаю " + ", ".join("@" + name for name in unknown) + ".")
+    outbox.post(message.reply("\n".join(lines)))
+
+async def handle_razdat(message: types.Message, amount: int | None, target: str | None):
+    await _bulk(message, amount, target, "раздать", 1)
+
+async def handle_sobrat(message: types.Message, amount: int | None, target: str | None):
+    await _bulk(message, amount, target, "собрать", -1)
 
-async def handle_naznachit(message: types.Message):
+async def handle_naznachit(message: types.Message, role_name: str | None, role_desc: str | None):
     # Формат: назначить "название роли" описание роли
-    m = re.match(r'назначить\s+"([^"]+)"\s+(.+)', message.text.strip(), re.IGNORECASE)
-    if not m:
-        await message.reply('Я не совсем понял')
+    if role_name is None:
+        outbox.post(message.reply('Я не совсем понял'))
         return
-    role_name, role_desc = m.groups()
 
     if not message.reply_to_message:
-        await message.reply("Кому мне выдать роль, Куратор?")
+        outbox.post(message.reply("Кому мне выдать роль, Куратор?"))
         return
 
     user_id = message.reply_to_message.from_user.id
@@ -237,144 +282,192 @@ async def handle_naznachit(message: types.Message):
     uname = message.reply_to_message.from_user.username
     fname = message.reply_to_message.from_user.full_name
     mention = f"@{uname}" if uname else mention_html(user_id, fname)
-    await message.reply(f"Назначена роль '{role_name}' пользователю {mention}", parse_mode="HTML")
+    outbox.post(message.reply(f"Назначена роль '{role_name}' пользователю {mention}", parse_mode="HTML"))
 
 async def handle_snyat_rol(message: types.Message):
     if not message.reply_to_message:
-        await message.reply("Но кого мне лишить роли, Куратор?")
+        outbox.post(message.reply("Но кого мне лишить роли, Куратор?"))
         return
     user_id = message.reply_to_message.from_user.id
     await set_role(user_id, None, None)
     uname = message.reply_to_message.from_user.username
     fname = message.reply_to_message.from_user.full_name
     mention = f"@{uname}" if uname else mention_html(user_id, fname)
-    await message.reply(f"Роль снята у {mention}", parse_mode="HTML")
+    outbox.post(message.reply(f"Роль снята у {mention}", parse_mode="HTML"))
 
 async def handle_kluch(message: types.Message):
     if not message.reply_to_message:
-        await message.reply("Кому мне выдать ключ, Куратор?")
+        outbox.post(message.reply("Кому мне выдать ключ, Куратор?"))
         return
     user_id = message.reply_to_message.from_user.id
     await grant_key(user_id)
     uname = message.reply_to_message.from_user.username
     fname = message.reply_to_message.from_user.full_name
     mention = f"@{uname}" if uname else mention_html(user_id, fname)
-    await message.reply(f"🗝Ключ от сейфа выдан {mention}", parse_mode="HTML")
+    outbox.post(message.reply(f"🗝Ключ от сейфа выдан {mention}", parse_mode="HTML"))
 
 async def handle_snyat_kluch(message: types.Message):
     if not message.reply_to_message:
-        await message.reply("У кого мне отобрать ключ, Куратор?")
+        outbox.post(message.reply("У кого мне отобрать ключ, Куратор?"))
         return
     user_id = message.reply_to_message.from_user.id
     await revoke_key(user_id)
     uname = message.reply_to_message.from_user.username
     fname = message.reply_to_message.from_user.full_name
     mention = f"@{uname}" if uname else mention_html(user_id, fname)
-    await message.reply(f"🗝Ключ от сейфа отнят у {mention}", parse_mode="HTML")
+    outbox.post(message.reply(f"🗝Ключ от сейфа отнят у {mention}", parse_mode="HTML"))
 
 async def handle_list(message: types.Message):
     try:
-        with open("Список команд.txt", "r", encoding="utf-8") as f:
-            help_text = f.read()
-        await message.reply(help_text)
+        if _help_text is None:
+            await preload_help()
+        outbox.post(message.reply(_help_text))
     except Exception as e:
         print(f"Ошибка при чтении списка команд: {e}")
-        await message.reply("Не удалось загрузить список команд.")
+        outbox.post(message.reply("Не удалось загрузить список команд."))
 
 async def handle_rating(message: types.Message):
     rows = await get_top_users(limit=10)
     if not rows:
-        await message.reply("Ни у кого в клубе нет нуаров.")
+        outbox.post(message.reply("Ни у кого в клубе нет нуаров."))
         return
 
+    names = await resolve_names(message.bot, message.chat.id, [user_id for user_id, _ in rows])
     lines = ["💰 Богатейшие члены клуба Le Cadeau Noir:\n"]
     for i, (user_id, balance) in enumerate(rows, start=1):
-        name = "Участник"
-        try:
-            member = await message.bot.get_chat_member(message.chat.id, user_id)
-            name = member.user.full_name or name
-        except Exception:
-            pass
+        name = names.get(user_id, "Участник")
         lines.append(f"{i}. {mention_html(user_id, name)} — {balance} нуаров")
-    await message.reply("\n".join(lines), parse_mode="HTML")
+    outbox.post(message.reply("\n".join(lines), parse_mode="HTML"))
 
 async def handle_club_members(message: types.Message):
     rows = await get_all_roles()
     if not rows:
-        await message.reply("Пока что в клубе пусто.")
+        outbox.post(message.reply("Пока что в клубе пусто."))
         return
 
+    # как в рейтинге: полные имена берём из справочника имён
+    names = await resolve_names(message.bot, message.chat.id, [user_id for user_id, _ in rows])
     lines = ["🎭 <b>Члены клуба:</b>\n"]
     for user_id, role in rows:
-        # как в рейтинге: пытаемся взять полное имя из текущего чата
-        name = "Участник"
-        try:
-            member = await message.bot.get_chat_member(message.chat.id, user_id)
-            name = member.user.full_name or name
-        except Exception:
-            pass
-
+        name = names.get(user_id, "Участник")
         mention = mention_html(user_id, name)  # кликабельное имя, не @username
         lines.append(f"{mention} — <b>{role}</b>")
 
-    await message.reply("\n".join(lines), parse_mode="HTML")
+    outbox.post(message.reply("\n".join(lines), parse_mode="HTML"))
+
+async def handle_proshloe(message: types.Message, before: int | None):
+    # В ответ на сообщение — прошлое участника, иначе — всего клуба.
+    # Страницы листаются курсором по id: «прошлое до <id>»
+    target = message.reply_to_message.from_user if message.reply_to_message else None
+    rows = await get_history(target.id if target else None, before_id=before, limit=HISTORY_PAGE)
+    if not rows:
+        outbox.post(message.reply("Дальше архив пуст." if before else "Архив пока пуст."))
+        return
+
+    if target:
+        lines = [f"📜 Прошлое {mention_html(target.id, target.full_name)}:\n"]
+        for _, _, _, amount, reason, date in rows:
+            lines.append(f"{str(date)[:16]} — {amount:+d} нуаров ({reason})")
+    else:
+        names = await resolve_names(message.bot, message.chat.id, list({row[1] for row in rows}))
+        lines = ["📜 Прошлое клуба:\n"]
+        for _, user_id, _, amount, reason, date in rows:
+            name = names.get(user_id, "Участник")
+            lines.append(f"{str(date)[:16]} {mention_html(user_id, name)} — {amount:+d} нуаров ({reason})")
+    if len(rows) == HISTORY_PAGE:
+        lines.append(f"\nДальше: <code>прошлое до {rows[-1][0]}</code>")
+    outbox.post(message.reply("\n".join(lines), parse_mode="HTML"))
+
+async def handle_vygruzit(message: types.Message, fmt: str | None):
+    fmt = (fmt or "csv").lower()
+    if _exports.locked():
+        outbox.post(message.reply("📦 Сейчас уже собирается другой архив. Попробуйте чуть позже."))
+        return
+    await _exports.acquire()
+    outbox.post(message.reply("📦 Собираю архив клуба..."))
+    # Выгрузка идёт десятки секунд: она выполняется фоновой задачей, а обработчик
+    # (и очередь сообщений куратора) её не ждёт
+    scheduler.call_at(time.time(), _export_history, message, fmt)
+
+async def _export_history(message: types.Message, fmt: str):
+    # Выполняется после обработчика: база клуба берётся заново.
+    # Файловые операции — в потоке: цикл событий не ждёт диска
+    try:
+        await retention.attach_club_archive(message.chat.id)
+        fd, path = await asyncio.to_thread(tempfile.mkstemp, suffix=f".{fmt}.gz")
+        await asyncio.to_thread(os.close, fd)
+        try:
+            async with club(message.chat.id):
+                count = await write_history(path, fmt)
+            too_big = await asyncio.to_thread(os.path.getsize, path) > DOCUMENT_LIMIT
+        except BaseException:
+            await asyncio.to_thread(os.remove, path)
+            raise
+    finally:
+        _exports.release()
+    if too_big:
+        await asyncio.to_thread(os.remove, path)
+        outbox.post(message.reply("Архив больше 50 МБ — Telegram не даст его отправить."))
+        return
+    filename = f"history-{time.strftime('%Y%m%d')}.{fmt}.gz"
+    outbox.post(_reply_export(message, path, filename, f"🗄 Записей в архиве: {count}"))
+
+async def _reply_export(message: types.Message, path: str, filename: str, caption: str):
+    # Файл уходит через очередь отправки и удаляется, когда отправка закончилась
+    try:
+        await message.reply_document(FSInputFile(path, filename=filename), caption=caption)
+    finally:
+        await asyncio.to_thread(os.remove, path)
 
 async def handle_clear_db(message: types.Message):
-    if message.from_user.id != KURATOR_ID:
-        await message.reply("Только куратор может обнулить клуб.")
+    if message.from_user.id != kurator_of(message.chat.id):
+        outbox.post(message.reply("Только куратор может обнулить клуб."))
         return
     try:
-        await message.reply("🗑Клуб обнуляется...")
-        if os.path.exists(DB_PATH):
-            os.remove(DB_PATH)
-        await message.answer("💢Код Армагедон. Клуб обнулен. Теперь только я и вы, Куратор.")
-        os.execv(sys.executable, [sys.executable] + sys.argv)
+        outbox.post(message.reply("🗑Клуб обнуляется..."))
+        await reset_club()
+        scheduler.call_at(time.time(), retention.purge_club, message.chat.id)  # старую историю дочищаем в фоне
+        outbox.post(message.answer("💢Код Армагедон. Клуб обнулен. Теперь только я и вы, Куратор."))
     except Exception as e:
-        await message.reply(f"Ошибка при обнулении: {e}")
+        outbox.post(message.reply(f"Ошибка при обнулении: {e}"))
 
 async def handle_obnulit_balans(message: types.Message):
     if not message.reply_to_message:
-        await message.reply("Чтобы обнулить баланс, ответь на сообщение участника.")
+        outbox.post(message.reply("Чтобы обнулить баланс, ответь на сообщение участника."))
         return
     user_id = message.reply_to_message.from_user.id
     await reset_user_balance(user_id)
-    await message.reply("✅Баланс участника обнулён.")
+    outbox.post(message.reply("✅Баланс участника обнулён."))
 
 async def handle_obnulit_balansy(message: types.Message):
     await reset_all_balances()
-    await message.reply("✅Все балансы обнулены.")
+    outbox.post(message.reply("✅Все балансы обнулены."))
 
 async def handle_key_holders(message: types.Message):
     user_ids = await get_key_holders()
     if not user_ids:
-        await message.reply("Пока ни у кого нет ключа.")
+        outbox.post(message.reply("Пока ни у кого нет ключа."))
         return
 
+    names = await resolve_names(message.bot, message.chat.id, user_ids)
     lines = ["🗝️ <b>Хранители ключа:</b>\n"]
     for user_id in user_ids:
-        name = "Участник"
-        try:
-            member = await message.bot.get_chat_member(message.chat.id, user_id)
-            name = member.user.full_name or name
-        except Exception:
-            pass
+        name = names.get(user_id, "Участник")
         lines.append(f"{mention_html(user_id, name)}")
-    await message.reply("\n".join(lines), parse_mode="HTML")
+    outbox.post(message.reply("\n".join(lines), parse_mode="HTML"))
 
-async def handle_peredat(message: types.Message):
+async def handle_peredat(message: types.Message, amount: int | None):
     # Команда работает ТОЛЬКО в ответ на сообщение получателя
     if not message.reply_to_message:
-        await message.reply("Чтобы передать нуары, ответьте на сообщение получателя. Пример: 'передать 10'")
+        outbox.post(message.reply("Чтобы передать нуары, ответьте на сообщение получателя. Пример: 'передать 10'"))
         return
 
-    m = re.match(r"передать\s+(\d+)", message.text.strip(), re.IGNORECASE)
-    if not m:
-        await message.reply("Обращение не по этикету Клуба. Пример: 'передать 10'")
+    if amount is None:
+        outbox.post(message.reply("Обращение не по этикету Клуба. Пример: 'передать 10'"))
         return
 
-    amount = int(m.group(1))
     if amount <= 0:
-        await message.reply("Я не могу передать минус.")
+        outbox.post(message.reply("Я не могу передать минус."))
         return
 
     giver_id = message.from_user.id
@@ -383,78 +476,215 @@ async def handle_peredat(message: types.Message):
 
     # Нельзя переводить себе
     if giver_id == recipient_id:
-        await message.reply("Нельзя передать нуары самому себе.")
+        outbox.post(message.reply("Нельзя передать нуары самому себе."))
         return
 
-    # Проверяем баланс дарителя
-    balance = await get_balance(giver_id)
-    if amount > balance:
-        await message.reply(f"У Вас недостаточно нуаров. Баланс: {balance}")
+    # Списываем у дарителя и зачисляем получателю одной транзакцией
+    ok, balance, _ = await transfer(giver_id, recipient_id, amount, "передача")
+    if not ok:
+        outbox.post(message.reply(f"У Вас недостаточно нуаров. Баланс: {balance}"))
         return
 
-    # Списываем у дарителя и зачисляем получателю
-    await change_balance(giver_id, -amount, "передача", giver_id)
-    await change_balance(recipient_id, amount, "передача", giver_id)
-
     giver_name = message.from_user.full_name
     recipient_name = recipient.full_name
 
-    await message.reply(
+    outbox.post(message.reply(
         f"💸Я передал {amount} нуаров от {mention_html(giver_id, giver_name)} к {mention_html(recipient_id, recipient_name)}",
         parse_mode="HTML"
-    )
+    ))
 
 async def handle_kurator_karman(message: types.Message):
     # Работает только в ответ на сообщение
     if not message.reply_to_message:
-        await message.reply("Этикет Клуба требует ответа на сообщение участника.")
+        outbox.post(message.reply("Этикет Клуба требует ответа на сообщение участника."))
         return
 
     target = message.reply_to_message.from_user
     balance = await get_balance(target.id)
 
-    await message.reply(
+    outbox.post(message.reply(
         f"💼 {mention_html(target.id, target.full_name)} хранит в своём кармане {balance} нуаров.",
         parse_mode="HTML"
-    )
+    ))
+
+async def handle_karman_na(message: types.Message, date: str | None):
+    # Баланс участника на конец указанного дня (время в базе — UTC)
+    day = None
+    for fmt in ("%d.%m.%Y", "%Y-%m-%d"):
+        try:
+            day = datetime.strptime(date or "", fmt)
+            break
+        except ValueError:
+            continue
+    if day is None:
+        outbox.post(message.reply("Обращение не по этикету Клуба. Пример: 'Карман на 01.09.2025'"))
+        return
+
+    target = message.reply_to_message.from_user
+    balance = await get_balance_at(target.id, day.strftime("%Y-%m-%d 23:59:59"))
+    if balance is None:
+        outbox.post(message.reply("О том дне у Клуба нет данных: снимков карманов ещё не было или тот день слишком давно."))
+        return
+    outbox.post(message.reply(
+        f"💼 {day:%d.%m.%Y} в кармане {mention_html(target.id, target.full_name)} было {balance} нуаров.",
+        parse_mode="HTML"
+    ))
 
-async def handle_kubik(message: types.Message):
+async def handle_rating_week(message: types.Message):
+    since = datetime.now(timezone.utc) - timedelta(days=RATING_WEEK)
+    rows = await get_balance_changes(since.strftime("%Y-%m-%d %H:%M:%S"), limit=10)
+    if rows is None:
+        outbox.post(message.reply("О начале недели у Клуба нет данных: снимков карманов ещё не было или прошлое уже в архиве."))
+        return
+    if not rows:
+        outbox.post(message.reply("За неделю никто в клубе не разбогател."))
+        return
 
-    m = re.match(r"^\s*ставлю\s+(\d+)\s+на\s+(?:🎲|кубик)\s*$", message.text.strip(), re.IGNORECASE)
-    if not m:
-        await message.reply("Обращение не по этикету Клуба. Пример: 'Ставлю 10 на 🎲|кубик'")
+    names = await resolve_names(message.bot, message.chat.id, [user_id for user_id, _ in rows])
+    lines = ["📈 Кто разбогател за неделю:\n"]
+    for i, (user_id, gain) in enumerate(rows, start=1):
+        name = names.get(user_id, "Участник")
+        lines.append(f"{i}. {mention_html(user_id, name)} — +{gain} нуаров")
+    outbox.post(message.reply("\n".join(lines), parse_mode="HTML"))
+
+async def handle_kubik(message: types.Message, amount: int | None):
+    if amount is None:
+        outbox.post(message.reply("Обращение не по этикету Клуба. Пример: 'Ставлю 10 на 🎲|кубик'"))
         return
 
-    amount = int(m.group(1))
     if amount <= 0:
-        await message.reply("Я не могу принять отрицательную ставку.")
+        outbox.post(message.reply("Я не могу принять отрицательную ставку."))
         return
 
     gambler_id = message.from_user.id
     gambler_name = message.from_user.full_name
 
-    # Проверяем баланс лудика
-    balance = await get_balance(gambler_id)
-    if amount > balance:
-        await message.reply(f"🔍У Вас недостаточно нуаров. Баланс: {balance}")
+    # Списываем ставку в эскроу сразу: параллельные ставки не потратят один баланс дважды
+    ok, balance, bet_id = await place_bet(gambler_id, amount, message.chat.id, message.message_id, gambler_name)
+    if not ok:
+        outbox.post(message.reply(f"🔍У Вас недостаточно нуаров. Баланс: {balance}"))
         return
 
-    # Бросаем кубик сервером Телеграма
-    sent: types.Message = await message.answer_dice(emoji="🎲")
+    # Кубик бросает сервер Телеграма; бросок ждёт своей очереди отправки, а обработчик — нет
+    outbox.post(_roll_kubik(message, bet_id))
+
+async def _roll_kubik(message: types.Message, bet_id: int):
+    # Выполняется в очереди отправки, после обработчика: база клуба берётся заново
+    try:
+        sent: types.Message = await message.answer_dice(emoji="🎲")
+    except Exception:
+        async with club(message.chat.id):
+            await cancel_bet(bet_id)
+        raise
     roll_value = sent.dice.value  # 1..6
 
-    await asyncio.sleep(3.5)
-    if roll_value == 6:
-        await change_balance(gambler_id, amount*3, "ставка", gambler_id)
-        await message.reply(
-            f"🎉Фортуна на вашей стороне,{mention_html(gambler_id, gambler_name)}. Вы получаете 🪙{amount*3} нуаров",
-            parse_mode="HTML"
-        )
+    # Результат объявим, когда закончится анимация
+    settle_at = time.time() + KUBIK_DELAY
+    async with club(message.chat.id):
+        await set_bet_roll(bet_id, roll_value, settle_at)
+    scheduler.call_at(settle_at, settle_kubik, message.bot, message.chat.id, bet_id)
+
+async def settle_kubik(bot, club_id: int | None, bet_id: int):
+    # club_id — чат, в базе которого лежит ставка (None — основная база)
+    async with club(club_id):
+        bet = await settle_bet(bet_id, KUBIK_WIN, KUBIK_PAYOUT)
+    if bet is None:
+        return  # уже рассчитана
+    gambler_id, chat_id, message_id, gambler_name, amount, roll_value = bet
+    gambler_name = gambler_name or "Участник"
+    if roll_value == KUBIK_WIN:
+        text = f"🎉Фортуна на вашей стороне,{mention_html(gambler_id, gambler_name)}. Вы получаете 🪙{amount*3} нуаров"
     else:
-        await change_balance(gambler_id, -amount, "ставка", gambler_id)
-        await message.reply(
-            f"🪦Ставки погубят вас, {mention_html(gambler_id, gambler_name)}. Вы потеряли 🪙{amount} нуаров.",
-            parse_mode="HTML"
-        )
-
+        text = f"🪦Ставки погубят вас, {mention_html(gambler_id, gambler_name)}. Вы потеряли 🪙{amount} нуаров."
+    outbox.post(bot.send_message(chat_id, text, reply_to_message_id=message_id,
+                                 allow_sending_without_reply=True, parse_mode="HTML"))
+
+async def resume_kubik_bets(bot):
+    # После перезапуска: брошенные кубики доигрываем, а не брошенные — возвращаем
+    # клубы обходятся фоном: при запуске кэш открытых баз не заполняется всем каталогом
+    for club_id in [None, *await club_chat_ids()]:
+        async with club(club_id, background=True):
+            for bet_id, roll_value, settle_at in await get_pending_bets():
+                if roll_value is None:
+                    await cancel_bet(bet_id)
+                else:
+                    scheduler.call_at(settle_at, settle_kubik, bot, club_id, bet_id)
+
+# --- Таблица команд ---
+PUBLIC, KEY, KURATOR = "all", "key", "kurator"
+
+# Точные команды: текст -> (обработчик, доступ, нужен ли ответ на сообщение)
+EXACT_COMMANDS = {
+    "мой карман":      (handle_moy_karman, PUBLIC, False),
+    "моя роль":        (handle_moya_rol, PUBLIC, False),
+    "роль":            (handle_rol, PUBLIC, True),
+    "список команд":   (handle_list, PUBLIC, False),
+    "клуб":            (handle_klub, PUBLIC, False),
+    "рейтинг клуба":   (handle_rating, PUBLIC, False),
+    "рейтинг недели":  (handle_rating_week, PUBLIC, False),
+    "члены клуба":     (handle_club_members, PUBLIC, False),
+    "хранители ключа": (handle_key_holders, PUBLIC, False),
+    "карман":          (handle_kurator_karman, KEY, False),
+    "снять роль":      (handle_snyat_rol, KURATOR, True),
+    "ключ от сейфа":   (handle_kluch, KURATOR, True),
+    "снять ключ":      (handle_snyat_kluch, KURATOR, True),
+    "обнулить клуб":   (handle_clear_db, KURATOR, False),
+}
+
+# Команды по началу текста: (имя, шаблон, обработчик, доступ, нужен ли ответ).
+# Группы аргументов называются «<имя>_<аргумент>» и передаются обработчику
+# как <аргумент>; если аргументы не разобрались, приходит None.
+PREFIX_COMMANDS = (
+    ("peredat", r"передать \s*(?P<peredat_amount>\d+)?", handle_peredat, PUBLIC, False),
+    ("kubik", r"ставлю(?:\s+(?P<kubik_amount>\d+)\s+на\s+(?:🎲|кубик)\s*$)?", handle_kubik, PUBLIC, False),
+    ("vruchit", r"(?:вручить|выдать) \s*(?P<vruchit_amount>-?\d+)?", handle_vruchit, KEY, False),
+    ("otnyat", r"(?:взыскать|отнять) \s*(?P<otnyat_amount>-?\d+)?", handle_otnyat, KEY, False),
+    ("razdat", r"раздать(?:\s+(?P<razdat_amount>\d+))?(?:\s+(?P<razdat_target>[\s\S]+))?", handle_razdat, KEY, False),
+    ("sobrat", r"собрать(?:\s+(?P<sobrat_amount>\d+))?(?:\s+(?P<sobrat_target>[\s\S]+))?", handle_sobrat, KEY, False),
+    ("naznachit", r'назначить (?:\s*"(?P<naznachit_role_name>[^"]+)"\s+(?P<naznachit_role_desc>.+))?',
+     handle_naznachit, KURATOR, True),
+    ("karman_na", r"карман на(?:\s+(?P<karman_na_date>\d{1,2}\.\d{1,2}\.\d{4}|\d{4}-\d{2}-\d{2})\s*$)?",
+     handle_karman_na, KEY, True),
+    ("proshloe", r"прошлое(?:\s+до\s+(?P<proshloe_before>\d+))?\s*$", handle_proshloe, KEY, False),
+    ("vygruzit", r"выгрузить историю(?:\s+(?P<vygruzit_fmt>csv|jsonl))?\s*$", handle_vygruzit, KURATOR, False),
+    ("obnulit_balansy", r"обнулить балансы", handle_obnulit_balansy, KURATOR, False),
+    ("obnulit_balans", r"обнулить баланс", handle_obnulit_balans, KURATOR, False),
+)
 
+INT_ARGS = {"amount", "before"}  # аргументы-числа
+INT_MAX = 2**63 - 1  # больше SQLite не хранит: такое число — как не указанное
+
+# Длинный вывод: его отправки уступают очередь ответам на команды
+BULK_OUTPUT = {handle_list, handle_rating, handle_rating_week, handle_club_members,
+               handle_key_holders, handle_proshloe, handle_vygruzit}
+
+# Все префиксы — одна регулярка: текст разбирается за один проход
+PREFIX_RE = re.compile("|".join(f"(?P<{name}>{pattern})" for name, pattern, *_ in PREFIX_COMMANDS),
+                       re.IGNORECASE)
+PREFIX_TABLE = {
+    name: (handler, access, needs_reply,
+           [group for group in re.compile(pattern).groupindex])
+    for name, pattern, handler, access, needs_reply in PREFIX_COMMANDS
+}
+
+def classify(text: str):
+    # -> (обработчик, доступ, нужен ли ответ, аргументы) или None
+    text = text.strip()
+    command = EXACT_COMMANDS.get(text.lower())
+    if command is not None:
+        return (*command, {})
+    m = PREFIX_RE.match(text)
+    if m is None:
+        return None
+    name = m.lastgroup
+    handler, access, needs_reply, groups = PREFIX_TABLE[name]
+    args = {}
+    for group in groups:
+        value = m.group(group)
+        arg = group[len(name) + 1:]
+        if value is not None and arg in INT_ARGS:
+            value = int(value)
+            if not -INT_MAX <= value <= INT_MAX:
+                value = None
+        args[arg] = value
+    return handler, access, needs_reply, args
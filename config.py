@@ -1,2 +1,77 @@
 # config.py
-# Загрузка переменных окружения (токен, ID куратора).
\ No newline at end of file
+# Загрузка переменных окружения (токен, ID куратора).
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- База данных ---
+DB_PATH = os.getenv("DB_PATH", "/data/bot_data.sqlite")
+DB_READERS = int(os.getenv("DB_READERS", "4"))  # размер пула читающих соединений
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")  # sqlite | eventlog (состояние в памяти + журнал, см. eventlog.py)
+EVENTLOG_FLUSH_MS = float(os.getenv("EVENTLOG_FLUSH_MS", "2"))                      # окно пачки перед fsync журнала, мс
+EVENTLOG_COMPACT_BYTES = int(os.getenv("EVENTLOG_COMPACT_BYTES", str(64 * 2**20)))  # журнал больше — сжать в снимок
+
+# --- Групповая фиксация изменений баланса ---
+LEDGER_FLUSH_MS = float(os.getenv("LEDGER_FLUSH_MS", "5"))     # окно накопления пачки, мс
+LEDGER_BATCH_MAX = int(os.getenv("LEDGER_BATCH_MAX", "200"))  # максимум операций в одной транзакции
+
+# --- Кэш профилей участников ---
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "10000"))
+
+# --- Справочник имён участников ---
+NAME_TTL = float(os.getenv("NAME_TTL", "3600"))                        # сколько секунд имя живёт в памяти
+NAME_FETCH_CONCURRENCY = int(os.getenv("NAME_FETCH_CONCURRENCY", "8"))  # параллельных get_chat_member
+
+# --- Приём обновлений ---
+BOT_MODE = os.getenv("BOT_MODE", "polling")                # polling | webhook
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")       # пусто — api.telegram.org; стенд: http://127.0.0.1:8081 (bench/fakeapi.py)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")                     # публичный адрес, напр. https://the-archivist.fly.dev
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")               # проверяется в X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "16"))  # сколько обновлений разом раскладывается по очередям участников
+WEBHOOK_QUEUE = int(os.getenv("WEBHOOK_QUEUE", "1000"))    # сколько принятых обновлений может ждать воркера
+
+# --- Очереди обработки по участникам ---
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "32"))          # столько обработчиков работает одновременно
+SHARD_QUEUE_DEPTH = int(os.getenv("SHARD_QUEUE_DEPTH", "100"))  # сколько сообщений одного участника может ждать; всего — не больше SHARD_WORKERS * это
+
+# --- Метрики (Prometheus) ---
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9091"))  # 0 — не поднимать /metrics
+LOOP_STALL_MS = float(os.getenv("LOOP_STALL_MS", "100"))  # цикл событий стоит дольше — лог со стеком; 0 — не следить
+
+# --- Хранение истории ---
+ARCHIVE_PATH = os.getenv("ARCHIVE_PATH", os.path.join(os.path.dirname(DB_PATH), "bot_archive.sqlite"))
+RETENTION_DAYS = float(os.getenv("RETENTION_DAYS", "90"))           # сколько дней история живёт в основной базе; 0 — вечно
+RETENTION_CHUNK = int(os.getenv("RETENTION_CHUNK", "500"))          # записей за один шаг переноса
+RETENTION_PAUSE_MS = float(os.getenv("RETENTION_PAUSE_MS", "50"))   # пауза между шагами, мс
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "3600"))  # как часто запускать перенос, с
+PURGE_CHUNK = int(os.getenv("PURGE_CHUNK", "5000"))                 # строк стёртой истории за один шаг
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", "21600"))   # как часто снимать балансы, с (0 — не снимать)
+SNAPSHOT_KEEP_DAYS = float(os.getenv("SNAPSHOT_KEEP_DAYS", "90"))    # насколько назад отвечает «карман на дату»; старше — удаляются
+
+# --- Сверка балансов с историей ---
+AUDIT_INTERVAL = float(os.getenv("AUDIT_INTERVAL", "600"))  # как часто сверять, с; 0 — не сверять
+AUDIT_CHUNK = int(os.getenv("AUDIT_CHUNK", "2000"))         # записей истории (или участников) за один шаг
+AUDIT_PAUSE_MS = float(os.getenv("AUDIT_PAUSE_MS", "20"))   # пауза между шагами, мс
+AUDIT_REPAIR = os.getenv("AUDIT_REPAIR", "0") == "1"        # закрывать расхождения записью в истории
+
+# --- Клубы: несколько чатов, у каждого своя база ---
+CLUBS_DIR = os.getenv("CLUBS_DIR", "")                      # пусто — все чаты в одной базе DB_PATH
+HOME_CHAT_ID = int(os.getenv("HOME_CHAT_ID", "0")) or None  # чат, чьи данные остаются в DB_PATH
+CLUB_POOL_MAX = int(os.getenv("CLUB_POOL_MAX", "64"))       # сколько баз клубов держать открытыми
+CLUB_READERS = int(os.getenv("CLUB_READERS", "1"))          # читающих соединений у базы клуба
+CLUB_IDLE = float(os.getenv("CLUB_IDLE", "600"))            # после скольких секунд простоя база клуба закрывается
+# Кураторы клубов: "chat_id:user_id,chat_id:user_id"; где не указан — KURATOR_ID
+CLUB_CURATORS = {int(chat): int(user) for chat, user in
+                 (pair.split(":") for pair in os.getenv("CLUB_CURATORS", "").split(",") if pair.strip())}
+
+# --- Исходящие сообщения: лимиты Telegram ---
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "30"))      # сообщений в секунду на весь бот
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", "1"))           # в секунду в личный чат
+OUTBOX_GROUP_PER_MIN = float(os.getenv("OUTBOX_GROUP_PER_MIN", "20"))  # в минуту в группу
+OUTBOX_BURST = int(os.getenv("OUTBOX_BURST", "3"))                     # сколько подряд можно отправить в чат
+OUTBOX_RETRIES = int(os.getenv("OUTBOX_RETRIES", "3"))                 # повторов после 429
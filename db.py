@@ -1,7 +1,32 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager, nullcontext
+from contextvars import ContextVar
+
 import aiosqlite
 
-DB_PATH = "/data/bot_data.sqlite"
-SCHEMA_VERSION = 1  # при изменении схемы увеличивай это число
+import metrics
+from cache import MISSING, ProfileCache
+from config import DB_PATH, DB_READERS, LEDGER_FLUSH_MS, LEDGER_BATCH_MAX
+from config import CLUBS_DIR, HOME_CHAT_ID, CLUB_POOL_MAX, CLUB_READERS, CLUB_IDLE, STORAGE_BACKEND
+from eventlog import EventLog
+
+# Настройки каждого соединения: WAL позволяет читателям не ждать писателя
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -8000",
+    "PRAGMA mmap_size = 67108864",
+    "PRAGMA foreign_keys = ON",
+)
+# Только писателю: в WAL с NORMAL COMMIT не ждёт fsync, и пачка, о которой уже
+# ответили «записано», может пропасть при отключении питания. Читателям не нужно.
+WRITER_PRAGMAS = ("PRAGMA synchronous = FULL",)
 
 CREATE_USERS = """
 CREATE TABLE IF NOT EXISTS users (
@@ -32,167 +57,1186 @@ CREATE TABLE IF NOT EXISTS history (
 );
 """
 
-EXPECTED_USERS_COLS  = ["user_id", "username", "balance", "key"]
-EXPECTED_ROLES_COLS  = ["user_id", "role_name", "role_desc", "role_image"]
-EXPECTED_HIST_COLS   = ["id", "user_id", "action", "amount", "reason", "date"]
+# Справочник имён: заполняется из входящих сообщений, чтобы списки
+# не спрашивали Telegram про каждого участника
+CREATE_NAMES = """
+CREATE TABLE IF NOT EXISTS names (
+    user_id    INTEGER PRIMARY KEY,
+    full_name  TEXT NOT NULL,
+    username   TEXT,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+# Ставки на кубик, ждущие расчёта: ставка уже списана (эскроу), бросок
+# записывается после ответа Telegram; при старте незавершённые доигрываются
+CREATE_PENDING_BETS = """
+CREATE TABLE IF NOT EXISTS pending_bets (
+    id         INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id    INTEGER NOT NULL,
+    chat_id    INTEGER NOT NULL,
+    message_id INTEGER,
+    user_name  TEXT,
+    amount     INTEGER NOT NULL,
+    roll       INTEGER,
+    settle_at  REAL
+);
+"""
+
+# Служебные значения (отметки фоновых задач и т.п.)
+CREATE_META = """
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Итоги по дням для истории, перенесённой в архив: сумма и число записей
+CREATE_HISTORY_DAILY = """
+CREATE TABLE IF NOT EXISTS history_daily (
+    user_id INTEGER,
+    day     TEXT,
+    amount  INTEGER NOT NULL DEFAULT 0,
+    entries INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, day)
+) WITHOUT ROWID;
+"""
+
+# Загруженные в Telegram локальные картинки: sha256 содержимого -> file_id
+CREATE_ASSETS = """
+CREATE TABLE IF NOT EXISTS assets (
+    sha256     TEXT PRIMARY KEY,
+    path       TEXT,
+    file_id    TEXT NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+# Снимки балансов: все ненулевые балансы на момент снимка. history_id — последняя
+# запись истории, вошедшая в снимок; баланс на момент T = ближайший снимок до T
+# плюс записи истории после него (в истории — фактически применённые изменения).
+CREATE_SNAPSHOTS = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    id         INTEGER PRIMARY KEY,
+    history_id INTEGER NOT NULL,
+    taken_at   TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+CREATE_BALANCE_SNAPSHOTS = """
+CREATE TABLE IF NOT EXISTS balance_snapshots (
+    snap_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    balance INTEGER NOT NULL,
+    PRIMARY KEY (snap_id, user_id)
+) WITHOUT ROWID;
+"""
+
+# Сверка балансов с историей: суммы истории по участникам до отметки meta audit_to.
+# last_id — последняя вошедшая запись участника, checked_id — до какой его сверили.
+CREATE_AUDIT_LEDGER = """
+CREATE TABLE IF NOT EXISTS audit_ledger (
+    user_id    INTEGER PRIMARY KEY,
+    amount     INTEGER NOT NULL DEFAULT 0,
+    last_id    INTEGER NOT NULL DEFAULT 0,
+    checked_id INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+# Архивная история лежит в отдельном файле, подключённом через ATTACH
+CREATE_ARCHIVE_HISTORY = """
+CREATE TABLE IF NOT EXISTS archive.history (
+    id      INTEGER PRIMARY KEY,
+    user_id INTEGER,
+    action  TEXT,
+    amount  INTEGER,
+    reason  TEXT,
+    date    TIMESTAMP
+);
+"""
+
+# Столбцы, которых может не быть в таблицах очень старых версий бота:
+# добавляются на месте через ALTER TABLE ADD COLUMN (таблица не переписывается)
+LEGACY_COLUMNS = {
+    "users": (("username", "TEXT"), ("balance", "INTEGER NOT NULL DEFAULT 0"),
+              ("key", "INTEGER NOT NULL DEFAULT 0")),
+    "roles": (("role_name", "TEXT"), ("role_desc", "TEXT"), ("role_image", "TEXT")),
+    "history": (("action", "TEXT"), ("amount", "INTEGER"), ("reason", "TEXT"), ("date", "TIMESTAMP")),
+}
 
 async def _table_columns(db, table: str):
     async with db.execute(f"PRAGMA table_info({table})") as cur:
         rows = await cur.fetchall()
     return [r[1] for r in rows]  # name is at index 1
 
-async def _schema_ok(db) -> bool:
-    # Проверяем наличие таблиц и состав столбцов
-    for table, expected in (
-        ("users", EXPECTED_USERS_COLS),
-        ("roles", EXPECTED_ROLES_COLS),
-        ("history", EXPECTED_HIST_COLS),
-    ):
-        async with db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,)) as cur:
+async def _add_missing_columns(db):
+    for table, columns in LEGACY_COLUMNS.items():
+        existing = await _table_columns(db, table)
+        for name, definition in columns:
+            if name not in existing:
+                await db.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+
+BALANCE_INDEX = "CREATE INDEX IF NOT EXISTS idx_users_balance ON users(balance) WHERE balance > 0"
+
+# Миграции схемы: номер -> шаги (SQL или async-функция от соединения).
+# Каждая применяется один раз, в своей транзакции вместе с PRAGMA user_version,
+# и ничего не удаляет. Выпущенные миграции не правь — добавляй следующую.
+MIGRATIONS = {
+    1: (CREATE_USERS, CREATE_ROLES, CREATE_HISTORY, _add_missing_columns),
+    2: (CREATE_NAMES, CREATE_PENDING_BETS, CREATE_META),
+    3: (
+        # рейтинг: только ненулевые балансы, по убыванию
+        BALANCE_INDEX,
+        # держатели ключа
+        "CREATE INDEX IF NOT EXISTS idx_users_key ON users(key)",
+        # история конкретного участника
+        "CREATE INDEX IF NOT EXISTS idx_history_user ON history(user_id, id)",
+        # список ролей без пустых
+        "CREATE INDEX IF NOT EXISTS idx_roles_name ON roles(role_name) "
+        "WHERE role_name IS NOT NULL AND TRIM(role_name) != ''",
+        # версия индексов теперь — часть user_version
+        "DELETE FROM meta WHERE key = 'index_version'",
+        "ANALYZE",
+    ),
+    4: (CREATE_HISTORY_DAILY,),
+    5: (CREATE_ASSETS,),
+    # поиск по @username для массовых начислений
+    6: ("CREATE INDEX IF NOT EXISTS idx_names_username ON names(username COLLATE NOCASE)",),
+    7: (
+        CREATE_SNAPSHOTS, CREATE_BALANCE_SNAPSHOTS,
+        "CREATE INDEX IF NOT EXISTS idx_snapshots_taken ON snapshots(taken_at)",
+        "CREATE INDEX IF NOT EXISTS idx_snapshots_history ON snapshots(history_id)",
+        # первый снимок: с этого момента баланс на любую дату точный
+        lambda db: _apply_snapshot(db),
+    ),
+    8: (
+        CREATE_AUDIT_LEDGER,
+        # несверенные участники: после сверки строка выпадает из индекса
+        "CREATE INDEX IF NOT EXISTS idx_audit_unchecked ON audit_ledger(user_id) WHERE last_id > checked_id",
+    ),
+}
+SCHEMA_VERSION = max(MIGRATIONS)
+
+async def _migrate(pool) -> int:
+    # -> версия, с которой стартовали. Если база уже последней версии —
+    # это единственный запрос при старте.
+    async with pool.writer.execute("PRAGMA user_version") as cur:
+        current = (await cur.fetchone())[0]
+    if current == SCHEMA_VERSION:
+        return current
+    if current > SCHEMA_VERSION:
+        raise RuntimeError(f"Версия базы {current} новее, чем знает бот ({SCHEMA_VERSION})")
+    for version in range(current + 1, SCHEMA_VERSION + 1):
+        async with pool.write() as db:
+            for step in MIGRATIONS[version]:
+                if isinstance(step, str):
+                    await db.execute(step)
+                else:
+                    await step(db)
+            await db.execute(f"PRAGMA user_version = {version}")
+        logging.info("База: применена миграция %s", version)
+    return current
+
+# --- Пул соединений ---
+# Одно пишущее соединение и несколько читающих, открытых на всё время работы
+class Pool:
+    def __init__(self, path: str, readers: int = DB_READERS):
+        self.path = path
+        self.size = max(1, readers)
+        self.writer: aiosqlite.Connection | None = None
+        self._readers: asyncio.Queue = asyncio.Queue()
+        self._all: list[aiosqlite.Connection] = []
+        self._write_lock = asyncio.Lock()
+        self.ledger = GroupCommit(self)
+        self.profiles = ProfileCache()
+        self.history_floor = 0  # история с id <= этого стёрта «обнулить клуб» (meta history_floor)
+        self.archive: str | None = None  # подключённый архив истории (attach_archive)
+        self.state: EventLog | None = None  # STORAGE_BACKEND=eventlog: участники, роли и ставки в памяти
+        self.users = 0          # сколько обработчиков сейчас работают с этой базой
+        self.last_used = time.monotonic()
+
+    async def _connect(self, pragmas: tuple = PRAGMAS) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.path)
+        for pragma in pragmas:
+            await conn.execute(pragma)
+        self._all.append(conn)
+        return conn
+
+    async def open(self):
+        self.writer = await self._connect(PRAGMAS + WRITER_PRAGMAS)
+        for _ in range(self.size):
+            self._readers.put_nowait(await self._connect())
+        self.ledger.start()
+
+    @asynccontextmanager
+    async def read(self):
+        if self.state:
+            await self.state.sync()  # база — копия журнала: ждём, пока она догонит принятые изменения
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def write(self):
+        # Транзакции пишущего соединения не должны перемежаться между корутинами
+        async with self._write_lock:
+            await self.writer.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.writer
+            except BaseException:
+                await self.writer.rollback()
+                raise
+            else:
+                await self.writer.commit()
+
+    async def close(self):
+        if self.state:
+            await self.state.close()
+        await self.ledger.stop()
+        for conn in self._all:
+            await conn.close()
+        self._all.clear()
+        self.writer = None
+        self._readers = asyncio.Queue()
+
+
+# Групповая фиксация: операции записи от разных обработчиков копятся в очереди
+# и применяются одной транзакцией раз в LEDGER_FLUSH_MS мс или по LEDGER_BATCH_MAX
+# штук. Каждая операция идёт в своём SAVEPOINT, чтобы ошибка одной не откатывала
+# соседей, а её future выполняется только после COMMIT всей пачки.
+class GroupCommit:
+    def __init__(self, pool: Pool, flush_ms: float = LEDGER_FLUSH_MS, max_ops: int = LEDGER_BATCH_MAX):
+        self.pool = pool
+        self.flush_ms = flush_ms
+        self.max_ops = max(1, max_ops)
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._full = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._closed = False
+
+    def start(self):
+        if self._task is None:
+            self._closed = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # дописываем всё, что успели поставить в очередь, и останавливаемся
+        if self._task is None:
+            return
+        self._closed = True
+        self._queue.put_nowait(None)
+        self._full.set()
+        await self._task
+        self._task = None
+
+    async def submit(self, op):
+        # op: async-функция, принимающая соединение и возвращающая результат
+        if self._task is None or self._closed:
+            raise RuntimeError("База не открыта: сначала вызови init_db()")
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((op, fut))
+        if self._queue.qsize() >= self.max_ops:
+            self._full.set()
+        return await fut
+
+    def _drain(self, batch: list) -> list:
+        while len(batch) < self.max_ops and not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is None:
+                # сигнал остановки обработаем после этой пачки
+                self._queue.put_nowait(None)
+                break
+            batch.append(item)
+        return batch
+
+    async def _run(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            if self.flush_ms > 0 and self._queue.qsize() + 1 < self.max_ops:
+                self._full.clear()
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.flush_ms / 1000)
+                except asyncio.TimeoutError:
+                    pass
+            await self._flush(self._drain([item]))
+
+    async def _flush(self, batch: list):
+        results = []
+        try:
+            async with self.pool.write() as db:
+                for op, fut in batch:
+                    await db.execute("SAVEPOINT op")
+                    try:
+                        result = await op(db)
+                    except Exception as e:
+                        await db.execute("ROLLBACK TO op")
+                        results.append((fut, e, None))
+                    else:
+                        results.append((fut, None, result))
+                    await db.execute("RELEASE op")
+        except Exception as e:
+            # COMMIT не прошёл — вся пачка считается непримененной
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for fut, err, result in results:
+            if fut.done():
+                continue
+            if err is not None:
+                fut.set_exception(err)
+            else:
+                fut.set_result(result)
+
+
+_pool: Pool | None = None  # основная база (DB_PATH)
+
+# Клубы: у каждого чата своя база (CLUBS_DIR/<chat_id>.sqlite) со своим писателем,
+# очередью записи и кэшем. Базы открываются при первом сообщении из чата и
+# закрываются, когда открытых больше CLUB_POOL_MAX или база простаивает CLUB_IDLE.
+# Текущий клуб хранится в contextvar, поэтому функции ниже не принимают chat_id.
+# Общее для всего бота (имена, file_id картинок) живёт в основной базе: club(None).
+_clubs: OrderedDict[str, Pool] = OrderedDict()  # путь -> открытая база, LRU
+_opening: dict[str, asyncio.Task] = {}
+_waiting: dict[str, int] = {}  # путь -> сколько club() ждут открытия этой базы
+_closing: dict[str, asyncio.Task] = {}  # путь -> закрытие вытесненной базы в фоне (checkpoint WAL)
+_current: ContextVar[Pool | None] = ContextVar("club_pool", default=None)
+# Фоновые обходы клубов (архив, сверка) идут только по клубам, где после их прошлого
+# прохода работали обработчики: обход -> отмеченные чаты (dirty_clubs)
+_dirty: dict[str, set] = {}
+
+def _db() -> Pool:
+    pool = _current.get() or _pool
+    if pool is None:
+        raise RuntimeError("База не открыта: сначала вызови init_db()")
+    return pool
+
+def club_path(chat_id: int | None) -> str:
+    if not CLUBS_DIR or chat_id is None or chat_id == HOME_CHAT_ID:
+        return DB_PATH
+    return os.path.join(CLUBS_DIR, f"{chat_id}.sqlite")
+
+async def club_chat_ids() -> list[int]:
+    # чаты, у которых уже есть своя база (каталог читается в потоке)
+    if not CLUBS_DIR:
+        return []
+    names = await asyncio.to_thread(lambda: os.listdir(CLUBS_DIR) if os.path.isdir(CLUBS_DIR) else [])
+    return [int(name[:-7]) for name in names if name.endswith(".sqlite") and name[:-7].lstrip("-").isdigit()]
+
+def open_clubs() -> int:
+    return len(_clubs)
+
+async def _open_pool(path: str, readers: int) -> Pool:
+    pool = Pool(path, readers)
+    await pool.open()
+    try:
+        await _migrate(pool)
+        async with pool.writer.execute("SELECT value FROM meta WHERE key = 'history_floor'") as cur:
             row = await cur.fetchone()
-        if not row:
-            return False
-        cols = await _table_columns(db, table)
-        if cols != expected:  # важен и порядок, и наличие столбцов
-            return False
-    return True
+        pool.history_floor = int(row[0]) if row else 0
+        mark = await _meta_int(pool.writer, "eventlog_seq")
+        if STORAGE_BACKEND == "eventlog":
+            pool.state = EventLog(path, _projector(pool))
+            await pool.state.open(mark, lambda: _load_state(pool.writer))
+        elif mark is not None:
+            # база меняется мимо журнала: при возврате на eventlog состояние возьмётся из неё
+            async with pool.write() as db:
+                await db.execute("DELETE FROM meta WHERE key = 'eventlog_seq'")
+    except BaseException:
+        await pool.close()
+        raise
+    return pool
 
-async def _recreate_all(db):
-    await db.execute("DROP TABLE IF EXISTS history")
-    await db.execute("DROP TABLE IF EXISTS roles")
-    await db.execute("DROP TABLE IF EXISTS users")
+def _close_club(path: str, pool: Pool):
+    del _clubs[path]
+    task = _closing[path] = asyncio.create_task(pool.close())
 
-    await db.execute(CREATE_USERS)
-    await db.execute(CREATE_ROLES)
-    await db.execute(CREATE_HISTORY)
+    def done(_):
+        if _closing.get(path) is task:
+            del _closing[path]
+    task.add_done_callback(done)
 
-    await db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
-    await db.commit()
+def _over() -> bool:
+    return len(_clubs) + len(_opening) > CLUB_POOL_MAX
 
-async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Включаем foreign keys на всякий
-        await db.execute("PRAGMA foreign_keys = ON")
-        # Узнаём текущую версию
-        async with db.execute("PRAGMA user_version") as cur:
+def _evict():
+    # закрываем простаивающие базы и лишние сверх CLUB_POOL_MAX (самые давние первыми)
+    now = time.monotonic()
+    for path, pool in list(_clubs.items()):
+        over = _over()  # _opening: и эта база тоже
+        if pool.users == 0 and (over or now - pool.last_used > CLUB_IDLE):
+            _close_club(path, pool)
+
+async def _open_club(path: str, background: bool) -> Pool:
+    try:
+        if not background:
+            _evict()
+        closing = _closing.get(path)
+        if closing is not None:
+            # база ещё закрывается: второй Pool (и второй журнал событий) на тот же файл не открываем
+            await asyncio.gather(asyncio.shield(closing), return_exceptions=True)
+        await asyncio.to_thread(os.makedirs, os.path.dirname(path) or ".", exist_ok=True)
+        pool = await _open_pool(path, CLUB_READERS)
+    finally:
+        waiting = _waiting.pop(path, 0)
+    # ждущие club() учитываются до того, как база станет видна _evict
+    pool.users += waiting
+    _clubs[path] = pool
+    if background:
+        _clubs.move_to_end(path, last=False)  # фоновый обход не вытесняет горячие базы
+    return pool
+
+async def _club_pool(path: str, background: bool = False) -> Pool:
+    # -> открытая база, в pool.users уже учтён вызывающий
+    pool = _clubs.get(path)
+    if pool is not None:
+        if not background:
+            _clubs.move_to_end(path)
+        pool.users += 1
+        return pool
+    # одновременные первые сообщения из чата открывают базу один раз
+    task = _opening.get(path)
+    if task is None:
+        task = _opening[path] = asyncio.create_task(_open_club(path, background))
+        task.add_done_callback(lambda _: _opening.pop(path, None))
+    _waiting[path] = _waiting.get(path, 0) + 1
+    try:
+        pool = await asyncio.shield(task)
+    except asyncio.CancelledError:
+        # перестали ждать: снимаем свой учёт там, где он уже лежит
+        if not task.done():
+            _waiting[path] -= 1
+        elif not task.cancelled() and task.exception() is None:
+            task.result().users -= 1
+        raise
+    if not background:
+        _clubs.move_to_end(path)
+    return pool
+
+def _mark_dirty(chat_id: int | None):
+    for chats in _dirty.values():
+        chats.add(chat_id)
+
+async def dirty_clubs(name: str) -> list[int | None]:
+    # Клубы, где после прошлого вызова с тем же name работали обработчики (None — основная база).
+    # Первый вызов отдаёт все клубы: что в них было до запуска, неизвестно
+    if name not in _dirty:
+        _dirty[name] = set()
+        return [None, *await club_chat_ids()]
+    chats, _dirty[name] = _dirty[name], set()
+    return list(chats)
+
+@asynccontextmanager
+async def club(chat_id: int | None, background: bool = False):
+    # async with club(message.chat.id): ... — все вызовы db.py внутри идут в базу этого чата.
+    # background=True — для фоновых обходов (архив, сверка): база не поднимается в LRU,
+    # открытая ради обхода закрывается сразу, если открытых больше CLUB_POOL_MAX,
+    # и клуб не отмечается как изменённый (dirty_clubs)
+    if _pool is None:
+        raise RuntimeError("База не открыта: сначала вызови init_db()")
+    path = club_path(chat_id)
+    if path == _pool.path:
+        chat_id, pool = None, _pool
+        pool.users += 1
+    else:
+        opened = path not in _clubs and path not in _opening
+        pool = await _club_pool(path, background)
+    token = _current.set(pool)
+    try:
+        yield pool
+    finally:
+        _current.reset(token)
+        pool.users -= 1
+        pool.last_used = time.monotonic()
+        if not background:
+            _mark_dirty(chat_id)
+        elif pool is not _pool and opened and pool.users == 0 and _clubs.get(path) is pool and _over():
+            _close_club(path, pool)
+
+async def _cached(user_id: int, field: str, query: str, convert):
+    # Чтение через кэш профилей: при промахе — один SELECT и заполнение кэша
+    pool = _db()
+    value = pool.profiles.get(user_id, field)
+    if value is not MISSING:
+        return value
+    version = pool.profiles.version
+    async with pool.read() as db:
+        async with db.execute(query, (user_id,)) as cur:
             row = await cur.fetchone()
-        current_ver = row[0] if row else 0
+    value = convert(row)
+    pool.profiles.fill(user_id, field, value, version)
+    return value
 
-        # Создаём таблицы (если их нет)
-        await db.execute(CREATE_USERS)
-        await db.execute(CREATE_ROLES)
-        await db.execute(CREATE_HISTORY)
-        await db.commit()
+def profile_cache_stats() -> dict:
+    return _db().profiles.stats()
 
-        # Если версия не совпадает или таблицы «битые» — пересобираем
-        if current_ver != SCHEMA_VERSION or not await _schema_ok(db):
-            await _recreate_all(db)
+async def init_db():
+    global _pool
+    if _pool is not None:
+        return
+    _pool = await _open_pool(DB_PATH, DB_READERS)
+
+async def close_db():
+    global _pool
+    while _clubs:
+        _, pool = _clubs.popitem()
+        await pool.close()
+    await asyncio.gather(*_closing.values(), return_exceptions=True)
+    if _pool is not None:
+        pool, _pool = _pool, None
+        await pool.close()
 
 # --- Баланс ---
+@metrics.timed("db")
 async def get_balance(user_id: int) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
+    state = _db().state
+    if state:
+        return state.balance(user_id)
+    return await _cached(user_id, "balance", "SELECT balance FROM users WHERE user_id = ?",
+                         lambda row: row[0] if row else 0)
+
+async def _apply_balance(db, user_id: int, amount: int, reason: str) -> int:
+    # гарантируем наличие пользователя; баланс не уходит ниже нуля
+    await db.execute("INSERT INTO users (user_id, username, balance, key) VALUES (?, NULL, 0, 0) "
+                     "ON CONFLICT(user_id) DO NOTHING", (user_id,))
+    applied = amount
+    if amount < 0:
+        # в историю пишем то, что реально списано: баланс упирается в ноль
         async with db.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,)) as cur:
-            row = await cur.fetchone()
-            return row[0] if row else 0
+            applied = max(amount, -(await cur.fetchone())[0])
+    async with db.execute("UPDATE users SET balance = balance + ? WHERE user_id = ? RETURNING balance",
+                          (applied, user_id)) as cur:
+        row = await cur.fetchone()
+    await db.execute(
+        "INSERT INTO history (user_id, action, amount, reason) VALUES (?, ?, ?, ?)",
+        (user_id, 'change_balance', applied, reason)
+    )
+    return row[0]
 
-async def change_balance(user_id: int, amount: int, reason: str, author_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        # гарантируем наличие пользователя
+@metrics.timed("db")
+async def change_balance(user_id: int, amount: int, reason: str, author_id: int) -> int:
+    # Запись уходит в групповую фиксацию; возвращаемся, когда пачка закоммичена
+    pool = _db()
+    if pool.state:
+        return await pool.state.change_balance(user_id, amount, reason)
+    balance = await pool.ledger.submit(lambda db: _apply_balance(db, user_id, amount, reason))
+    pool.profiles.update(user_id, balance=balance)
+    return balance
+
+async def _apply_debit(db, user_id: int, amount: int, reason: str) -> tuple[bool, int]:
+    # списываем только если хватает: условие проверяется самим UPDATE
+    async with db.execute("UPDATE users SET balance = balance - ? WHERE user_id = ? AND balance >= ? RETURNING balance",
+                          (amount, user_id, amount)) as cur:
+        row = await cur.fetchone()
+    if row is None:
         async with db.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,)) as cur:
             row = await cur.fetchone()
-        if row is None:
-            await db.execute("INSERT INTO users (user_id, username, balance, key) VALUES (?, ?, ?, ?)",
-                             (user_id, None, 0, 0))
-            current_balance = 0
-        else:
-            current_balance = row[0]
+        return False, row[0] if row else 0
+    await db.execute(
+        "INSERT INTO history (user_id, action, amount, reason) VALUES (?, ?, ?, ?)",
+        (user_id, 'change_balance', -amount, reason)
+    )
+    return True, row[0]
+
+@metrics.timed("db")
+async def debit_if_sufficient(user_id: int, amount: int, reason: str = "без причины") -> tuple[bool, int]:
+    # (списано ли, баланс после операции)
+    pool = _db()
+    if pool.state:
+        return await pool.state.debit_if_sufficient(user_id, amount, reason)
+    ok, balance = await pool.ledger.submit(lambda db: _apply_debit(db, user_id, amount, reason))
+    pool.profiles.update(user_id, balance=balance)
+    return ok, balance
+
+async def _balances(db, user_ids: list[int]) -> dict[int, int]:
+    balances = {}
+    for i in range(0, len(user_ids), 500):  # держимся ниже лимита переменных SQLite
+        chunk = user_ids[i:i + 500]
+        marks = ",".join("?" * len(chunk))
+        async with db.execute(f"SELECT user_id, balance FROM users WHERE user_id IN ({marks})", chunk) as cur:
+            balances.update(await cur.fetchall())
+    return balances
+
+async def _apply_bulk(db, user_ids: list[int], amount: int, reason: str) -> tuple[dict[int, int], dict[int, int]]:
+    # зачисление (amount > 0) всем; списание — только тем, у кого хватает
+    before = await _balances(db, user_ids)
+    if amount > 0:
+        await db.executemany("INSERT INTO users (user_id, username, balance, key) VALUES (?, NULL, 0, 0) "
+                             "ON CONFLICT(user_id) DO NOTHING", ((uid,) for uid in user_ids if uid not in before))
+        applied = user_ids
+    else:
+        applied = [uid for uid in user_ids if before.get(uid, 0) >= -amount]
+    await db.executemany("UPDATE users SET balance = balance + ? WHERE user_id = ?", ((amount, uid) for uid in applied))
+    await db.executemany("INSERT INTO history (user_id, action, amount, reason) VALUES (?, 'change_balance', ?, ?)",
+                         ((uid, amount, reason) for uid in applied))
+    done = {uid: before.get(uid, 0) + amount for uid in applied}
+    skipped = {uid: before.get(uid, 0) for uid in user_ids if uid not in done}
+    return done, skipped
+
+@metrics.timed("db")
+async def bulk_change_balance(user_ids: list[int], amount: int, reason: str) -> tuple[dict[int, int], dict[int, int]]:
+    # Начисление или списание многим одной транзакцией:
+    # -> ({user_id: баланс после} для прошедших, {user_id: баланс} для тех, кому не хватило)
+    pool = _db()
+    user_ids = list(dict.fromkeys(user_ids))
+    if pool.state:
+        return await pool.state.bulk_change_balance(user_ids, amount, reason)
+    done, skipped = await pool.ledger.submit(lambda db: _apply_bulk(db, user_ids, amount, reason))
+    for user_id, balance in done.items():
+        pool.profiles.update(user_id, balance=balance)
+    return done, skipped
 
-        new_balance = current_balance + amount
-        if new_balance < 0:
-            new_balance = 0
+async def _apply_transfer(db, from_id: int, to_id: int, amount: int, reason: str) -> tuple[bool, int, int | None]:
+    ok, from_balance = await _apply_debit(db, from_id, amount, reason)
+    if not ok:
+        return False, from_balance, None
+    to_balance = await _apply_balance(db, to_id, amount, reason)
+    return True, from_balance, to_balance
 
-        await db.execute("UPDATE users SET balance = ? WHERE user_id = ?", (new_balance, user_id))
-        await db.execute(
-            "INSERT INTO history (user_id, action, amount, reason) VALUES (?, ?, ?, ?)",
-            (user_id, 'change_balance', amount, reason)
-        )
-        await db.commit()
+@metrics.timed("db")
+async def transfer(from_id: int, to_id: int, amount: int, reason: str = "передача") -> tuple[bool, int, int | None]:
+    # Списание и зачисление в одной транзакции: (прошёл ли перевод, баланс отправителя, баланс получателя)
+    pool = _db()
+    if pool.state:
+        return await pool.state.transfer(from_id, to_id, amount, reason)
+    ok, from_balance, to_balance = await pool.ledger.submit(
+        lambda db: _apply_transfer(db, from_id, to_id, amount, reason))
+    pool.profiles.update(from_id, balance=from_balance)
+    if ok:
+        pool.profiles.update(to_id, balance=to_balance)
+    return ok, from_balance, to_balance
 
+@metrics.timed("db")
 async def reset_user_balance(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE users SET balance = 0 WHERE user_id = ?", (user_id,))
-        await db.commit()
+    # через пачку баланса: обнуление встаёт в общую очередь после уже принятых изменений
+    async def op(db):
+        async with db.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,)) as cur:
+            row = await cur.fetchone()
+        if row and row[0]:
+            await db.execute("UPDATE users SET balance = 0 WHERE user_id = ?", (user_id,))
+            await db.execute("INSERT INTO history (user_id, action, amount, reason) "
+                             "VALUES (?, 'reset_balance', ?, 'обнуление баланса')", (user_id, -row[0]))
+    pool = _db()
+    if pool.state:
+        return await pool.state.reset_user_balance(user_id)
+    await pool.ledger.submit(op)
+    pool.profiles.update(user_id, balance=0)
 
+@metrics.timed("db")
 async def reset_all_balances():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE users SET balance = 0")
-        await db.commit()
+    async def op(db):
+        # Частичный индекс по балансу дешевле пересобрать, чем обновлять на каждую строку:
+        # после обнуления он пуст. Балансы не бывают отрицательными, так что трогаем только ненулевые.
+        await db.execute("INSERT INTO history (user_id, action, amount, reason) "
+                         "SELECT user_id, 'reset_balance', -balance, 'обнуление балансов' FROM users WHERE balance > 0")
+        await db.execute("DROP INDEX IF EXISTS idx_users_balance")
+        await db.execute("UPDATE users SET balance = 0 WHERE balance > 0")
+        await db.execute(BALANCE_INDEX)
+        # пустой снимок (все нули): запросам на момент времени не нужно перебирать записи обнуления
+        await _apply_snapshot(db)
+    pool = _db()
+    if pool.state:
+        return await pool.state.reset_all_balances()
+    await pool.ledger.submit(op)
+    pool.profiles.set_all("balance", 0)
+
+# Что стирает «обнулить клуб»: справочник имён, загруженные картинки и служебные
+# отметки остаются. DELETE без WHERE SQLite выполняет усечением таблицы.
+CLUB_TABLES = ("users", "roles", "history_daily", "pending_bets", "snapshots", "balance_snapshots",
+               "audit_ledger")
+
+@metrics.timed("db")
+async def reset_club():
+    # Одна транзакция в общей очереди записи: база остаётся открытой, обработчики работают.
+    # История (основная и архивная) не удаляется сразу — её отсекает граница history_floor,
+    # а сами строки потом стирает purge_history небольшими шагами.
+    pool = _db()
+    if pool.state:
+        await pool.state.reset_club()
+        await pool.state.sync()  # history_floor ставит перенос записи в базу
+        return
+    pool.history_floor = await pool.ledger.submit(_apply_reset_club)
+    pool.profiles.invalidate()
+
+async def _apply_reset_club(db) -> int:
+    for table in CLUB_TABLES:
+        await db.execute(f"DELETE FROM main.{table}")
+    async with db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'history'") as cur:
+        row = await cur.fetchone()
+    floor = row[0] if row else 0
+    await db.execute("INSERT INTO meta (key, value) VALUES ('history_floor', ?) "
+                     "ON CONFLICT(key) DO UPDATE SET value = excluded.value", (str(floor),))
+    await _apply_snapshot(db)  # пустой клуб — точка отсчёта для балансов на момент времени
+    return floor
+
+@metrics.timed("db")
+async def purge_history(limit: int = 5000) -> int:
+    # Стирает до limit строк истории ниже history_floor (основной и архивной) -> сколько стёрто
+    pool = _db()
+    deleted = 0
+    async with pool.write() as db:
+        async with db.execute("PRAGMA database_list") as cur:
+            schemas = [row[1] for row in await cur.fetchall() if row[1] in ("main", "archive")]
+        for schema in schemas:
+            async with db.execute(f"""
+                DELETE FROM {schema}.history WHERE id IN (
+                    SELECT id FROM {schema}.history WHERE id <= ? ORDER BY id LIMIT ?)
+            """, (pool.history_floor, limit - deleted)) as cur:
+                deleted += cur.rowcount
+            if deleted >= limit:
+                break
+    return deleted
 
 # --- Роли ---
+@metrics.timed("db")
 async def set_role(user_id: int, role_name: str | None, role_desc: str | None):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
+    pool = _db()
+    if pool.state:
+        return await pool.state.set_role(user_id, role_name, role_desc)
+    async with pool.write() as db:
+        async with db.execute("""
             INSERT INTO roles (user_id, role_name, role_desc, role_image)
             VALUES (?, ?, ?, COALESCE((SELECT role_image FROM roles WHERE user_id=?), NULL))
             ON CONFLICT(user_id) DO UPDATE SET role_name=excluded.role_name, role_desc=excluded.role_desc
-        """, (user_id, role_name, role_desc, user_id))
-        await db.commit()
+            RETURNING role_name, role_desc, role_image
+        """, (user_id, role_name, role_desc, user_id)) as cur:
+            row = await cur.fetchone()
+    pool.profiles.update(user_id, role=tuple(row))
 
+@metrics.timed("db")
 async def get_role(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT role_name, role_desc FROM roles WHERE user_id = ?", (user_id,)) as cur:
-            row = await cur.fetchone()
-            if row:
-                return {"role": row[0], "description": row[1]}
-            return None
+    row = await get_role_with_image(user_id)
+    if row:
+        return {"role": row[0], "description": row[1]}
+    return None
 
+@metrics.timed("db")
 async def set_role_image(user_id: int, image_file_id: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
+    pool = _db()
+    if pool.state:
+        return await pool.state.set_role_image(user_id, image_file_id)
+    async with pool.write() as db:
+        async with db.execute("""
             INSERT INTO roles (user_id, role_name, role_desc, role_image)
             VALUES (?, NULL, NULL, ?)
             ON CONFLICT(user_id) DO UPDATE SET role_image = excluded.role_image
-        """, (user_id, image_file_id))
-        await db.commit()
+            RETURNING role_name, role_desc, role_image
+        """, (user_id, image_file_id)) as cur:
+            row = await cur.fetchone()
+    pool.profiles.update(user_id, role=tuple(row))
 
+@metrics.timed("db")
 async def get_role_with_image(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT role_name, role_desc, role_image FROM roles WHERE user_id = ?", (user_id,)) as cur:
-            row = await cur.fetchone()
-            return row  # (role_name, role_desc, role_image) или None
+    # (role_name, role_desc, role_image) или None
+    state = _db().state
+    if state:
+        return state.role(user_id)
+    return await _cached(user_id, "role", "SELECT role_name, role_desc, role_image FROM roles WHERE user_id = ?",
+                         lambda row: tuple(row) if row else None)
 
 # --- Ключи ---
+@metrics.timed("db")
 async def grant_key(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    pool = _db()
+    if pool.state:
+        return await pool.state.set_key(user_id, True)
+    async with pool.write() as db:
         await db.execute("""
             INSERT INTO users (user_id, username, balance, key)
             VALUES (?, NULL, 0, 1)
             ON CONFLICT(user_id) DO UPDATE SET key = 1
         """, (user_id,))
-        await db.commit()
+    pool.profiles.update(user_id, key=True)
 
+@metrics.timed("db")
 async def revoke_key(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    pool = _db()
+    if pool.state:
+        return await pool.state.set_key(user_id, False)
+    async with pool.write() as db:
         await db.execute("UPDATE users SET key = 0 WHERE user_id = ?", (user_id,))
-        await db.commit()
+    pool.profiles.update(user_id, key=False)
 
+@metrics.timed("db")
 async def has_key(user_id: int) -> bool:
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT key FROM users WHERE user_id = ?", (user_id,)) as cur:
-            row = await cur.fetchone()
-            return bool(row and row[0] == 1)
+    state = _db().state
+    if state:
+        return state.has_key(user_id)
+    return await _cached(user_id, "key", "SELECT key FROM users WHERE user_id = ?",
+                         lambda row: bool(row and row[0] == 1))
 
 # --- История/Топ/Роли списка ---
+@metrics.timed("db")
 async def get_last_history(limit: int = 5):
-    async with aiosqlite.connect(DB_PATH) as db:
+    pool = _db()
+    async with pool.read() as db:
         async with db.execute("""
             SELECT user_id, action, amount, reason, date
-            FROM history ORDER BY id DESC LIMIT ?
-        """, (limit,)) as cur:
+            FROM history WHERE id > ? ORDER BY id DESC LIMIT ?
+        """, (pool.history_floor, limit)) as cur:
+            return await cur.fetchall()
+
+# --- История: постранично по id (keyset), без OFFSET ---
+MAX_ID = 2**63 - 1
+
+@metrics.timed("db")
+async def get_history(user_id: int | None = None, before_id: int | None = None, limit: int = 10):
+    # Страница истории (новые сверху): строки с id < before_id; курсор следующей страницы — id последней строки
+    pool = _db()
+    before_id = before_id or MAX_ID
+    async with pool.read() as db:
+        if user_id is None:
+            query = """
+                SELECT id, user_id, action, amount, reason, date
+                FROM history WHERE id > ? AND id < ? ORDER BY id DESC LIMIT ?
+            """
+            params = (pool.history_floor, before_id, limit)
+        else:
+            query = """
+                SELECT id, user_id, action, amount, reason, date
+                FROM history WHERE user_id = ? AND id > ? AND id < ? ORDER BY id DESC LIMIT ?
+            """
+            params = (user_id, pool.history_floor, before_id, limit)
+        async with db.execute(query, params) as cur:
             return await cur.fetchall()
 
+async def iter_history(after_id: int = 0, batch: int = 5000):
+    # Вся история по возрастанию id пачками: сначала перенесённая в архив (если он подключён —
+    # читается своим соединением), затем основная; читатель занят только на время одной пачки.
+    # Архив — префикс по id, поэтому основная продолжается после последней архивной записи.
+    pool = _db()
+    after_id = max(after_id, pool.history_floor)
+    archive = await aiosqlite.connect(pool.archive) if pool.archive else None
+    try:
+        for source in ([lambda: nullcontext(archive)] if archive else []) + [pool.read]:
+            while True:
+                async with source() as db:
+                    async with db.execute("""
+                        SELECT id, user_id, action, amount, reason, date
+                        FROM history WHERE id > ? ORDER BY id LIMIT ?
+                    """, (after_id, batch)) as cur:
+                        rows = await cur.fetchall()
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+                after_id = rows[-1][0]
+    finally:
+        if archive is not None:
+            await archive.close()
+
+# --- Архив истории ---
+async def attach_archive(path: str):
+    # ATTACH нельзя выполнять внутри транзакции, поэтому берём замок писателя без BEGIN
+    pool = _db()
+    async with pool._write_lock:
+        async with pool.writer.execute("PRAGMA database_list") as cur:
+            if any(row[1] == "archive" for row in await cur.fetchall()):
+                return
+        await pool.writer.execute("ATTACH DATABASE ? AS archive", (path,))
+        await pool.writer.execute("PRAGMA archive.journal_mode = WAL")
+        await pool.writer.execute(CREATE_ARCHIVE_HISTORY)
+        await pool.writer.commit()
+        pool.archive = path
+
+@metrics.timed("db")
+async def archive_history(before: str, limit: int = 500) -> int:
+    # Переносит в архив до limit самых старых записей с date < before -> сколько перенесено.
+    # id растут вместе с date, поэтому берём префикс по id и останавливаемся на первой свежей.
+    # Два коротких шага: копия в архив (повтор безопасен), затем итоги по дням и удаление
+    # одной транзакцией основной базы — при сбое между ними следующий проход всё доделает.
+    pool = _db()
+    floor = pool.history_floor  # стёртое «обнулить клуб» не переносим и не суммируем
+    async with pool.read() as db:
+        async with db.execute("SELECT id, date FROM history WHERE id > ? ORDER BY id LIMIT ?",
+                              (floor, limit)) as cur:
+            rows = await cur.fetchall()
+    last_id = None
+    for row_id, date in rows:
+        if date is None or date >= before:
+            break
+        last_id = row_id
+    if last_id is None:
+        return 0
+
+    async with pool.write() as db:
+        await db.execute("INSERT OR IGNORE INTO archive.history SELECT * FROM main.history "
+                         "WHERE id > ? AND id <= ?", (floor, last_id))
+    async with pool.write() as db:
+        await db.execute("""
+            INSERT INTO history_daily (user_id, day, amount, entries)
+            SELECT user_id, date(date), SUM(amount), COUNT(*) FROM main.history NOT INDEXED
+            WHERE id > ? AND id <= ?
+            GROUP BY user_id, date(date)
+            ON CONFLICT(user_id, day) DO UPDATE SET
+                amount = amount + excluded.amount,
+                entries = entries + excluded.entries
+        """, (floor, last_id))
+        await db.execute("INSERT INTO meta (key, value) VALUES ('archived_to', ?) "
+                         "ON CONFLICT(key) DO UPDATE SET value = excluded.value", (str(last_id),))
+        async with db.execute("DELETE FROM main.history WHERE id > ? AND id <= ?", (floor, last_id)) as cur:
+            return cur.rowcount
+
+@metrics.timed("db")
+async def get_history_total(user_id: int) -> int:
+    # Сумма всех изменений участника: итоги архивных дней + живая история
+    pool = _db()
+    async with pool.read() as db:
+        async with db.execute("""
+            SELECT (SELECT COALESCE(SUM(amount), 0) FROM history_daily WHERE user_id = ?)
+                 + (SELECT COALESCE(SUM(amount), 0) FROM history WHERE user_id = ? AND id > ?)
+        """, (user_id, user_id, pool.history_floor)) as cur:
+            return (await cur.fetchone())[0]
+
+# --- Снимки балансов ---
+async def _apply_snapshot(db) -> int:
+    async with db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'history'") as cur:
+        row = await cur.fetchone()
+    async with db.execute("INSERT INTO snapshots (history_id) VALUES (?) RETURNING id", (row[0] if row else 0,)) as cur:
+        snap_id = (await cur.fetchone())[0]
+    await db.execute("INSERT INTO balance_snapshots (snap_id, user_id, balance) "
+                     "SELECT ?, user_id, balance FROM users WHERE balance > 0", (snap_id,))
+    return snap_id
+
+@metrics.timed("db")
+async def take_snapshot(min_age: float = 0) -> int | None:
+    # Снимок всех балансов в общей очереди записи -> id снимка;
+    # None, если последний снимок моложе min_age секунд
+    async def op(db):
+        if min_age > 0:
+            async with db.execute("SELECT 1 FROM snapshots WHERE taken_at > datetime('now', ?) LIMIT 1",
+                                  (f"-{min_age} seconds",)) as cur:
+                if await cur.fetchone():
+                    return None
+        return await _apply_snapshot(db)
+    pool = _db()
+    if pool.state:
+        await pool.state.sync()
+    return await pool.ledger.submit(op)
+
+async def _meta_int(db, key: str) -> int | None:
+    async with db.execute("SELECT value FROM meta WHERE key = ?", (key,)) as cur:
+        row = await cur.fetchone()
+    return int(row[0]) if row else None
+
+async def _archived_to(db) -> int:
+    return await _meta_int(db, "archived_to") or 0
+
+@metrics.timed("db")
+async def prune_snapshots(keep_days: float = 0) -> int:
+    # Удаляет снимки, бесполезные для запросов -> сколько удалено: те, после которых часть
+    # истории уже в архиве, и (keep_days > 0) те, что старше keep_days дней, — кроме
+    # последнего из них: от него считается баланс на любой момент внутри окна
+    async def op(db):
+        async with db.execute("SELECT MAX(id) FROM snapshots WHERE history_id < ?", (await _archived_to(db),)) as cur:
+            last = (await cur.fetchone())[0] or 0
+        if keep_days > 0:
+            async with db.execute("SELECT MAX(id) FROM snapshots WHERE taken_at <= datetime('now', ?)",
+                                  (f"-{keep_days} days",)) as cur:
+                base = (await cur.fetchone())[0]
+            if base is not None:
+                last = max(last, base - 1)
+        if not last:
+            return 0
+        await db.execute("DELETE FROM balance_snapshots WHERE snap_id <= ?", (last,))
+        async with db.execute("DELETE FROM snapshots WHERE id <= ?", (last,)) as cur:
+            return cur.rowcount
+    return await _db().ledger.submit(op)
+
+async def _window(db, at: str, floor: int) -> tuple[int, int, int] | None:
+    # -> (снимок до at, история после него: id > start и id <= end) или None, если снимка
+    # до at нет (старая история неточна: списания без упора в ноль, обнуления без записей)
+    # или нужная часть истории уже ушла в архив
+    async with db.execute("SELECT id, history_id FROM snapshots WHERE taken_at <= ? "
+                          "ORDER BY taken_at DESC, id DESC LIMIT 1", (at,)) as cur:
+        snap = await cur.fetchone()
+    async with db.execute("SELECT history_id FROM snapshots WHERE taken_at > ? "
+                          "ORDER BY taken_at LIMIT 1", (at,)) as cur:
+        nxt = await cur.fetchone()
+    if snap is None:
+        return None
+    start = max(snap[1], floor)
+    if await _archived_to(db) > start:
+        return None
+    return snap[0], start, (nxt[0] if nxt else MAX_ID)
+
+@metrics.timed("db")
+async def get_balance_at(user_id: int, at: str) -> int | None:
+    # Баланс на момент at ('YYYY-MM-DD HH:MM:SS', UTC): снимок + хвост истории участника.
+    # None — на тот момент данных нет: раньше первого снимка или история уже в архиве.
+    pool = _db()
+    async with pool.read() as db:
+        window = await _window(db, at, pool.history_floor)
+        if window is None:
+            return None
+        snap_id, start, end = window
+        async with db.execute("SELECT balance FROM balance_snapshots WHERE snap_id = ? AND user_id = ?",
+                              (snap_id, user_id)) as cur:
+            row = await cur.fetchone()
+        balance = row[0] if row else 0
+        async with db.execute("SELECT COALESCE(SUM(amount), 0) FROM history "
+                              "WHERE user_id = ? AND id > ? AND id <= ? AND date <= ?",
+                              (user_id, start, end, at)) as cur:
+            return balance + (await cur.fetchone())[0]
+
+async def _balances_at(db, at: str, floor: int) -> dict[int, int] | None:
+    window = await _window(db, at, floor)
+    if window is None:
+        return None
+    snap_id, start, end = window
+    async with db.execute("SELECT user_id, balance FROM balance_snapshots WHERE snap_id = ?", (snap_id,)) as cur:
+        balances = dict(await cur.fetchall())
+    async with db.execute("SELECT user_id, amount FROM history WHERE id > ? AND id <= ? AND date <= ?",
+                          (start, end, at)) as cur:
+        async for user_id, amount in cur:
+            balances[user_id] = balances.get(user_id, 0) + amount
+    return balances
+
+@metrics.timed("db")
+async def get_balance_changes(since: str, until: str | None = None, limit: int = 10) -> list[tuple[int, int]] | None:
+    # Кто больше всех прибавил за период: [(user_id, прирост)] по убыванию.
+    # Без until — до текущих балансов. None — на начало периода данных нет.
+    pool = _db()
+    async with pool.read() as db:
+        before = await _balances_at(db, since, pool.history_floor)
+        if until is None:
+            async with db.execute("SELECT user_id, balance FROM users WHERE balance > 0") as cur:
+                after = dict(await cur.fetchall())
+        else:
+            after = await _balances_at(db, until, pool.history_floor)
+    if before is None or after is None:
+        return None
+    changes = [(uid, balance - before.get(uid, 0)) for uid, balance in after.items()]
+    changes = [c for c in changes if c[1] > 0]
+    changes.sort(key=lambda c: (-c[1], c[0]))
+    return changes[:limit]
+
+# --- Сверка балансов с историей ---
+# audit_history добавляет в audit_ledger следующие chunk записей истории и сдвигает
+# отметку audit_to одной транзакцией: прерванная сверка продолжается с той же записи.
+# audit_balances сравнивает balance участников, чьи суммы изменились, с суммой до
+# отметки + хвостом истории после неё — одним запросом на читателе, писатель не ждёт.
+# Расхождения закрывает repair_balance_drift записями 'audit' в истории: баланс,
+# который видит участник, не меняется. Запись 'audit' исправляет историю, а не
+# двигает нуары, поэтому вместе с ней снимаются балансы: снимок уже содержит
+# исправленный баланс, и запросы на момент времени не прибавят её второй раз.
+# Снимок копирует все балансы, поэтому страница расхождений исправляется одной
+# транзакцией с одним снимком, а не снимком на каждого участника.
+
+# отметка, после которой история ещё не вошла в audit_ledger (стёртое «обнулить клуб» не в счёт)
+AUDIT_MARK = "(SELECT MAX(CAST(value AS INTEGER)) FROM meta WHERE key IN ('audit_to', 'history_floor'))"
+
+async def _apply_audit(db, chunk: int) -> int:
+    audit_to = await _meta_int(db, "audit_to")
+    floor = await _meta_int(db, "history_floor") or 0
+    archived_to = await _archived_to(db)
+    start = max(audit_to or 0, floor)
+    if audit_to is None or archived_to > start:
+        # первая сверка или архив обогнал отметку: начинаем с итогов перенесённых дней
+        await db.execute("DELETE FROM audit_ledger")
+        await db.execute("INSERT INTO audit_ledger (user_id, amount, last_id) "
+                         "SELECT user_id, SUM(amount), ? FROM history_daily GROUP BY user_id", (archived_to,))
+        start = max(archived_to, floor)
+    async with db.execute("SELECT COUNT(*), MAX(id) FROM (SELECT id FROM history WHERE id > ? ORDER BY id LIMIT ?)",
+                          (start, chunk)) as cur:
+        count, end = await cur.fetchone()
+    if count:
+        await db.execute("""
+            INSERT INTO audit_ledger (user_id, amount, last_id)
+            SELECT user_id, SUM(amount), MAX(id) FROM history NOT INDEXED
+            WHERE id > ? AND id <= ?
+            GROUP BY user_id
+            ON CONFLICT(user_id) DO UPDATE SET
+                amount = amount + excluded.amount,
+                last_id = excluded.last_id
+        """, (start, end))
+    await db.execute("INSERT INTO meta (key, value) VALUES ('audit_to', ?) "
+                     "ON CONFLICT(key) DO UPDATE SET value = excluded.value", (str(end or start),))
+    return count
+
+@metrics.timed("db")
+async def audit_history(chunk: int = 2000) -> int:
+    # -> сколько записей истории добавлено в сверку; 0 — отметка догнала историю
+    pool = _db()
+    if pool.state:
+        await pool.state.sync()  # сверяем всё, что журнал уже принял
+    return await pool.ledger.submit(lambda db: _apply_audit(db, chunk))
+
+@metrics.timed("db")
+async def audit_balances(after_id: int = 0, limit: int = 500) -> tuple[list[tuple[int, int, int]], int | None]:
+    # Сверяет страницу участников, чьи суммы изменились, по user_id ->
+    # ([(user_id, баланс, по истории)] расхождений, курсор следующей страницы или None в конце)
+    pool = _db()
+    async with pool.read() as db:
+        async with db.execute(f"""
+            SELECT a.user_id, COALESCE(u.balance, 0), a.amount + (
+                       SELECT COALESCE(SUM(h.amount), 0) FROM history h
+                       WHERE h.user_id = a.user_id AND h.id > {AUDIT_MARK}),
+                   a.last_id
+            FROM audit_ledger a LEFT JOIN users u ON u.user_id = a.user_id
+            WHERE a.last_id > a.checked_id AND a.user_id > ?
+            ORDER BY a.user_id
+            LIMIT ?
+        """, (after_id, limit)) as cur:
+            rows = await cur.fetchall()
+    # сошедшиеся выпадают из очереди до новых записей; расхождения остаются в ней до исправления
+    checked = [(last_id, user_id) for user_id, balance, expected, last_id in rows if balance == expected]
+    if checked:
+        async def op(db):
+            await db.executemany("UPDATE audit_ledger SET checked_id = ? WHERE user_id = ?", checked)
+        await pool.ledger.submit(op)
+    drift = [(user_id, balance, expected) for user_id, balance, expected, _ in rows if balance != expected]
+    return drift, (rows[-1][0] if len(rows) == limit else None)
+
+@metrics.timed("db")
+async def audit_users(after_id: int = 0, limit: int = 500) -> tuple[list[tuple[int, int, int]], int | None]:
+    # Участники с балансом, которых нет в сверке (баланс менялся мимо истории), страницей
+    # по user_id -> (расхождения, курсор следующей страницы или None в конце)
+    async with _db().read() as db:
+        async with db.execute(f"""
+            SELECT u.user_id, u.balance, (
+                       SELECT COALESCE(SUM(h.amount), 0) FROM history h
+                       WHERE h.user_id = u.user_id AND h.id > {AUDIT_MARK}),
+                   EXISTS (SELECT 1 FROM audit_ledger a WHERE a.user_id = u.user_id)
+            FROM users u
+            WHERE u.user_id > ?
+            ORDER BY u.user_id
+            LIMIT ?
+        """, (after_id, limit)) as cur:
+            rows = await cur.fetchall()
+    drift = [(user_id, balance, expected) for user_id, balance, expected, known in rows
+             if not known and balance != expected]
+    return drift, (rows[-1][0] if len(rows) == limit else None)
+
+@metrics.timed("db")
+async def repair_balance_drift(user_ids: list[int]) -> int:
+    # Дописывает в историю недостающие изменения ('audit') страницы участников
+    # и снимает балансы один раз на всю страницу -> сколько записей добавлено
+    async def op(db):
+        rows = []
+        for user_id in user_ids:
+            async with db.execute(f"""
+                SELECT COALESCE((SELECT balance FROM users WHERE user_id = ?), 0)
+                     - COALESCE((SELECT amount FROM audit_ledger WHERE user_id = ?), 0)
+                     - (SELECT COALESCE(SUM(amount), 0) FROM history WHERE user_id = ? AND id > {AUDIT_MARK})
+            """, (user_id, user_id, user_id)) as cur:
+                diff = (await cur.fetchone())[0]
+            if diff:
+                rows.append((user_id, diff))
+        if rows:
+            await db.executemany("INSERT INTO history (user_id, action, amount, reason) "
+                                 "VALUES (?, 'audit', ?, 'сверка с историей')", rows)
+            await _apply_snapshot(db)
+        return len(rows)
+    return await _db().ledger.submit(op)
+
+@metrics.timed("db")
 async def get_top_users(limit: int = 10):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _db().read() as db:
         async with db.execute("""
             SELECT user_id, balance FROM users
             WHERE balance > 0
@@ -201,8 +1245,9 @@ async def get_top_users(limit: int = 10):
         """, (limit,)) as cur:
             return await cur.fetchall()
 
+@metrics.timed("db")
 async def get_all_roles():
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _db().read() as db:
         async with db.execute("""
             SELECT user_id, role_name FROM roles
             WHERE role_name IS NOT NULL AND TRIM(role_name) != ''
@@ -210,12 +1255,238 @@ async def get_all_roles():
             return await cur.fetchall()
 
 # --- Держатели ключа ---
+@metrics.timed("db")
 async def get_key_holders():
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _db().read() as db:
         async with db.execute("""
             SELECT user_id FROM users
             WHERE key = 1
             ORDER BY user_id ASC
         """) as cur:
             rows = await cur.fetchall()
-            return [r[0] for r in rows]
\ No newline at end of file
+            return [r[0] for r in rows]
+
+# --- Справочник имён ---
+@metrics.timed("db")
+async def save_names(rows: list[tuple[int, str, str | None]]):
+    # rows: (user_id, full_name, username)
+    async def op(db):
+        await db.executemany("""
+            INSERT INTO names (user_id, full_name, username) VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET full_name = excluded.full_name,
+                username = excluded.username, updated_at = CURRENT_TIMESTAMP
+        """, rows)
+    await _db().ledger.submit(op)
+
+@metrics.timed("db")
+async def get_user_ids_by_usernames(usernames: list[str]) -> dict[str, int]:
+    # -> {username в нижнем регистре: user_id}; регистр в Telegram не важен
+    found = {}
+    async with _db().read() as db:
+        for i in range(0, len(usernames), 500):
+            chunk = usernames[i:i + 500]
+            marks = ",".join("?" * len(chunk))
+            async with db.execute(f"SELECT username, user_id FROM names WHERE username COLLATE NOCASE IN ({marks})",
+                                  chunk) as cur:
+                for username, user_id in await cur.fetchall():
+                    found[username.lower()] = user_id
+    return found
+
+@metrics.timed("db")
+async def get_names(user_ids: list[int]) -> dict[int, str]:
+    names = {}
+    async with _db().read() as db:
+        for i in range(0, len(user_ids), 500):  # держимся ниже лимита переменных SQLite
+            chunk = user_ids[i:i + 500]
+            marks = ",".join("?" * len(chunk))
+            async with db.execute(f"SELECT user_id, full_name FROM names WHERE user_id IN ({marks})", chunk) as cur:
+                for user_id, full_name in await cur.fetchall():
+                    names[user_id] = full_name
+    return names
+
+# --- Файлы, загруженные в Telegram ---
+@metrics.timed("db")
+async def get_asset_file_id(sha256: str) -> str | None:
+    async with _db().read() as db:
+        async with db.execute("SELECT file_id FROM assets WHERE sha256 = ?", (sha256,)) as cur:
+            row = await cur.fetchone()
+    return row[0] if row else None
+
+@metrics.timed("db")
+async def save_asset_file_id(sha256: str, path: str, file_id: str):
+    async def op(db):
+        await db.execute("""
+            INSERT INTO assets (sha256, path, file_id) VALUES (?, ?, ?)
+            ON CONFLICT(sha256) DO UPDATE SET
+                path = excluded.path, file_id = excluded.file_id, updated_at = CURRENT_TIMESTAMP
+        """, (sha256, path, file_id))
+    await _db().ledger.submit(op)
+
+@metrics.timed("db")
+async def forget_asset(sha256: str):
+    async def op(db):
+        await db.execute("DELETE FROM assets WHERE sha256 = ?", (sha256,))
+    await _db().ledger.submit(op)
+
+# --- Ставки на кубик ---
+async def _apply_place_bet(db, user_id: int, amount: int, chat_id: int, message_id: int | None,
+                           user_name: str | None) -> tuple[bool, int, int | None]:
+    ok, balance = await _apply_debit(db, user_id, amount, "ставка")
+    if not ok:
+        return False, balance, None
+    async with db.execute("""
+        INSERT INTO pending_bets (user_id, chat_id, message_id, user_name, amount)
+        VALUES (?, ?, ?, ?, ?) RETURNING id
+    """, (user_id, chat_id, message_id, user_name, amount)) as cur:
+        row = await cur.fetchone()
+    return True, balance, row[0]
+
+@metrics.timed("db")
+async def place_bet(user_id: int, amount: int, chat_id: int, message_id: int | None = None,
+                    user_name: str | None = None) -> tuple[bool, int, int | None]:
+    # Списывает ставку в эскроу: (принята ли, баланс после списания, id ставки)
+    pool = _db()
+    if pool.state:
+        return await pool.state.place_bet(user_id, amount, chat_id, message_id, user_name)
+    ok, balance, bet_id = await pool.ledger.submit(
+        lambda db: _apply_place_bet(db, user_id, amount, chat_id, message_id, user_name))
+    pool.profiles.update(user_id, balance=balance)
+    return ok, balance, bet_id
+
+@metrics.timed("db")
+async def set_bet_roll(bet_id: int, roll: int, settle_at: float):
+    async def op(db):
+        await db.execute("UPDATE pending_bets SET roll = ?, settle_at = ? WHERE id = ?", (roll, settle_at, bet_id))
+    pool = _db()
+    if pool.state:
+        return await pool.state.set_bet_roll(bet_id, roll, settle_at)
+    await pool.ledger.submit(op)
+
+async def _apply_settle_bet(db, bet_id: int, win_roll: int, payout: int):
+    async with db.execute("""
+        DELETE FROM pending_bets WHERE id = ? AND roll IS NOT NULL
+        RETURNING user_id, chat_id, message_id, user_name, amount, roll
+    """, (bet_id,)) as cur:
+        row = await cur.fetchone()
+    if row is None:
+        return None, None
+    balance = None
+    if row[5] == win_roll:
+        balance = await _apply_balance(db, row[0], row[4] * payout, "ставка")
+    return tuple(row), balance
+
+@metrics.timed("db")
+async def settle_bet(bet_id: int, win_roll: int, payout: int):
+    # Рассчитывает ставку ровно один раз. При выигрыше начисляет amount * payout
+    # (ставка уже в эскроу). -> (user_id, chat_id, message_id, user_name, amount, roll) или None
+    pool = _db()
+    if pool.state:
+        return await pool.state.settle_bet(bet_id, win_roll, payout)
+    bet, balance = await pool.ledger.submit(lambda db: _apply_settle_bet(db, bet_id, win_roll, payout))
+    if balance is not None:
+        pool.profiles.update(bet[0], balance=balance)
+    return bet
+
+async def _apply_cancel_bet(db, bet_id: int):
+    async with db.execute("DELETE FROM pending_bets WHERE id = ? RETURNING user_id, amount", (bet_id,)) as cur:
+        row = await cur.fetchone()
+    if row is None:
+        return None, None
+    return row[0], await _apply_balance(db, row[0], row[1], "возврат ставки")
+
+@metrics.timed("db")
+async def cancel_bet(bet_id: int):
+    # Возвращает ставку из эскроу (кубик так и не был брошен)
+    pool = _db()
+    if pool.state:
+        return await pool.state.cancel_bet(bet_id)
+    user_id, balance = await pool.ledger.submit(lambda db: _apply_cancel_bet(db, bet_id))
+    if user_id is not None:
+        pool.profiles.update(user_id, balance=balance)
+
+@metrics.timed("db")
+async def get_pending_bets():
+    # [(id, roll, settle_at)] — для доигрывания после перезапуска
+    pool = _db()
+    if pool.state:
+        return pool.state.pending_bets()
+    async with pool.read() as db:
+        async with db.execute("SELECT id, roll, settle_at FROM pending_bets ORDER BY id") as cur:
+            return await cur.fetchall()
+
+# --- Журнал событий (STORAGE_BACKEND=eventlog) ---
+# Состояние живёт в памяти (eventlog.py), а база — его копия: записи журнала
+# после fsync переносятся сюда той же групповой фиксацией.
+async def _apply_events(db, records: list[dict], seq: int) -> int | None:
+    # Значения в записях абсолютные, поэтому несколько изменений одного участника
+    # за пачку схлопываются в одно. «Обнулить клуб» и снимок балансов — границы:
+    # накопленное до них записывается сразу. -> новая history_floor или None
+    users, roles, bets, history = {}, {}, {}, []
+    floor = None
+
+    async def flush():
+        if users:
+            await db.executemany("INSERT INTO users (user_id, username, balance, key) VALUES (?, NULL, ?, ?) "
+                                 "ON CONFLICT(user_id) DO UPDATE SET balance = excluded.balance, key = excluded.key",
+                                 ((uid, balance, key) for uid, (balance, key) in users.items()))
+        if roles:
+            await db.executemany("INSERT INTO roles (user_id, role_name, role_desc, role_image) VALUES (?, ?, ?, ?) "
+                                 "ON CONFLICT(user_id) DO UPDATE SET role_name = excluded.role_name, "
+                                 "role_desc = excluded.role_desc, role_image = excluded.role_image",
+                                 ((uid, *role) for uid, role in roles.items()))
+        if bets:
+            await db.executemany("DELETE FROM pending_bets WHERE id = ?",
+                                 ((bet_id,) for bet_id, bet in bets.items() if bet is None))
+            await db.executemany("INSERT INTO pending_bets (id, user_id, chat_id, message_id, user_name, amount, "
+                                 "roll, settle_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(id) DO UPDATE SET "
+                                 "roll = excluded.roll, settle_at = excluded.settle_at",
+                                 ((bet_id, *bet) for bet_id, bet in bets.items() if bet is not None))
+        if history:
+            await db.executemany("INSERT INTO history (user_id, action, amount, reason, date) VALUES (?, ?, ?, ?, ?)",
+                                 history)
+        for pending in (users, roles, bets, history):
+            pending.clear()
+
+    for record in records:
+        for op in record["ops"]:
+            kind = op[0]
+            if kind == "user":
+                users[op[1]] = (op[2], op[3])
+            elif kind == "role":
+                roles[op[1]] = tuple(op[2:5])
+            elif kind == "bet":
+                bets[op[1]] = tuple(op[2:9])
+            elif kind == "unbet":
+                bets[op[1]] = None
+            elif kind == "hist":
+                history.append((*op[1:5], record["ts"]))
+            elif kind == "snapshot":
+                await flush()
+                await _apply_snapshot(db)
+            elif kind == "reset":
+                await flush()
+                floor = await _apply_reset_club(db)
+    await flush()
+    await db.execute("INSERT INTO meta (key, value) VALUES ('eventlog_seq', ?) "
+                     "ON CONFLICT(key) DO UPDATE SET value = excluded.value", (str(seq),))
+    return floor
+
+def _projector(pool: Pool):
+    async def project(records: list[dict], seq: int):
+        floor = await pool.ledger.submit(lambda db: _apply_events(db, records, seq))
+        if floor is not None:
+            pool.history_floor = floor
+    return project
+
+async def _load_state(db):
+    # Состояние из базы, когда журнал о ней ничего нового не знает
+    async with db.execute("SELECT user_id, balance, key FROM users") as cur:
+        users = {uid: (balance, key) for uid, balance, key in await cur.fetchall()}
+    async with db.execute("SELECT user_id, role_name, role_desc, role_image FROM roles") as cur:
+        roles = {row[0]: tuple(row[1:]) for row in await cur.fetchall()}
+    async with db.execute("SELECT id, user_id, chat_id, message_id, user_name, amount, roll, settle_at "
+                          "FROM pending_bets") as cur:
+        bets = {row[0]: tuple(row[1:]) for row in await cur.fetchall()}
+    async with db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'pending_bets'") as cur:
+        row = await cur.fetchone()
+    return users, roles, bets, max([row[0] if row else 0, *bets]) + 1
@@ -0,0 +1,472 @@
+import asyncio
+import json
+import logging
+import os
+import time
+
+from config import EVENTLOG_FLUSH_MS, EVENTLOG_COMPACT_BYTES
+import metrics
+
+# Журнал событий — хранилище для STORAGE_BACKEND=eventlog. Участники (баланс и
+# ключ), роли и ставки в эскроу целиком живут в памяти: чтения не ходят в SQLite,
+# а проверки вроде «хватает ли на списание» идут по памяти без гонок (между
+# проверкой и изменением нет await). Каждое изменение дописывается строкой JSON
+# в <база>.events; строки сбрасываются на диск одним fsync раз в EVENTLOG_FLUSH_MS
+# мс, и вызов возвращается после fsync своей пачки.
+#
+# Записи журнала — абсолютные значения («баланс стал 15», а не «+5»), поэтому
+# повторное применение ничего не портит. После fsync записи переносятся в SQLite
+# (проекция, одна транзакция на пачку вместе с meta eventlog_seq): история,
+# снимки, сверка, архив и выгрузки работают с базой как раньше, а чтения из
+# базы сначала ждут, пока проекция догонит журнал.
+#
+# Когда журнал вырастает больше EVENTLOG_COMPACT_BYTES, состояние пишется в
+# снимок <база>.events.snap (tmp + fsync + rename) и журнал начинается заново.
+# При старте: снимок + журнал после него; оборванная последняя строка (сбой
+# посреди записи) отбрасывается, записи новее meta eventlog_seq доносятся в базу.
+
+FORMAT = 1
+
+
+def _now() -> str:
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+
+
+def _fsync_dir(path: str):
+    fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class EventLog:
+    def __init__(self, path: str, project, flush_ms: float = EVENTLOG_FLUSH_MS,
+                 compact_bytes: int = EVENTLOG_COMPACT_BYTES):
+        # project(records, seq): корутина, переносящая записи в SQLite и ставящая отметку seq
+        self.path = path + ".events"
+        self.snap_path = self.path + ".snap"
+        self.flush_ms = flush_ms
+        self.compact_bytes = compact_bytes
+        self._project = project
+        self.users: dict[int, tuple[int, int]] = {}  # user_id -> (баланс, ключ)
+        self.roles: dict[int, tuple] = {}            # user_id -> (role_name, role_desc, role_image)
+        self.bets: dict[int, tuple] = {}             # id -> (user_id, chat_id, message_id, user_name, amount, roll, settle_at)
+        self.next_bet = 1
+        self.seq = 0        # последняя принятая запись
+        self.durable = 0    # последняя записанная на диск
+        self.projected = 0  # последняя перенесённая в SQLite
+        self.size = 0       # байт в журнале
+        self.compactions = 0
+        self.failed: BaseException | None = None
+        self._file = None
+        self._pending: list[tuple[dict, asyncio.Future]] = []
+        self._unprojected: list[dict] = []
+        self._wake = asyncio.Event()
+        self._project_wake = asyncio.Event()
+        self._progress = asyncio.Condition()
+        self._open = asyncio.Event()  # сброшено, пока идёт сжатие
+        self._open.set()
+        self._tasks: list[asyncio.Task] = []
+        self._compacting: asyncio.Task | None = None
+        self._closed = False
+
+    # --- Состояние ---
+    def _apply(self, op: list):
+        kind = op[0]
+        if kind == "user":
+            self.users[op[1]] = (op[2], op[3])
+        elif kind == "role":
+            self.roles[op[1]] = tuple(op[2:5])
+        elif kind == "bet":
+            self.bets[op[1]] = tuple(op[2:9])
+            self.next_bet = max(self.next_bet, op[1] + 1)
+        elif kind == "unbet":
+            self.bets.pop(op[1], None)
+        elif kind == "reset":
+            self.users.clear()
+            self.roles.clear()
+            self.bets.clear()
+        # "hist" и "snapshot" памяти не меняют — они нужны только проекции
+
+    def _dump(self) -> dict:
+        # значения — кортежи, которые не меняются на месте, поэтому поверхностной копии
+        # достаточно, а сериализация может идти в потоке
+        return {"format": FORMAT, "seq": self.seq, "next_bet": self.next_bet,
+                "users": [(uid, *value) for uid, value in self.users.items()],
+                "roles": [(uid, *value) for uid, value in self.roles.items()],
+                "bets": [(bet_id, *value) for bet_id, value in self.bets.items()]}
+
+    def _restore(self, snapshot: dict):
+        self.users = {row[0]: (row[1], row[2]) for row in snapshot["users"]}
+        self.roles = {row[0]: tuple(row[1:4]) for row in snapshot["roles"]}
+        self.bets = {row[0]: tuple(row[1:8]) for row in snapshot["bets"]}
+        self.next_bet = snapshot["next_bet"]
+        self.seq = snapshot["seq"]
+
+    # --- Файлы (вызываются в потоке) ---
+    def _read(self) -> tuple[dict | None, list[dict]]:
+        snapshot = None
+        if os.path.exists(self.snap_path):
+            with open(self.snap_path, "rb") as f:
+                snapshot = json.loads(f.read())
+        records = []
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                lines = f.read().split(b"\n")
+            for i, line in enumerate(lines):
+                if not line:
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    if i < len(lines) - 1:
+                        raise RuntimeError(f"Журнал {self.path}: испорчена строка {i + 1}")
+                    logging.warning("Журнал %s: отброшена оборванная последняя запись", self.path)
+                    break
+        return snapshot, records
+
+    def _write_snapshot(self, snapshot: dict):
+        # снимок целиком или никак: tmp + fsync + rename; потом журнал начинается заново
+        tmp = self.snap_path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(json.dumps(snapshot, ensure_ascii=False, separators=(",", ":")).encode())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.snap_path)
+        _fsync_dir(self.snap_path)
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.path, "wb")
+        os.fsync(self._file.fileno())
+        self.size = 0
+
+    def _append(self, data: bytes):
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    # --- Открытие и закрытие ---
+    async def open(self, mark: int | None, load):
+        # mark — последняя запись журнала, уже перенесённая в SQLite (meta eventlog_seq),
+        # None — база менялась без журнала (первый запуск, работа на STORAGE_BACKEND=sqlite);
+        # load() -> (users, roles, bets, next_bet) читает состояние из SQLite
+        started = time.perf_counter()
+        snapshot, records = await asyncio.to_thread(self._read)
+        base = snapshot["seq"] if snapshot else 0
+        last = records[-1]["seq"] if records else base
+        replayed = 0
+        if mark is not None and snapshot is not None and last >= mark:
+            if base > mark:
+                raise RuntimeError(f"Снимок журнала {self.snap_path} (запись {base}) новее базы (запись {mark})")
+            self._restore(snapshot)
+            missing = []
+            for record in records:
+                if record["seq"] <= base:
+                    continue  # уже в снимке: сбой между снимком и очисткой журнала
+                for op in record["ops"]:
+                    self._apply(op)
+                self.seq = record["seq"]
+                if record["seq"] > mark:
+                    missing.append(record)
+            replayed = len(records)
+            for i in range(0, len(missing), 1000):
+                chunk = missing[i:i + 1000]
+                await self._project(chunk, chunk[-1]["seq"])
+        else:
+            if mark is not None:
+                logging.warning("Журнал %s отстал от базы (запись %s из %s): состояние берётся из базы",
+                                self.path, last, mark)
+            self.users, self.roles, self.bets, self.next_bet = await load()
+            self.seq = max(last, mark or 0)
+            await self._project([], self.seq)
+        self.durable = self.projected = self.seq
+        # новый снимок сразу: следующий старт не проигрывает тот же журнал ещё раз
+        await asyncio.to_thread(self._write_snapshot, self._dump())
+        self._tasks = [asyncio.create_task(self._flusher()), asyncio.create_task(self._projector())]
+        logging.info("Журнал %s: %s участников, %s ролей, %s ставок; проиграно записей %s за %.0f мс",
+                      self.path, len(self.users), len(self.roles), len(self.bets), replayed,
+                      (time.perf_counter() - started) * 1e3)
+
+    async def close(self):
+        # дописываем и переносим всё принятое, затем останавливаемся
+        if not self._tasks:
+            return
+        if self._compacting is not None:
+            await asyncio.gather(self._compacting, return_exceptions=True)
+        self._closed = True
+        self._wake.set()
+        await self._tasks[0]
+        self._project_wake.set()
+        await self._tasks[1]
+        self._tasks = []
+        await asyncio.to_thread(self._file.close)
+        self._file = None
+
+    # --- Запись ---
+    async def _ready(self):
+        if not self._open.is_set():
+            await self._open.wait()
+        if self.failed is not None or self._closed:
+            raise RuntimeError(f"Журнал {self.path} недоступен: {self.failed or 'закрыт'}")
+
+    def _do(self, ops: list, *op):
+        # изменение сразу видно в памяти; на диск оно попадёт с пачкой
+        self._apply(op)
+        ops.append(op)
+
+    async def _commit(self, ops: list):
+        # ждём fsync пачки, в которую попала запись
+        if not ops:
+            return
+        self.seq += 1
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.append(({"seq": self.seq, "ts": _now(), "ops": ops}, fut))
+        self._wake.set()
+        await fut
+
+    async def _flusher(self):
+        while True:
+            if not self._closed:
+                await self._wake.wait()
+            self._wake.clear()
+            if self.flush_ms > 0 and not self._closed:
+                await asyncio.sleep(self.flush_ms / 1000)
+            batch, self._pending = self._pending, []
+            if not batch:
+                if self._closed:
+                    return
+                continue
+            data = "".join(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+                           for record, _ in batch).encode()
+            try:
+                await asyncio.to_thread(self._append, data)
+            except Exception as e:
+                # память уже впереди диска: дальше не принимаем, после перезапуска верен журнал
+                logging.exception("Журнал %s: запись не удалась", self.path)
+                self.failed = e
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            self.size += len(data)
+            self.durable = batch[-1][0]["seq"]
+            metrics.inc("archivist_eventlog_fsync_total")
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_result(None)
+            self._unprojected.extend(record for record, _ in batch)
+            self._project_wake.set()
+            if self.size >= self.compact_bytes and self._compacting is None and not self._closed:
+                self._compacting = asyncio.create_task(self.compact())
+
+    async def _projector(self):
+        while True:
+            if not self._closed:
+                await self._project_wake.wait()
+            self._project_wake.clear()
+            batch, self._unprojected = self._unprojected, []
+            if not batch and self._closed and self._tasks[0].done():
+                return
+            if batch:
+                try:
+                    await self._project(batch, batch[-1]["seq"])
+                except Exception as e:
+                    # записи уже в журнале: при следующем старте они будут перенесены
+                    logging.exception("Журнал %s: перенос в базу не удался", self.path)
+                    self.failed = e
+                else:
+                    self.projected = batch[-1]["seq"]
+                async with self._progress:
+                    self._progress.notify_all()
+
+    async def sync(self):
+        # ждём, пока SQLite догонит всё, что принято к этому моменту
+        target = self.seq
+        if self.projected >= target:
+            return
+        async with self._progress:
+            await self._progress.wait_for(lambda: self.projected >= target or self.failed is not None)
+        if self.failed is not None:
+            raise RuntimeError(f"Журнал {self.path} недоступен: {self.failed}")
+
+    async def compact(self):
+        # новые изменения ждут, пока всё принятое не окажется на диске и в базе;
+        # тогда снимок совпадает с концом журнала и журнал можно начать заново
+        self._open.clear()
+        try:
+            await self.sync()
+            started = time.perf_counter()
+            size = self.size
+            await asyncio.to_thread(self._write_snapshot, self._dump())
+            self.compactions += 1
+            metrics.inc("archivist_eventlog_compactions_total")
+            logging.info("Журнал %s: сжат (%s байт) за %.0f мс", self.path, size,
+                         (time.perf_counter() - started) * 1e3)
+        except Exception:
+            logging.exception("Журнал %s: сжатие не удалось", self.path)
+        finally:
+            self._open.set()
+            self._compacting = None
+
+    # --- Чтения ---
+    def balance(self, user_id: int) -> int:
+        return self.users.get(user_id, (0, 0))[0]
+
+    def has_key(self, user_id: int) -> bool:
+        return self.users.get(user_id, (0, 0))[1] == 1
+
+    def role(self, user_id: int):
+        return self.roles.get(user_id)
+
+    def pending_bets(self) -> list[tuple]:
+        return [(bet_id, bet[5], bet[6]) for bet_id, bet in sorted(self.bets.items())]
+
+    # --- Баланс ---
+    def _credit(self, ops: list, user_id: int, amount: int, reason: str) -> int:
+        # как _apply_balance: участник появляется, баланс не уходит ниже нуля
+        balance, key = self.users.get(user_id, (0, 0))
+        applied = max(amount, -balance)
+        self._do(ops, "user", user_id, balance + applied, key)
+        self._do(ops, "hist", user_id, "change_balance", applied, reason)
+        return balance + applied
+
+    def _debit(self, ops: list, user_id: int, amount: int, reason: str) -> tuple[bool, int]:
+        # как _apply_debit: только если хватает
+        if user_id not in self.users:
+            return False, 0
+        balance, key = self.users[user_id]
+        if balance < amount:
+            return False, balance
+        self._do(ops, "user", user_id, balance - amount, key)
+        self._do(ops, "hist", user_id, "change_balance", -amount, reason)
+        return True, balance - amount
+
+    async def change_balance(self, user_id: int, amount: int, reason: str) -> int:
+        await self._ready()
+        ops = []
+        balance = self._credit(ops, user_id, amount, reason)
+        await self._commit(ops)
+        return balance
+
+    async def debit_if_sufficient(self, user_id: int, amount: int, reason: str) -> tuple[bool, int]:
+        await self._ready()
+        ops = []
+        result = self._debit(ops, user_id, amount, reason)
+        await self._commit(ops)
+        return result
+
+    async def bulk_change_balance(self, user_ids: list[int], amount: int,
+                                  reason: str) -> tuple[dict[int, int], dict[int, int]]:
+        await self._ready()
+        ops, done, skipped = [], {}, {}
+        for user_id in user_ids:
+            balance, key = self.users.get(user_id, (0, 0))
+            if amount <= 0 and balance < -amount:
+                skipped[user_id] = balance
+                continue
+            if amount > 0 or user_id in self.users:
+                self._do(ops, "user", user_id, balance + amount, key)
+            self._do(ops, "hist", user_id, "change_balance", amount, reason)
+            done[user_id] = balance + amount
+        await self._commit(ops)
+        return done, skipped
+
+    async def transfer(self, from_id: int, to_id: int, amount: int, reason: str) -> tuple[bool, int, int | None]:
+        await self._ready()
+        ops = []
+        ok, from_balance = self._debit(ops, from_id, amount, reason)
+        to_balance = self._credit(ops, to_id, amount, reason) if ok else None
+        await self._commit(ops)
+        return ok, from_balance, to_balance
+
+    async def reset_user_balance(self, user_id: int):
+        await self._ready()
+        ops = []
+        balance, key = self.users.get(user_id, (0, 0))
+        if balance:
+            self._do(ops, "user", user_id, 0, key)
+            self._do(ops, "hist", user_id, "reset_balance", -balance, "обнуление баланса")
+        await self._commit(ops)
+
+    async def reset_all_balances(self):
+        await self._ready()
+        ops = []
+        for user_id, (balance, key) in list(self.users.items()):
+            if balance > 0:
+                self._do(ops, "user", user_id, 0, key)
+                self._do(ops, "hist", user_id, "reset_balance", -balance, "обнуление балансов")
+        self._do(ops, "snapshot")
+        await self._commit(ops)
+
+    async def reset_club(self):
+        await self._ready()
+        ops = []
+        self._do(ops, "reset")
+        await self._commit(ops)
+
+    # --- Роли и ключи ---
+    async def set_role(self, user_id: int, role_name: str | None, role_desc: str | None):
+        await self._ready()
+        ops = []
+        image = (self.roles.get(user_id) or (None, None, None))[2]
+        self._do(ops, "role", user_id, role_name, role_desc, image)
+        await self._commit(ops)
+
+    async def set_role_image(self, user_id: int, image_file_id: str):
+        await self._ready()
+        ops = []
+        name, desc, _ = self.roles.get(user_id) or (None, None, None)
+        self._do(ops, "role", user_id, name, desc, image_file_id)
+        await self._commit(ops)
+
+    async def set_key(self, user_id: int, key: bool):
+        # снятие ключа у неизвестного участника ничего не создаёт, как UPDATE в SQLite
+        await self._ready()
+        ops = []
+        if key or user_id in self.users:
+            self._do(ops, "user", user_id, self.balance(user_id), int(key))
+        await self._commit(ops)
+
+    # --- Ставки на кубик ---
+    async def place_bet(self, user_id: int, amount: int, chat_id: int, message_id: int | None,
+                        user_name: str | None) -> tuple[bool, int, int | None]:
+        await self._ready()
+        ops = []
+        ok, balance = self._debit(ops, user_id, amount, "ставка")
+        bet_id = None
+        if ok:
+            bet_id = self.next_bet
+            self._do(ops, "bet", bet_id, user_id, chat_id, message_id, user_name, amount, None, None)
+        await self._commit(ops)
+        return ok, balance, bet_id
+
+    async def set_bet_roll(self, bet_id: int, roll: int, settle_at: float):
+        await self._ready()
+        ops = []
+        bet = self.bets.get(bet_id)
+        if bet is not None:
+            self._do(ops, "bet", bet_id, *bet[:5], roll, settle_at)
+        await self._commit(ops)
+
+    async def settle_bet(self, bet_id: int, win_roll: int, payout: int):
+        await self._ready()
+        bet = self.bets.get(bet_id)
+        if bet is None or bet[5] is None:
+            return None
+        ops = []
+        self._do(ops, "unbet", bet_id)
+        if bet[5] == win_roll:
+            self._credit(ops, bet[0], bet[4] * payout, "ставка")
+        await self._commit(ops)
+        return bet[:6]
+
+    async def cancel_bet(self, bet_id: int):
+        await self._ready()
+        bet = self.bets.get(bet_id)
+        if bet is None:
+            return
+        ops = []
+        self._do(ops, "unbet", bet_id)
+        self._credit(ops, bet[0], bet[4], "возврат ставки")
+        await self._commit(ops)
@@ -0,0 +1,52 @@
+import asyncio
+import csv
+import gzip
+import io
+import json
+
+from db import iter_history
+
+# Выгрузка всей истории в gzip-файл прямо из курсора: в памяти одновременно
+# только одна пачка строк, сжатие и запись на диск — в отдельном потоке.
+
+COLUMNS = ("id", "user_id", "action", "amount", "reason", "date")
+CHUNK_ROWS = 5000
+
+
+def _csv_chunk(rows: list, header: bool) -> bytes:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    if header:
+        writer.writerow(COLUMNS)
+    writer.writerows(rows)
+    return buf.getvalue().encode("utf-8")
+
+
+def _jsonl_chunk(rows: list, header: bool) -> bytes:
+    return "".join(json.dumps(dict(zip(COLUMNS, row)), ensure_ascii=False) + "\n"
+                   for row in rows).encode("utf-8")
+
+
+def _write(gz, encode, rows: list, header: bool):
+    gz.write(encode(rows, header))
+
+
+async def write_history(path: str, fmt: str = "csv") -> int:
+    # -> сколько строк записано
+    encode = _jsonl_chunk if fmt == "jsonl" else _csv_chunk
+    gz = await asyncio.to_thread(gzip.open, path, "wb", 6)
+    count = 0
+    rows = []
+    try:
+        async for row in iter_history(batch=CHUNK_ROWS):
+            rows.append(row)
+            if len(rows) >= CHUNK_ROWS:
+                await asyncio.to_thread(_write, gz, encode, rows, count == 0)
+                count += len(rows)
+                rows = []
+        if rows or count == 0:
+            await asyncio.to_thread(_write, gz, encode, rows, count == 0)
+            count += len(rows)
+    finally:
+        await asyncio.to_thread(gz.close)
+    return count
@@ -0,0 +1,151 @@
+import bisect
+import functools
+import logging
+import time
+
+from aiohttp import web
+
+# Метрики горячего пути в формате Prometheus без внешних зависимостей:
+# гистограммы задержек обработчиков, функций db.py и вызовов Telegram API,
+# счётчики команд/ошибок и «снимаемые» значения (кэши, очереди).
+# Наблюдение — это bisect по 14 границам и три сложения, так что метрики
+# можно держать включёнными в проде.
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+_histograms: dict[tuple[str, str], Histogram] = {}    # (семейство, имя) -> гистограмма
+_counters: dict[tuple[str, tuple], float] = {}        # (метрика, метки) -> значение
+_gauges: list[tuple[str, str, object]] = []           # (метрика, тип, функция без аргументов)
+
+
+def histogram(family: str, name: str) -> Histogram:
+    key = (family, name)
+    hist = _histograms.get(key)
+    if hist is None:
+        hist = _histograms[key] = Histogram()
+    return hist
+
+
+def inc(metric: str, value: float = 1, **labels):
+    key = (metric, tuple(sorted(labels.items())))
+    _counters[key] = _counters.get(key, 0) + value
+
+
+def gauge(metric: str, fn, kind: str = "gauge"):
+    # значение снимается в момент запроса /metrics
+    _gauges.append((metric, kind, fn))
+
+
+class track:
+    # with track("handler", name): ... — время и ошибки блока
+    __slots__ = ("hist", "family", "name", "start")
+
+    def __init__(self, family: str, name: str):
+        self.hist = histogram(family, name)
+        self.family = family
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.hist.observe(time.perf_counter() - self.start)
+        if exc_type is not None and issubclass(exc_type, Exception):
+            inc("archivist_errors_total", where=self.family, name=self.name)
+        return False
+
+
+def timed(family: str):
+    # декоратор для async-функций
+    def decorator(fn):
+        name = fn.__name__
+        observe = histogram(family, name).observe
+        clock = time.perf_counter
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            start = clock()
+            try:
+                return await fn(*args, **kwargs)
+            except Exception:
+                inc("archivist_errors_total", where=family, name=name)
+                raise
+            finally:
+                observe(clock() - start)
+        return wrapper
+    return decorator
+
+
+async def api_middleware(make_request, bot, method):
+    # мидлварь сессии aiogram v3: bot.session.middleware(api_middleware)
+    with track("telegram", type(method).__name__):
+        return await make_request(bot, method)
+
+
+def _labels(pairs) -> str:
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{str(v)}"' for k, v in pairs) + "}"
+
+
+def render() -> str:
+    lines = []
+    families: dict[str, list] = {}
+    for (family, name), hist in sorted(_histograms.items()):
+        families.setdefault(family, []).append((name, hist))
+    for family, items in families.items():
+        metric = f"archivist_{family}_seconds"
+        lines.append(f"# TYPE {metric} histogram")
+        for name, hist in items:
+            cumulative = 0
+            for bound, count in zip(BUCKETS, hist.counts):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{name="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{name="{name}",le="+Inf"}} {hist.count}')
+            lines.append(f'{metric}_sum{{name="{name}"}} {hist.sum}')
+            lines.append(f'{metric}_count{{name="{name}"}} {hist.count}')
+
+    typed = set()
+    for (metric, labels), value in sorted(_counters.items()):
+        if metric not in typed:
+            lines.append(f"# TYPE {metric} counter")
+            typed.add(metric)
+        lines.append(f"{metric}{_labels(labels)} {value}")
+
+    for metric, kind, fn in _gauges:
+        try:
+            value = fn()
+        except Exception:
+            continue  # источник ещё/уже не доступен (например, база закрыта)
+        lines.append(f"# TYPE {metric} {kind}")
+        lines.append(f"{metric} {value}")
+    return "\n".join(lines) + "\n"
+
+
+async def start_server(host: str, port: int) -> web.AppRunner:
+    async def handle(_request):
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info("Метрики: http://%s:%s/metrics", host, port)
+    return runner
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from config import NAME_TTL, NAME_FETCH_CONCURRENCY, PROFILE_CACHE_SIZE
+from db import get_names, save_names, club
+import metrics
+
+# Справочник отображаемых имён: память (с TTL) -> таблица names -> get_chat_member.
+# Имена запоминаются из каждого входящего сообщения, поэтому до Telegram
+# доходят только те, кто давно не писал в чат.
+# Имя у пользователя одно на все чаты, поэтому справочник общий — в основной базе.
+# Память — LRU на PROFILE_CACHE_SIZE участников. TTL решает только, когда имя
+# перечитать из базы; что лежит в базе, помнится отдельно, и в базу уходит лишь
+# изменившееся имя.
+
+# user_id -> (имя, когда протухает, (full_name, username) в базе или None — неизвестно)
+_cache: OrderedDict[int, tuple[str, float, tuple | None]] = OrderedDict()
+_pending: set[asyncio.Task] = set()
+
+
+def _put(user_id: int, name: str, now: float, persisted: tuple | None = None):
+    entry = _cache.pop(user_id, None)
+    if persisted is None and entry:
+        persisted = entry[2]
+    _cache[user_id] = (name, now + NAME_TTL, persisted)
+    while len(_cache) > PROFILE_CACHE_SIZE:
+        _cache.popitem(last=False)
+
+
+def _saved(task: asyncio.Task):
+    _pending.discard(task)
+    if not task.cancelled() and task.exception():
+        logging.warning("Не удалось сохранить имя: %s", task.exception())
+
+
+async def _save(user):
+    try:
+        async with club(None):
+            await save_names([(user.id, user.full_name, user.username)])
+    except BaseException:
+        _cache.pop(user.id, None)  # в базе имени нет: следующее сообщение запишет его снова
+        raise
+
+
+def remember(user):
+    # Вызывается на каждое сообщение; в базу пишем только новое или изменившееся имя
+    if user is None or not user.full_name:
+        return
+    stored = (user.full_name, user.username)
+    entry = _cache.get(user.id)
+    _put(user.id, user.full_name, time.monotonic(), stored)
+    if entry and entry[2] == stored:
+        return
+    task = asyncio.create_task(_save(user))
+    _pending.add(task)
+    task.add_done_callback(_saved)
+
+
+async def resolve_names(bot, chat_id: int, user_ids: list[int]) -> dict[int, str]:
+    now = time.monotonic()
+    names = {}
+    missing = []
+    for user_id in user_ids:
+        entry = _cache.get(user_id)
+        if entry and entry[1] > now:
+            names[user_id] = entry[0]
+            _cache.move_to_end(user_id)
+        else:
+            missing.append(user_id)
+    metrics.inc("archivist_name_lookups_total", len(names), source="memory")
+
+    if missing:
+        async with club(None):
+            stored = await get_names(missing)
+        for user_id, name in stored.items():
+            names[user_id] = name
+            _put(user_id, name, now)
+        found = len(missing)
+        missing = [user_id for user_id in missing if user_id not in names]
+        metrics.inc("archivist_name_lookups_total", found - len(missing), source="db")
+
+    if missing:
+        # остальных спрашиваем у Telegram параллельно, но не больше N запросов разом
+        sem = asyncio.Semaphore(NAME_FETCH_CONCURRENCY)
+
+        async def fetch(user_id: int):
+            async with sem:
+                try:
+                    member = await bot.get_chat_member(chat_id, user_id)
+                except Exception:
+                    return None
+            return member.user
+
+        fetched = [u for u in await asyncio.gather(*(fetch(uid) for uid in missing)) if u and u.full_name]
+        metrics.inc("archivist_name_lookups_total", len(fetched), source="telegram")
+        metrics.inc("archivist_name_lookups_total", len(missing) - len(fetched), source="unresolved")
+        for user in fetched:
+            names[user.id] = user.full_name
+            _put(user.id, user.full_name, now, (user.full_name, user.username))
+        if fetched:
+            async with club(None):
+                await save_names([(u.id, u.full_name, u.username) for u in fetched])
+    return names
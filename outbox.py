@@ -0,0 +1,180 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from aiogram.exceptions import TelegramRetryAfter
+
+from config import OUTBOX_GLOBAL_RATE, OUTBOX_CHAT_RATE, OUTBOX_GROUP_PER_MIN, OUTBOX_BURST, OUTBOX_RETRIES
+import metrics
+
+# Исходящие сообщения. Каждая отправка бота (send*, forward*, copy*) проходит
+# через мидлварь сессии aiogram и ждёт токены двух вёдер: своего чата (личка —
+# OUTBOX_CHAT_RATE в секунду, группа — OUTBOX_GROUP_PER_MIN в минуту) и общего
+# на бота (OUTBOX_GLOBAL_RATE в секунду). Общие токены раздаются по приоритету:
+# ответы на команды раньше массового вывода (списки, выгрузки). На 429 чат
+# замирает на retry_after, отправка повторяется до OUTBOX_RETRIES раз.
+# post() ставит отправку в очередь и сразу возвращает управление обработчику.
+
+REPLY, BULK = 0, 1
+CHAT_BUCKETS_MAX = 10_000  # больше вёдер — забываем полные (давно молчавшие чаты)
+
+_priority: ContextVar[int] = ContextVar("outbox_priority", default=REPLY)
+_tasks: set[asyncio.Task] = set()
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + max(0.0, now - self.stamp) * self.rate)
+        self.stamp = max(self.stamp, now)
+
+    def _reserve(self, now: float) -> float:
+        # берём токен, при нехватке — в долг; -> сколько ждать своей очереди
+        self._refill(now)
+        self.tokens -= 1
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    async def take(self):
+        while True:
+            now = time.monotonic()
+            if self.paused_until > now:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            wait = self._reserve(now)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if self.paused_until <= time.monotonic():
+                return
+            # пока ждали очереди, чат получил 429: место отдаём, после паузы встаём заново
+            self.tokens += 1
+
+    def pause(self, seconds: float):
+        now = time.monotonic()
+        self._refill(now)
+        self.paused_until = max(self.paused_until, now + seconds)
+        self.tokens = min(self.tokens, 0.0)
+        self.stamp = max(self.stamp, self.paused_until)
+
+    def idle(self, now: float) -> bool:
+        return self.paused_until <= now and self.tokens + (now - self.stamp) * self.rate >= self.burst
+
+
+class Outbox:
+    def __init__(self, global_rate: float = OUTBOX_GLOBAL_RATE, chat_rate: float = OUTBOX_CHAT_RATE,
+                 group_per_min: float = OUTBOX_GROUP_PER_MIN, burst: int = OUTBOX_BURST,
+                 retries: int = OUTBOX_RETRIES):
+        self.bucket = TokenBucket(global_rate, 1)  # ровный поток: без залпов в начале секунды
+        self.chat_rate = chat_rate
+        self.group_rate = group_per_min / 60
+        self.burst = burst
+        self.retries = retries
+        self.chats: dict[int, TokenBucket] = {}
+        self._waiters: list = []  # куча (приоритет, номер, future) ждущих общий токен
+        self._seq = itertools.count()
+        self._pump: asyncio.Task | None = None
+        self.queued = 0
+        self.sent = 0
+        self.retried = 0
+
+    def _chat(self, chat_id: int) -> TokenBucket:
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            if len(self.chats) >= CHAT_BUCKETS_MAX:
+                now = time.monotonic()
+                self.chats = {cid: b for cid, b in self.chats.items() if not b.idle(now)}
+            rate = self.group_rate if chat_id < 0 else self.chat_rate
+            bucket = self.chats[chat_id] = TokenBucket(rate, self.burst)
+        return bucket
+
+    async def _global(self, priority: int):
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.create_task(self._run())
+        await fut
+
+    async def _run(self):
+        while self._waiters:
+            await self.bucket.take()
+            while self._waiters:
+                _, _, fut = heapq.heappop(self._waiters)
+                if not fut.done():
+                    fut.set_result(None)
+                    break
+
+    def stats(self) -> dict:
+        return {"queued": self.queued, "sent": self.sent, "retried": self.retried, "chats": len(self.chats)}
+
+    # Мидлварь сессии aiogram v3: bot.session.middleware(outbox)
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        if not name.startswith(("Send", "Forward", "Copy")):
+            return await make_request(bot, method)
+        chat_id = getattr(method, "chat_id", None)
+        chat = self._chat(chat_id) if isinstance(chat_id, int) else None
+        priority = _priority.get()
+        start = time.perf_counter()
+        self.queued += 1
+        try:
+            for attempt in range(self.retries + 1):
+                if chat is not None:
+                    await chat.take()
+                await self._global(priority)
+                try:
+                    result = await make_request(bot, method)
+                except TelegramRetryAfter as e:
+                    self.retried += 1
+                    metrics.inc("archivist_outbox_retry_after_total")
+                    if attempt == self.retries:
+                        raise
+                    (chat or self.bucket).pause(e.retry_after)
+                    continue
+                self.sent += 1
+                metrics.histogram("outbox", name).observe(time.perf_counter() - start)
+                return result
+        finally:
+            self.queued -= 1
+
+
+@contextmanager
+def priority(level: int):
+    # with outbox.priority(outbox.BULK): ... — отправки внутри уступают ответам
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def post(send):
+    # send — ещё не отправленный вызов API (message.reply(...)); обработчик не ждёт доставки
+    task = asyncio.ensure_future(send)
+    _tasks.add(task)
+    task.add_done_callback(_done)
+    return task
+
+
+def _done(task: asyncio.Task):
+    _tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logging.error("Не удалось отправить сообщение", exc_info=task.exception())
+
+
+def pending() -> int:
+    return len(_tasks)
+
+
+async def drain():
+    # дожидаемся поставленных отправок (при остановке бота)
+    while _tasks:
+        await asyncio.gather(*_tasks, return_exceptions=True)
@@ -0,0 +1,114 @@
+import asyncio
+import logging
+import os
+import time
+
+from config import (
+    ARCHIVE_PATH, RETENTION_DAYS, RETENTION_CHUNK, RETENTION_PAUSE_MS, RETENTION_INTERVAL, PURGE_CHUNK,
+    SNAPSHOT_INTERVAL, SNAPSHOT_KEEP_DAYS
+)
+from db import (
+    attach_archive, archive_history, purge_history, club, dirty_clubs, club_path, take_snapshot, prune_snapshots
+)
+
+# Хранение истории: записи старше RETENTION_DAYS раз в RETENTION_INTERVAL
+# переносятся в архивный файл (ATTACH), а в основной базе от них остаются
+# итоги по участнику и дню (history_daily). Перенос идёт шагами по
+# RETENTION_CHUNK записей с паузой, чтобы писатель не был занят надолго
+# и пачки баланса проходили между шагами. Освободившиеся страницы основная
+# база использует заново, так что файл перестаёт расти.
+# Здесь же дочищается история, отсечённая «обнулить клуб» (purge), и раз в
+# SNAPSHOT_INTERVAL снимаются балансы (db.take_snapshot) — по ним отвечают
+# запросы «баланс на дату» и «прирост за неделю», не перебирая всю историю.
+# Снимки старше SNAPSHOT_KEEP_DAYS удаляются и при RETENTION_DAYS = 0.
+# У каждого клуба (чата со своей базой) свой архив рядом с его базой;
+# клубы обходятся по очереди через db.club(background=True): после первого
+# прохода — только те, где с прошлого прохода работали обработчики (db.dirty_clubs).
+
+_task: asyncio.Task | None = None
+
+
+async def purge(chunk: int = PURGE_CHUNK, pause_ms: float = RETENTION_PAUSE_MS) -> int:
+    # -> сколько строк стёртой истории удалено
+    purged = 0
+    while True:
+        count = await purge_history(chunk)
+        purged += count
+        if count < chunk:
+            return purged
+        await asyncio.sleep(pause_ms / 1000)
+
+
+async def purge_club(chat_id: int | None) -> int:
+    async with club(chat_id, background=True):
+        return await purge()
+
+
+def archive_path(db_path: str) -> str:
+    if db_path == club_path(None):
+        return ARCHIVE_PATH
+    return os.path.splitext(db_path)[0] + "_archive.sqlite"
+
+
+async def attach_club_archive(chat_id: int | None):
+    # архив клуба, если переносы уже были: выгрузка истории читает и его
+    async with club(chat_id) as pool:
+        path = archive_path(pool.path)
+        if await asyncio.to_thread(os.path.exists, path):
+            await attach_archive(path)
+
+
+async def run_once(archive_path: str = ARCHIVE_PATH, days: float = RETENTION_DAYS,
+                   chunk: int = RETENTION_CHUNK, pause_ms: float = RETENTION_PAUSE_MS) -> int:
+    # -> сколько записей перенесено
+    if SNAPSHOT_INTERVAL > 0:
+        await take_snapshot(SNAPSHOT_INTERVAL)
+    await prune_snapshots(SNAPSHOT_KEEP_DAYS)  # и без переноса в архив: таблица снимков не растёт вечно
+    if days <= 0:
+        return 0
+    await attach_archive(archive_path)
+    await purge(pause_ms=pause_ms)
+    before = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time() - days * 86400))
+    moved = 0
+    while True:
+        count = await archive_history(before, chunk)
+        moved += count
+        if count < chunk:
+            await prune_snapshots(SNAPSHOT_KEEP_DAYS)
+            return moved  # старых записей больше нет
+        await asyncio.sleep(pause_ms / 1000)
+
+
+async def run_all() -> int:
+    # -> сколько записей перенесено во всех клубах
+    moved = 0
+    for chat_id in await dirty_clubs("retention"):
+        async with club(chat_id, background=True) as pool:
+            moved += await run_once(archive_path(pool.path))
+    return moved
+
+
+async def _loop():
+    while True:
+        try:
+            moved = await run_all()
+            if moved:
+                logging.info("Архив истории: перенесено %s записей", moved)
+        except Exception:
+            logging.exception("Ошибка переноса истории в архив")
+        await asyncio.sleep(RETENTION_INTERVAL)
+
+
+def start():
+    global _task
+    if _task is None and (RETENTION_DAYS > 0 or SNAPSHOT_INTERVAL > 0):
+        _task = asyncio.create_task(_loop())
+
+
+async def stop():
+    global _task
+    if _task is None:
+        return
+    _task.cancel()
+    await asyncio.gather(_task, return_exceptions=True)
+    _task = None
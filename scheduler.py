@@ -0,0 +1,44 @@
+import asyncio
+import itertools
+import logging
+import time
+
+# Лёгкий планировщик отложенных задач внутри процесса: таймер цикла событий
+# вместо корутины, которая спит. Ожидание ничего не стоит обработчикам.
+
+_timers: dict[int, asyncio.TimerHandle] = {}
+_tasks: set[asyncio.Task] = set()
+_ids = itertools.count()
+
+
+def call_at(when: float, fn, *args):
+    # when — время по часам time.time(); fn — async-функция
+    job_id = next(_ids)
+    delay = max(0.0, when - time.time())
+    _timers[job_id] = asyncio.get_running_loop().call_later(delay, _spawn, job_id, fn, args)
+
+
+def _spawn(job_id: int, fn, args):
+    _timers.pop(job_id, None)
+    task = asyncio.create_task(fn(*args))
+    _tasks.add(task)
+    task.add_done_callback(_done)
+
+
+def _done(task: asyncio.Task):
+    _tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logging.error("Отложенная задача упала", exc_info=task.exception())
+
+
+def pending() -> int:
+    return len(_timers) + len(_tasks)
+
+
+async def shutdown():
+    # Таймеры просто снимаем (их состояние хранится в базе), запущенные задачи дожидаемся
+    for timer in _timers.values():
+        timer.cancel()
+    _timers.clear()
+    if _tasks:
+        await asyncio.gather(*_tasks, return_exceptions=True)
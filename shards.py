@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from config import SHARD_WORKERS, SHARD_QUEUE_DEPTH
+import metrics
+
+# Упорядоченная обработка по участникам: у каждого участника, от которого ждут
+# сообщения, своя очередь и своя задача, которая выполняет их строго по порядку.
+# Разные участники друг друга не ждут: долгий обработчик держит только очередь
+# своего участника. Одновременно работает не больше SHARD_WORKERS обработчиков
+# (и при polling, и при вебхуке). У участника ждёт не больше SHARD_QUEUE_DEPTH
+# сообщений: сверх этого его сообщения отбрасываются (лог и счётчик
+# archivist_shard_dropped_total), а приём остальных не ждёт. Всего принятых и ещё
+# не выполненных сообщений не больше SHARD_WORKERS * SHARD_QUEUE_DEPTH — это
+# запасной предел: дальше приём ждёт, а polling запускается с
+# handle_as_tasks=False, поэтому ждёт и получение обновлений.
+# Долгая работа (выгрузки, ожидание кубика) в обработчике не выполняется,
+# а уходит в outbox.post или фоновую задачу.
+
+
+class UserShards:
+    def __init__(self, shards: int = SHARD_WORKERS, depth: int = SHARD_QUEUE_DEPTH):
+        self.limit = max(1, shards)
+        self.depth = max(1, depth)
+        self._running = asyncio.Semaphore(self.limit)
+        self._intake = asyncio.Semaphore(self.limit * self.depth)
+        self._queues: dict[int, deque] = {}  # участник -> его ждущие сообщения
+        self._dropping: dict[int, int] = {}  # участник -> сколько отброшено, пока его очередь полна
+        self._tasks: set[asyncio.Task] = set()
+        self.queued = 0
+        self.dropped = 0
+        self.processed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    async def stop(self):
+        # дорабатываем принятые сообщения
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def submit(self, key: int, fn, *args) -> bool:
+        # -> False, если очередь участника полна и сообщение отброшено
+        if self._full(key):
+            return self._drop(key)
+        await self._intake.acquire()
+        # пока ждали, очередь участника могла заполниться или закончиться
+        if self._full(key):
+            self._intake.release()
+            return self._drop(key)
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+            task = asyncio.create_task(self._worker(key, queue))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        queue.append((time.perf_counter(), fn, args))
+        self.queued += 1
+        return True
+
+    def _full(self, key: int) -> bool:
+        queue = self._queues.get(key)
+        return queue is not None and len(queue) >= self.depth
+
+    def _drop(self, key: int) -> bool:
+        self.dropped += 1
+        metrics.inc("archivist_shard_dropped_total")
+        self._dropping[key] = self._dropping.get(key, 0) + 1
+        if self._dropping[key] == 1:  # в лог — один раз, итог — когда очередь разберётся
+            logging.warning("Очередь участника %s полна (%s): его сообщения отбрасываются", key, self.depth)
+        return False
+
+    async def _worker(self, key: int, queue: deque):
+        # пока у участника есть сообщения; пустая очередь убирается вместе с задачей
+        try:
+            while queue:
+                queued_at, fn, args = queue.popleft()
+                self.queued -= 1
+                try:
+                    async with self._running:
+                        wait = time.perf_counter() - queued_at
+                        self.processed += 1
+                        self.wait_total += wait
+                        self.wait_max = max(self.wait_max, wait)
+                        await fn(*args)
+                except Exception:
+                    logging.exception("Ошибка в обработчике")
+                finally:
+                    self._intake.release()
+        finally:
+            del self._queues[key]
+            dropped = self._dropping.pop(key, 0)
+            if dropped:
+                logging.warning("У участника %s отброшено сообщений: %s", key, dropped)
+
+    def stats(self) -> dict:
+        return {
+            "shards": self.limit,
+            "users": len(self._queues),
+            "depth_total": self.queued,
+            "depth_max": max((len(q) for q in self._queues.values()), default=0),
+            "dropped": self.dropped,
+            "processed": self.processed,
+            "wait_avg_ms": self.wait_total / self.processed * 1e3 if self.processed else 0.0,
+            "wait_max_ms": self.wait_max * 1e3,
+        }
+
+    # Мидлварь aiogram v3: router.message.middleware(shards)
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user") or getattr(event, "from_user", None)
+        key = user.id if user else event.chat.id
+        await self.submit(key, handler, event, data)
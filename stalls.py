@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+from config import LOOP_STALL_MS
+import metrics
+
+# Сторож цикла событий: корутина-пульс отмечается каждые threshold/2, а поток
+# сторожа проверяет отметку. Если цикл не отмечался дольше порога, значит
+# какой-то колбэк работает синхронно (чтение файла, тяжёлый расчёт) и все
+# чаты ждут его. Поток снимает стек цикла в этот момент — на нём видно, что
+# именно блокирует и в каком обработчике (handle_*). Отчёт пишется, когда
+# цикл освободился: лог со стеком, счётчик archivist_loop_stalls_total и
+# гистограмма archivist_loop_stall_seconds по обработчикам. Стоит один
+# sys._current_frames() на зависание, так что его можно держать включённым.
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+_task: asyncio.Task | None = None
+_thread: threading.Thread | None = None
+_stop = threading.Event()
+_loop_thread = 0
+_beat = 0.0
+_stack: traceback.StackSummary | None = None  # стек цикла, снятый во время текущего зависания
+detected = 0
+
+
+def culprit(stack: traceback.StackSummary) -> str:
+    # обработчик команды, внутри которого застрял цикл, иначе — ближайшая функция бота
+    for frame in stack:
+        if frame.name.startswith("handle_") and frame.filename.startswith(ROOT):
+            return frame.name
+    for frame in reversed(stack):
+        if frame.filename.startswith(ROOT) and not frame.filename.startswith(os.path.join(ROOT, "bench")):
+            return f"{os.path.basename(frame.filename)}:{frame.name}"
+    return "unknown"
+
+
+def _watch(threshold: float, interval: float):
+    global _stack
+    while not _stop.wait(interval):
+        if _stack is None and time.monotonic() - _beat > interval + threshold:
+            frame = sys._current_frames().get(_loop_thread)
+            if frame is not None:
+                _stack = traceback.extract_stack(frame)
+
+
+def _report(lag: float):
+    global _stack, detected
+    stack, _stack = _stack, None
+    name = culprit(stack) if stack else "unknown"
+    detected += 1
+    metrics.inc("archivist_loop_stalls_total", handler=name)
+    metrics.histogram("loop_stall", name).observe(lag)
+    logging.warning("Цикл событий стоял %.0f мс в %s:\n%s", lag * 1e3, name,
+                    "".join(traceback.format_list(stack)) if stack else "(стек не снят)")
+
+
+async def _pulse(threshold: float, interval: float):
+    global _beat
+    while True:
+        _beat = time.monotonic()
+        await asyncio.sleep(interval)
+        lag = time.monotonic() - _beat - interval
+        if lag > threshold:
+            _report(lag)
+
+
+def start(threshold_ms: float = LOOP_STALL_MS):
+    # вызывать из работающего цикла событий
+    global _task, _thread, _loop_thread, _beat
+    if _task is not None or threshold_ms <= 0:
+        return
+    threshold = threshold_ms / 1000
+    interval = threshold / 2
+    _loop_thread = threading.get_ident()
+    _beat = time.monotonic()
+    _stop.clear()
+    _task = asyncio.create_task(_pulse(threshold, interval))
+    _thread = threading.Thread(target=_watch, args=(threshold, interval), name="loop-watchdog", daemon=True)
+    _thread.start()
+
+
+async def stop():
+    global _task, _thread, _stack
+    if _task is None:
+        return
+    _stop.set()
+    _task.cancel()
+    await asyncio.gather(_task, return_exceptions=True)
+    await asyncio.to_thread(_thread.join)
+    _task = _thread = _stack = None
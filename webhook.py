@@ -0,0 +1,86 @@
+import asyncio
+import logging
+
+from aiohttp import web
+
+from config import (
+    WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_HOST, WEBHOOK_PORT,
+    WEBHOOK_SECRET, WEBHOOK_WORKERS, WEBHOOK_QUEUE,
+)
+
+# Приём обновлений через вебхук (aiogram v3): встроенный aiohttp-сервер сразу
+# отвечает Telegram 200, а само обновление пул воркеров передаёт диспетчеру.
+# Обработчики команд выполняются в очередях по участникам (shards.py), поэтому
+# одновременно их работает не больше SHARD_WORKERS, сколько бы ни было воркеров
+# здесь; воркер занят, пока обновление не легло в очередь участника. Очереди
+# ограничены: если они полны, ответ задерживается, и Telegram сам притормаживает
+# доставку.
+
+
+class UpdateWorkers:
+    def __init__(self, dp, bot, workers: int = WEBHOOK_WORKERS, depth: int = WEBHOOK_QUEUE):
+        self.dp = dp
+        self.bot = bot
+        self.size = max(1, workers)
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=depth)
+        self._tasks: list[asyncio.Task] = []
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.size)]
+
+    async def stop(self):
+        # дорабатываем принятые обновления и гасим воркеры
+        await self.queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, update: dict):
+        await self.queue.put(update)
+
+    async def _worker(self):
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.dp.feed_raw_update(self.bot, update)
+            except Exception:
+                # тело не обязано быть похожим на обновление: в лог — как есть
+                update_id = update.get("update_id") if isinstance(update, dict) else None
+                logging.exception("Ошибка при обработке обновления %s", update_id)
+            finally:
+                self.queue.task_done()
+
+
+def build_app(workers: UpdateWorkers, path: str = WEBHOOK_PATH, secret: str | None = WEBHOOK_SECRET) -> web.Application:
+    async def handle(request: web.Request) -> web.Response:
+        if secret and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret:
+            return web.Response(status=401)
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        if not isinstance(update, dict):
+            return web.Response(status=400)  # обновление Telegram — всегда JSON-объект
+        await workers.submit(update)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, handle)
+    return app
+
+
+async def run_webhook(dp, bot, host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT):
+    workers = UpdateWorkers(dp, bot)
+    await workers.start()
+    runner = web.AppRunner(build_app(workers))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info("Вебхук слушает %s:%s%s, воркеров приёма: %s", host, port, WEBHOOK_PATH, workers.size)
+    if WEBHOOK_URL:
+        await bot.set_webhook(WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+    try:
+        await asyncio.Event().wait()  # работаем до отмены (Ctrl+C / остановка процесса)
+    finally:
+        await runner.cleanup()
+        await workers.stop()